@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import struct
+
+# A minimal MQTT 3.1.1 broker for the benchmarks. It keeps retained messages,
+# delivers by topic filter, honours last wills and completes the QoS 1 and 2
+# handshakes, but it has no persistent sessions and no authentication.
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+def topic_matches(topic_filter, topic):
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    if topic.startswith("$") and not topic_filter.startswith("$"):
+        return False
+    for i, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[i]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+def encode_remaining_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length > 0:
+            byte |= 0x80
+        encoded.append(byte)
+        if length == 0:
+            return bytes(encoded)
+
+
+def encode_string(value):
+    return struct.pack("!H", len(value)) + value
+
+
+def packet(packet_type, flags, body):
+    return bytes([(packet_type << 4) | flags]) + encode_remaining_length(len(body)) + body
+
+
+class Session:
+    def __init__(self, broker, reader, writer):
+        self._broker = broker
+        self._reader = reader
+        self._writer = writer
+        self._next_mid = 0
+        self._will = None
+        self.client_id = None
+
+    async def run(self):
+        try:
+            while True:
+                header = await self._reader.readexactly(1)
+                length = 0
+                multiplier = 1
+                while True:
+                    byte = (await self._reader.readexactly(1))[0]
+                    length += (byte & 0x7f) * multiplier
+                    multiplier *= 128
+                    if not byte & 0x80:
+                        break
+                body = await self._reader.readexactly(length)
+                if not self._handle(header[0] >> 4, header[0] & 0x0f, body):
+                    self._will = None
+                    break
+                await self._writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._broker.remove_session(self)
+            if self._will is not None:
+                self._broker.publish(*self._will)
+            self._writer.close()
+
+    def send_publish(self, topic, payload, qos, retain):
+        flags = (qos << 1) | (1 if retain else 0)
+        body = encode_string(topic)
+        if qos > 0:
+            self._next_mid = self._next_mid % 65535 + 1
+            body += struct.pack("!H", self._next_mid)
+        self._writer.write(packet(PUBLISH, flags, body + payload))
+
+
+    def _handle(self, packet_type, flags, body):
+        if packet_type == CONNECT:
+            self._handle_connect(body)
+        elif packet_type == PUBLISH:
+            qos = (flags >> 1) & 0x03
+            topic_length, = struct.unpack("!H", body[:2])
+            topic = body[2:2 + topic_length].decode("utf8")
+            offset = 2 + topic_length
+            if qos > 0:
+                mid = body[offset:offset + 2]
+                offset += 2
+            self._broker.publish(topic, body[offset:], qos, bool(flags & 0x01))
+            if qos == 1:
+                self._writer.write(packet(PUBACK, 0, mid))
+            elif qos == 2:
+                self._writer.write(packet(PUBREC, 0, mid))
+        elif packet_type == PUBREL:
+            self._writer.write(packet(PUBCOMP, 0, body[:2]))
+        elif packet_type == PUBREC:
+            self._writer.write(packet(PUBREL, 0x02, body[:2]))
+        elif packet_type == SUBSCRIBE:
+            self._handle_subscribe(body)
+        elif packet_type == UNSUBSCRIBE:
+            offset = 2
+            while offset < len(body):
+                length, = struct.unpack("!H", body[offset:offset + 2])
+                self._broker.unsubscribe(self, body[offset + 2:offset + 2 + length].decode("utf8"))
+                offset += 2 + length
+            self._writer.write(packet(UNSUBACK, 0, body[:2]))
+        elif packet_type == PINGREQ:
+            self._writer.write(packet(PINGRESP, 0, b""))
+        elif packet_type == DISCONNECT:
+            return False
+        return True
+
+    def _handle_connect(self, body):
+        offset = 2 + struct.unpack("!H", body[:2])[0]
+        connect_flags = body[offset + 1]
+        offset += 4
+        fields = []
+        while offset < len(body):
+            length, = struct.unpack("!H", body[offset:offset + 2])
+            fields.append(body[offset + 2:offset + 2 + length])
+            offset += 2 + length
+        self.client_id = fields[0].decode("utf8")
+        if connect_flags & 0x04:
+            will_qos = (connect_flags >> 3) & 0x03
+            will_retain = bool(connect_flags & 0x20)
+            self._will = (fields[1].decode("utf8"), fields[2], will_qos, will_retain)
+        self._writer.write(packet(CONNACK, 0, b"\x00\x00"))
+
+    def _handle_subscribe(self, body):
+        offset = 2
+        granted = bytearray()
+        topic_filters = []
+        while offset < len(body):
+            length, = struct.unpack("!H", body[offset:offset + 2])
+            topic_filter = body[offset + 2:offset + 2 + length].decode("utf8")
+            qos = body[offset + 2 + length]
+            self._broker.subscribe(self, topic_filter, qos)
+            topic_filters.append((topic_filter, qos))
+            granted.append(qos)
+            offset += 3 + length
+        self._writer.write(packet(SUBACK, 0, body[:2] + bytes(granted)))
+        for topic_filter, qos in topic_filters:
+            if "+" in topic_filter or "#" in topic_filter:
+                retained = [(topic, message) for topic, message in self._broker.retained.items() if topic_matches(topic_filter, topic)]
+            elif topic_filter in self._broker.retained:
+                retained = [(topic_filter, self._broker.retained[topic_filter])]
+            else:
+                retained = []
+            for topic, (payload, retained_qos) in retained:
+                self.send_publish(topic.encode("utf8"), payload, min(qos, retained_qos), True)
+
+
+class Broker:
+    def __init__(self):
+        self.retained = {}
+        # the qos of the subscribed sessions by topic filter, filters without
+        # wildcards are looked up by the topic directly
+        self._exact = {}
+        self._wildcards = {}
+        self._session_filters = {}
+
+    def subscribe(self, session, topic_filter, qos):
+        if "+" in topic_filter or "#" in topic_filter:
+            subscriptions = self._wildcards
+        else:
+            subscriptions = self._exact
+        subscriptions.setdefault(topic_filter, {})[session] = qos
+        self._session_filters.setdefault(session, set()).add(topic_filter)
+
+    def unsubscribe(self, session, topic_filter):
+        for subscriptions in [self._exact, self._wildcards]:
+            sessions = subscriptions.get(topic_filter)
+            if sessions is not None:
+                sessions.pop(session, None)
+                if not sessions:
+                    del subscriptions[topic_filter]
+        self._session_filters.get(session, set()).discard(topic_filter)
+
+    def remove_session(self, session):
+        for topic_filter in list(self._session_filters.pop(session, ())):
+            for subscriptions in [self._exact, self._wildcards]:
+                sessions = subscriptions.get(topic_filter)
+                if sessions is not None:
+                    sessions.pop(session, None)
+                    if not sessions:
+                        del subscriptions[topic_filter]
+
+    def publish(self, topic, payload, qos, retain):
+        if retain:
+            if payload:
+                self.retained[topic] = (payload, qos)
+            else:
+                self.retained.pop(topic, None)
+        granted = dict(self._exact.get(topic, {}))
+        for topic_filter, sessions in self._wildcards.items():
+            if topic_matches(topic_filter, topic):
+                for session, subscription_qos in sessions.items():
+                    granted[session] = max(granted.get(session, 0), subscription_qos)
+        if granted:
+            encoded_topic = topic.encode("utf8")
+            for session, subscription_qos in granted.items():
+                session.send_publish(encoded_topic, payload, min(qos, subscription_qos), False)
+
+    async def _on_client(self, reader, writer):
+        await Session(self, reader, writer).run()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self._on_client, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a minimal mqtt broker for the benchmarks.")
+    parser.add_argument("--host", help="the address to listen on, defaults to 127.0.0.1")
+    parser.add_argument("--port", type=int, help="the port to listen on, defaults to 1883")
+    parser.add_argument("--retained", type=int, help="the number of retained messages to start with, defaults to 0")
+    args = parser.parse_args()
+
+    if args.host:
+        host = args.host
+    else:
+        host = "127.0.0.1"
+    if args.port:
+        port = args.port
+    else:
+        port = 1883
+    if args.retained:
+        retained = args.retained
+    else:
+        retained = 0
+
+    broker = Broker()
+    for i in range(retained):
+        broker.retained["seed/{0}/{1}".format(i % 100, i)] = (b"x" * 16, 1)
+    asyncio.run(broker.serve(host, port))
+
+if __name__ == "__main__":
+    main()
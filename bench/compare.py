@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+import argparse
+import json
+
+def flatten(value, prefix=""):
+    # the numbers of the results by their dotted path
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from flatten(item, "{0}{1}.".format(prefix, key))
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield prefix[:-1], value
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the results of two benchmark runs.")
+    parser.add_argument("baseline", help="the results to compare against")
+    parser.add_argument("results", help="the results to compare")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.results) as f:
+        results = json.load(f)
+
+    print("{0} -> {1}".format((baseline.get("commit") or "unknown")[:10], (results.get("commit") or "unknown")[:10]))
+    old_values = dict(flatten(baseline["benchmarks"]))
+    for key, new_value in flatten(results["benchmarks"]):
+        old_value = old_values.get(key)
+        if old_value is None:
+            print("{0:<40} {1:>14} {2:>14.2f}".format(key, "-", new_value))
+        elif old_value == 0:
+            print("{0:<40} {1:>14.2f} {2:>14.2f}".format(key, old_value, new_value))
+        else:
+            print("{0:<40} {1:>14.2f} {2:>14.2f} {3:>+8.1f}%".format(key, old_value, new_value, (new_value - old_value) / old_value * 100))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import contextlib
+import datetime
+import importlib.util
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src", "common"))
+import async_mqtt
+import metrics
+import paho.mqtt.client as mqtt
+
+BENCHMARKS = ["sensor-node", "chat-rtt", "purge", "metrics", "alarms"]
+
+def load_program(name):
+    # every program is a main.py of its own, so they are loaded under their directory name
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, "src", name, "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def get_commit():
+    try:
+        commit = subprocess.check_output(["git", "-C", ROOT, "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode('utf8').strip()
+        status = subprocess.check_output(["git", "-C", ROOT, "status", "--porcelain", "--untracked-files=no"], stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status.strip())
+
+def get_percentiles(values):
+    values = sorted(values)
+    result = {}
+    for percentile in [50, 90, 99]:
+        result["p{0}".format(percentile)] = values[min(int(round(percentile / 100 * (len(values) - 1))), len(values) - 1)]
+    result["mean"] = sum(values) / len(values)
+    result["max"] = values[-1]
+    return result
+
+def log(line):
+    print(line, file=sys.stderr, flush=True)
+
+
+class LocalBroker:
+    # mosquitto or the python broker of bench/broker.py, listening on a free local port
+    def __init__(self, kind, retained=0):
+        self.port = get_free_port()
+        if kind == "mosquitto":
+            command = ["mosquitto", "-p", "{0}".format(self.port)]
+        else:
+            command = [sys.executable, os.path.join(ROOT, "bench", "broker.py"), "--port", "{0}".format(self.port), "--retained", "{0}".format(retained)]
+        self._process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self._wait_for_port(60.0)
+        if kind == "mosquitto" and retained:
+            asyncio.run(self._seed(retained))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+        return False
+
+    def _wait_for_port(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=1.0).close()
+                return
+            except OSError:
+                if self._process.poll() is not None or time.monotonic() > deadline:
+                    self.close()
+                    raise RuntimeError("The broker did not start listening on port {0}".format(self.port))
+                time.sleep(0.05)
+
+    async def _seed(self, count):
+        # the same topics the python broker starts with
+        publisher = async_mqtt.AsyncClient("127.0.0.1", self.port, max_inflight=1000)
+        await publisher.connect()
+        for i in range(count):
+            await publisher.wait_for_window()
+            publisher.publish_nowait("seed/{0}/{1}".format(i % 100, i), b"x" * 16, qos=1, retain=True)
+        await publisher.drain()
+        await publisher.close()
+
+    def close(self):
+        if self._process.poll() is None:
+            self._process.terminate()
+        self._process.wait()
+
+
+class SyntheticSensorBackend:
+    # a seeded random walk instead of the sensors of this machine, so that every
+    # run publishes the same values
+    def __init__(self, sensors, seed=0):
+        self._random = random.Random(seed)
+        self._sensors = ["temp{0}".format(i + 1) for i in range(sensors)]
+        self._values = [40.0 for _ in range(sensors)]
+
+    def read(self, sensors=None):
+        for i, sensor in enumerate(self._sensors):
+            if sensors is not None and sensor not in sensors:
+                continue
+            self._values[i] = round(self._values[i] + self._random.uniform(-0.5, 0.5), 1)
+            yield sensor, self._values[i], "°C"
+
+    def close(self):
+        pass
+
+
+class RecordingUI:
+    # stands in for ChatUI and remembers when each message arrived
+    def __init__(self):
+        self._received = {}
+        self._condition = threading.Condition()
+        self._window = ""
+
+    def set_history(self, history, name=""):
+        pass
+
+    def open_window(self, name):
+        pass
+
+    def close_window(self, name):
+        pass
+
+    def switch_window(self, name):
+        self._window = name
+
+    def get_window(self):
+        return self._window
+
+    def chatbuffer_addmessage(self, author, message, name=None):
+        with self._condition:
+            self._received[message] = time.perf_counter()
+            self._condition.notify_all()
+
+    def wait_for(self, message, timeout=10.0):
+        with self._condition:
+            if not self._condition.wait_for(lambda: message in self._received, timeout):
+                raise RuntimeError("Did not receive {0!r} within {1} seconds".format(message, timeout))
+            return self._received.pop(message)
+
+
+async def scan_sensor_node(node, sensors, scans):
+    started_on = time.perf_counter()
+    cpu_started_on = time.process_time()
+    for _ in range(scans):
+        # wait for room in the window instead of dropping readings
+        await node._client.wait_for_window(sensors)
+        node._publish_sensors()
+    scanned_on = time.perf_counter()
+    cpu_elapsed = time.process_time() - cpu_started_on
+    # the broker handles messages in order, once this one is acknowledged all
+    # readings went through
+    await node._client.publish("bench/marker", qos=1)
+    return started_on, scanned_on, cpu_elapsed, time.perf_counter()
+
+def stop_sensor_node(node):
+    node._alive = False
+    node._wake_up()
+
+def benchmark_sensor_node(broker_kind, sensors, scans, node_metrics=None):
+    program = load_program("publish_temperature_stateful")
+    with LocalBroker(broker_kind) as broker:
+        # the scan rate is long enough for the node not to scan by itself
+        node = program.SensorNode("127.0.0.1", broker.port, "bench-node", 3600.0, SyntheticSensorBackend(sensors), metrics=node_metrics)
+        runner = threading.Thread(target=node.run)
+        runner.start()
+        deadline = time.monotonic() + 10.0
+        while not node._connected and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # the first scan and the birth are out by now
+        time.sleep(0.5)
+        # the scans run in the event loop of the node like its own ones
+        started_on, scanned_on, cpu_elapsed, published_on = asyncio.run_coroutine_threadsafe(scan_sensor_node(node, sensors, scans), node._loop).result()
+        elapsed = published_on - started_on
+        node._loop.call_soon_threadsafe(stop_sensor_node, node)
+        runner.join()
+    return {
+        "sensors": sensors,
+        "scans": scans,
+        "publishes_per_second": scans * sensors / elapsed,
+        "us_per_scan": (scanned_on - started_on) / scans * 1e6,
+        "cpu_us_per_scan": cpu_elapsed / scans * 1e6,
+    }
+
+def benchmark_chat_rtt(broker_kind, messages):
+    program = load_program("chat_client")
+    ui = RecordingUI()
+    result = {}
+    with LocalBroker(broker_kind) as broker:
+        client = program.ChatClient(ui, "127.0.0.1", nickname="bench", client_id="bench-{0}".format(os.getpid()), clean_session=True, channels=["bench"])
+        # joins the channel once connected
+        client._connect("127.0.0.1", broker.port)
+        ui.wait_for("bench joined the channel")
+        for qos in [0, 1, 2]:
+            client._qos = qos
+            # the first messages warm up the connection
+            for i in range(10):
+                client._send_message_as("bench", "warm up {0} {1}".format(qos, i))
+                ui.wait_for("warm up {0} {1}".format(qos, i))
+            round_trips = []
+            for i in range(messages):
+                message = "round trip {0} {1}".format(qos, i)
+                sent_on = time.perf_counter()
+                client._send_message_as("bench", message)
+                round_trips.append((ui.wait_for(message) - sent_on) * 1000)
+            result["qos{0}".format(qos)] = dict(get_percentiles(round_trips), messages=messages, unit="ms")
+        client._disconnect()
+    return result
+
+def benchmark_purge(broker_kind, sizes, connections, window):
+    tooling = load_program("tooling")
+    result = {}
+    for size in sizes:
+        log("Purging {0} retained topics".format(size))
+        with LocalBroker(broker_kind, retained=size) as broker:
+            purge = tooling.PublishNullForeachRetained("127.0.0.1", broker.port, connections=connections, window=window, idle_timeout=1.0, quiet=True)
+            started_on = time.monotonic()
+            purge.run()
+            purged = sum(purger.published for purger in purge._purgers)
+            last_purged_on = max([started_on] + [purger.last_published_on for purger in purge._purgers])
+            elapsed = max(last_purged_on - started_on, 0.001)
+        result["{0}".format(size)] = {
+            "retained": size,
+            "purged": purged,
+            "seconds": elapsed,
+            "topics_per_second": purged / elapsed,
+            "connections": connections,
+            "window": window,
+        }
+    return result
+
+def benchmark_metrics(broker_kind, sensors, scans, rounds=3):
+    # the sensor node with and without metrics, in alternating rounds so that both
+    # see the same machine, the fastest round of each counts
+    without_metrics = []
+    with_metrics = []
+    for i in range(rounds):
+        log("Round {0} of {1}".format(i + 1, rounds))
+        without_metrics.append(benchmark_sensor_node(broker_kind, sensors, scans))
+        registry = metrics.Metrics({"application_id": "bench-node"})
+        with_metrics.append(benchmark_sensor_node(broker_kind, sensors, scans, registry))
+    result = {}
+    for key in ["us_per_scan", "cpu_us_per_scan"]:
+        baseline = min(run[key] for run in without_metrics)
+        measured = min(run[key] for run in with_metrics)
+        result[key] = {
+            "without_metrics": baseline,
+            "with_metrics": measured,
+            "overhead_percent": (measured - baseline) / baseline * 100,
+        }
+    # the cost of a single observation and of exporting the metrics of the last node
+    histogram = metrics.Histogram()
+    observations = 1000000
+    started_on = time.perf_counter()
+    for i in range(observations):
+        histogram.observe(0.0005)
+    result["ns_per_observe"] = (time.perf_counter() - started_on) / observations * 1e9
+    exports = 1000
+    started_on = time.perf_counter()
+    for _ in range(exports):
+        registry.to_json()
+        metrics.to_prometheus([registry])
+    result["us_per_export"] = (time.perf_counter() - started_on) / exports * 1e6
+    return result
+
+async def tick_alarm_engine(engine, ticks, readings):
+    # feeds the readings of all sensors into the engine like the client would and
+    # evaluates them once per tick, every other tick raises and resolves alarms
+    ingest_seconds = []
+    evaluate_seconds = []
+    for tick in range(ticks):
+        started_on = time.perf_counter()
+        for msg in readings[tick % 2]:
+            engine._on_message(msg)
+        ingested_on = time.perf_counter()
+        engine._evaluate()
+        evaluate_seconds.append(time.perf_counter() - ingested_on)
+        ingest_seconds.append(ingested_on - started_on)
+        # the alarms are acknowledged before the next tick, like they would be within a second
+        await engine._client.drain()
+    return ingest_seconds, evaluate_seconds
+
+def benchmark_alarms(broker_kind, sensors, ticks, alarm_percent=1.0):
+    program = load_program("temperature_alarm_engine")
+    sensors_per_node = 10
+    nodes = max(sensors // sensors_per_node, 1)
+    rng = random.Random(0)
+    in_alarm = set(rng.sample(range(nodes * sensors_per_node), int(nodes * sensors_per_node * alarm_percent / 100)))
+    births = []
+    readings = ([], [])
+    for node in range(nodes):
+        node_id = "bench-{0:06d}".format(node)
+        birth = []
+        for sensor in range(sensors_per_node):
+            topic = "{0}/property/temp{1}".format(node_id, sensor)
+            birth.append({"topic": topic, "modes": ["pub"], "type": "numeric", "quantity": "temperature", "unit": "degree_celsius"})
+            for i, value in enumerate([40.0, 70.0]):
+                msg = mqtt.MQTTMessage(topic=topic.encode('utf8'))
+                if node * sensors_per_node + sensor in in_alarm:
+                    msg.payload = "{0}".format(value).encode('utf8')
+                else:
+                    msg.payload = b"40.0"
+                readings[i].append(msg)
+        births.append((node_id, json.dumps(birth).encode('utf8')))
+    with LocalBroker(broker_kind) as broker:
+        # the interval is long enough for the engine not to tick by itself
+        engine = program.TemperatureAlarmEngine("127.0.0.1", broker.port, "bench-alarms", program.TemperatureTable(), 65.0, 2.0, 3600.0)
+        runner = threading.Thread(target=engine.run)
+        runner.start()
+        deadline = time.monotonic() + 10.0
+        while (engine._client is None or not engine._client.connected) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        loop = engine._client._loop
+        for node_id, birth in births:
+            loop.call_soon_threadsafe(engine._on_birth, node_id, birth)
+        ingest_seconds, evaluate_seconds = asyncio.run_coroutine_threadsafe(tick_alarm_engine(engine, ticks, readings), loop).result()
+        loop.call_soon_threadsafe(engine._shutdown)
+        runner.join()
+    ingest = min(ingest_seconds)
+    evaluate = sorted(evaluate_seconds)
+    return {
+        "sensors": nodes * sensors_per_node,
+        "ticks": ticks,
+        "transitions_per_tick": len(in_alarm),
+        "ns_per_reading": ingest / (nodes * sensors_per_node) * 1e9,
+        "evaluate_ms": dict(get_percentiles([seconds * 1000 for seconds in evaluate]), unit="ms"),
+        # the share of a core it takes to ingest every sensor once and evaluate them at 1 Hz
+        "core_percent_at_1hz": (ingest + evaluate[len(evaluate) // 2]) * 100,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the programs against a local mqtt broker and write the results as json.")
+    parser.add_argument("--broker", choices=["auto", "python", "mosquitto"], help="the broker to run, auto prefers mosquitto if it is installed, defaults to auto")
+    parser.add_argument("--only", action="append", choices=BENCHMARKS, help="run only this benchmark, may be given more than once")
+    parser.add_argument("--sensors", type=int, help="the number of sensors of the sensor node, defaults to 32")
+    parser.add_argument("--scans", type=int, help="the number of scans of the sensor node, defaults to 2000")
+    parser.add_argument("--chat-messages", type=int, help="the number of chat round trips per qos, defaults to 1000")
+    parser.add_argument("--purge-sizes", help="a comma separated list of the numbers of retained topics to purge, defaults to 10000,100000,1000000")
+    parser.add_argument("--connections", type=int, help="the number of connections to purge over, defaults to 1")
+    parser.add_argument("--window", type=int, help="the number of purges in flight per connection, defaults to 100")
+    parser.add_argument("--metrics-rounds", type=int, help="the number of rounds of the sensor node with and without metrics, defaults to 3")
+    parser.add_argument("--alarm-sensors", type=int, help="the number of sensors of the alarm engine, defaults to 100000")
+    parser.add_argument("--alarm-ticks", type=int, help="the number of ticks of the alarm engine, defaults to 10")
+    parser.add_argument("--output", help="the file to write the results to, defaults to bench/results/TIMESTAMP-COMMIT.json")
+    args = parser.parse_args()
+
+    if args.broker and args.broker != "auto":
+        broker_kind = args.broker
+    elif shutil.which("mosquitto"):
+        broker_kind = "mosquitto"
+    else:
+        broker_kind = "python"
+    if args.only:
+        benchmarks = args.only
+    else:
+        benchmarks = BENCHMARKS
+    if args.sensors:
+        sensors = args.sensors
+    else:
+        sensors = 32
+    if args.scans:
+        scans = args.scans
+    else:
+        scans = 2000
+    if args.chat_messages:
+        chat_messages = args.chat_messages
+    else:
+        chat_messages = 1000
+    if args.purge_sizes:
+        purge_sizes = [int(size) for size in args.purge_sizes.split(",")]
+    else:
+        purge_sizes = [10000, 100000, 1000000]
+    if args.connections:
+        connections = args.connections
+    else:
+        connections = 1
+    if args.window:
+        window = args.window
+    else:
+        window = 100
+
+    if args.metrics_rounds:
+        metrics_rounds = args.metrics_rounds
+    else:
+        metrics_rounds = 3
+    if args.alarm_sensors:
+        alarm_sensors = args.alarm_sensors
+    else:
+        alarm_sensors = 100000
+    if args.alarm_ticks:
+        alarm_ticks = args.alarm_ticks
+    else:
+        alarm_ticks = 10
+
+    commit, dirty = get_commit()
+    created_on = datetime.datetime.now(datetime.timezone.utc)
+    if args.output:
+        output = args.output
+    else:
+        output = os.path.join(ROOT, "bench", "results", "{0}-{1}.json".format(created_on.strftime("%Y%m%dT%H%M%S"), (commit or "unknown")[:10]))
+
+    results = {
+        "commit": commit,
+        "dirty": dirty,
+        "created_on": created_on.isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "broker": broker_kind,
+        "benchmarks": {},
+    }
+    # the programs print what they are doing, keep that apart from the results
+    with contextlib.redirect_stdout(sys.stderr):
+        if "sensor-node" in benchmarks:
+            log("Running the sensor node benchmark")
+            results["benchmarks"]["sensor_node"] = benchmark_sensor_node(broker_kind, sensors, scans)
+        if "chat-rtt" in benchmarks:
+            log("Running the chat round trip benchmark")
+            results["benchmarks"]["chat_rtt"] = benchmark_chat_rtt(broker_kind, chat_messages)
+        if "purge" in benchmarks:
+            log("Running the purge benchmark")
+            results["benchmarks"]["purge"] = benchmark_purge(broker_kind, purge_sizes, connections, window)
+        if "metrics" in benchmarks:
+            log("Running the metrics overhead benchmark")
+            results["benchmarks"]["metrics"] = benchmark_metrics(broker_kind, sensors, scans, metrics_rounds)
+        if "alarms" in benchmarks:
+            log("Running the alarm engine benchmark")
+            results["benchmarks"]["alarms"] = benchmark_alarms(broker_kind, alarm_sensors, alarm_ticks)
+
+    directory = os.path.dirname(output)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write("\n")
+    print(json.dumps(results["benchmarks"], indent=2, sort_keys=True))
+    log("Wrote the results to {0}".format(output))
+
+if __name__ == "__main__":
+    main()
@@ -1,48 +1,131 @@
 #!/usr/bin/env python3
-import paho.mqtt.client as mqtt
 import argparse
+import asyncio
+import concurrent.futures
+import os
+import signal
 import socket
-import time
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+import async_mqtt
+import metrics
 
 class SomeNode:
-    def __init__(self, host, port, application_id):
+    # the seconds to wait for DEAD to be acknowledged when shutting down
+    SHUTDOWN_TIMEOUT = 5.0
+
+    def __init__(self, host, port, application_id, metrics=None, metrics_interval=60.0, metrics_file=None):
         self._host = host
         self._port = port
         self._application_id = application_id
+        self._client = None
+        # the metrics are published retained to <id>/metrics and written to the
+        # metrics file every metrics interval
+        self._metrics = metrics
+        self._metrics_interval = metrics_interval
+        self._metrics_file = metrics_file
 
     def run(self):
-        self._client = mqtt.Client()
-        self._client.on_connect = self._on_connect
-        self._client.on_message = self._on_message
-        self._client.on_disconnect = self._on_disconnect
+        try:
+            asyncio.run(self._run())
+        except KeyboardInterrupt:
+            pass
+
+    async def _run(self, stopping=None):
+        self._client = self._create_client()
+        self._client.start()
+        reporter = None
+        if self._metrics is not None and self._metrics_interval > 0:
+            reporter = asyncio.ensure_future(metrics.report(self._metrics, self._client, "{0}/metrics".format(self._application_id), self._metrics_interval, self._metrics_file))
+        if stopping is None:
+            stopping = asyncio.Event()
+        await stopping.wait()
+        if reporter is not None:
+            reporter.cancel()
+        if self._client.connected:
+            # a clean disconnect drops the will, so publish DEAD ourselves
+            self._client.publish_nowait(self._get_topic_application_state(), "DEAD", qos=1, retain=True)
+        await self._client.close(self.SHUTDOWN_TIMEOUT)
+
+    def _create_client(self):
+        # the node does not subscribe to anything, only a few messages are kept
+        client = async_mqtt.AsyncClient(self._host, self._port, max_inflight=10, queue_size=10, overflow=async_mqtt.DROP_OLDEST)
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
         # Set last will of the node, the broker stores this message and publishes
         # it on behalf of this node when it detects that this node disconnects from
         # the broker.
-        self._client.will_set(self._get_topic_application_state(), "DEAD", qos=1, retain=True)
-        self._client.connect(self._host, self._port, 60)
-        self._client.loop_start()
-        while True:
-            time.sleep(1.0)
+        client.will_set(self._get_topic_application_state(), "DEAD", qos=1, retain=True)
+        if self._metrics is not None:
+            client.register_metrics(self._metrics)
+        return client
     
     def _get_topic_application_state(self):
         return "{0}/state".format(self._application_id)
 
-    def _on_message(self, client, userdata, msg):
-        pass
-
-    def _on_connect(self, client, userdata, flags, rc):
+    def _on_connect(self):
         print("Connected to {0}:{1}".format(self._host, self._port))
-        self._client.publish(self._get_topic_application_state(), "ALIVE", qos=1, retain=True)
+        self._client.publish_nowait(self._get_topic_application_state(), "ALIVE", qos=1, retain=True)
 
-    def _on_disconnect(self, client, userdata, rc):
+    def _on_disconnect(self):
         print("Disconnected from {0}:{1}".format(self._host, self._port))
 
 
+class AsyncNodeRuntime:
+    # Hosts many nodes in a single asyncio event loop. Every node keeps its own
+    # session, will and ALIVE publication, their clients are driven by the loop
+    # instead of a network thread each. Connecting blocks, so connects run on a few
+    # worker threads and a broker that is down does not stall the nodes that are
+    # still connected.
+    CONNECT_THREADS = 8
+
+    def __init__(self, host, port, nodes, metrics_interval=60.0, metrics_file=None):
+        self._host = host
+        self._port = port
+        self._nodes = nodes
+        # the metrics of all nodes are written to a single file, every node
+        # publishes its own
+        self._metrics_interval = metrics_interval
+        self._metrics_file = metrics_file
+
+    def run(self):
+        asyncio.run(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(max_workers=self.CONNECT_THREADS))
+        stopping = asyncio.Event()
+        for signum in [signal.SIGINT, signal.SIGTERM]:
+            loop.add_signal_handler(signum, stopping.set)
+        writer = None
+        if self._metrics_file is not None and self._metrics_interval > 0:
+            writer = asyncio.ensure_future(self._write_metrics())
+        # the nodes shut down cleanly on a signal and publish DEAD themselves
+        await asyncio.gather(*[node._run(stopping) for node in self._nodes])
+        if writer is not None:
+            writer.cancel()
+
+    async def _write_metrics(self):
+        registries = [node._metrics for node in self._nodes if node._metrics is not None]
+        while True:
+            await asyncio.sleep(self._metrics_interval)
+            metrics.write_prometheus(self._metrics_file, registries)
+
+
+def create_metrics(application_id, metrics_interval):
+    if metrics_interval > 0:
+        return metrics.Metrics({"application_id": application_id})
+    return None
+
 def main():
     parser = argparse.ArgumentParser(description="Publish temperature sensors of this machine.")
     parser.add_argument("--host", help="the host of the mqtt broker")
     parser.add_argument("--port", type=int, help="the port of the mqtt broker")
     parser.add_argument("--application-id", help="a custom application id, defaults to the hostname of the machine")
+    parser.add_argument("--nodes", type=int, help="the number of nodes to host in a single event loop, their application ids are APPLICATION_ID-0000 and so on, defaults to 1")
+    parser.add_argument("--metrics-interval", type=float, help="the seconds between publishing the metrics of each node to APPLICATION_ID/metrics, defaults to 60.0, 0 disables the metrics")
+    parser.add_argument("--metrics-file", help="a file the metrics of all nodes are written to in the prometheus text format every metrics interval")
     args = parser.parse_args()
 
     if args.host:
@@ -57,7 +140,21 @@ def main():
         application_id = args.application_id
     else:
         application_id = socket.gethostname()
-    node = SomeNode(host, port, application_id)
-    node.run()
+    if args.nodes:
+        nodes = args.nodes
+    else:
+        nodes = 1
+    if args.metrics_interval is not None:
+        metrics_interval = args.metrics_interval
+    else:
+        metrics_interval = 60.0
+    if nodes > 1:
+        application_ids = ["{0}-{1:04d}".format(application_id, i) for i in range(nodes)]
+        runtime = AsyncNodeRuntime(host, port, [SomeNode(host, port, node_id, create_metrics(node_id, metrics_interval), metrics_interval) for node_id in application_ids], metrics_interval, args.metrics_file)
+        runtime.run()
+    else:
+        node = SomeNode(host, port, application_id, create_metrics(application_id, metrics_interval), metrics_interval, args.metrics_file)
+        node.run()
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
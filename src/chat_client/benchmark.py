@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import random
+import time
+
+from main import CompactDecoder, CompactEncoder, zstandard
+
+def get_messages(count):
+    random.seed(0)
+    authors = ["alice", "bob", "carol@some-host", "dave"]
+    words = ["mqtt", "broker", "retained", "qos", "topic", "hello", "the", "a", "is", "sensor"]
+    return [(random.choice(authors), " ".join(random.choice(words) for _ in range(random.randint(1, 12)))) for _ in range(count)]
+
+def benchmark(name, encode, decode, items, count):
+    started_on = time.perf_counter()
+    payloads = [encode(item) for item in items]
+    encoded_on = time.perf_counter()
+    for payload in payloads:
+        decode(payload)
+    decoded_on = time.perf_counter()
+    size = sum(len(payload) for payload in payloads)
+    print("{0:>14}: {1:6.2f} us encode, {2:6.2f} us decode, {3:6.1f} bytes per message".format(
+        name, (encoded_on - started_on) / count * 1e6, (decoded_on - encoded_on) / count * 1e6, size / count))
+
+def benchmark_batches(name, compression, messages, batch_size):
+    encoder = CompactEncoder(1, compression)
+    decoder = CompactDecoder()
+    batches = [messages[i:i + batch_size] for i in range(0, len(messages), batch_size)]
+    benchmark(name, encoder.encode_batch, decoder.decode, batches, len(messages))
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare encoding and decoding chat messages as json tuples and compact frames.")
+    parser.add_argument("--messages", type=int, help="the number of messages, defaults to 100000")
+    parser.add_argument("--batch-size", type=int, help="the number of messages per batch, defaults to 50")
+    args = parser.parse_args()
+
+    if args.messages:
+        count = args.messages
+    else:
+        count = 100000
+    if args.batch_size:
+        batch_size = args.batch_size
+    else:
+        batch_size = 50
+    messages = get_messages(count)
+
+    benchmark("json", lambda message: json.dumps(message).encode('utf8'), lambda payload: json.loads(payload.decode('utf8')), messages, count)
+    encoder = CompactEncoder(1)
+    decoder = CompactDecoder()
+    benchmark("compact", lambda message: encoder.encode(*message), decoder.decode, messages, count)
+    for compression in CompactEncoder.COMPRESSIONS:
+        if compression == "zstd" and zstandard is None:
+            print("{0:>14}: the zstandard module is not installed".format("batch zstd"))
+            continue
+        benchmark_batches("batch {0}".format(compression), compression, messages, batch_size)
+
+if __name__ == "__main__":
+    main()
@@ -1,46 +1,303 @@
 #!/usr/bin/env python3
 import argparse
+import array
+import collections
 import curses
 import json
-import paho.mqtt.client as mqtt
+import mmap
+import os
+import random
 import re
+import select
 import string
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+import async_mqtt
+import metrics
+
+class PrefixTrieNode:
+    __slots__ = ["children", "count", "newest", "entry"]
 
-class CommandHistorian:
     def __init__(self):
-        self._items = []
-        self._index = 0
-    
-    def navDown(self):
-        self._index -= 1
-        if self._index < 0:
-            self._index = len(self._items) - 1
-        if self._index < 0:
-            self._index = 0
-    
-    def navUp(self):
-        self._index += 1
-        if self._index >= len(self._items):
-            self._index = 0
+        self.children = {}
+        # the number of commands below this node and the newest of them
+        self.count = 0
+        self.newest = None
+        # the command that ends here
+        self.entry = None
 
-    def push(self, item):
-        self._items.insert(self._index, item)
-    
-    def put(self, item):
-        self._items[self._index] = item
-    
-    def get(self):
-        return self._items[self._index]
+
+class PrefixTrie:
+    # Commands by their prefixes. Every node remembers the newest command below it,
+    # so the newest command with a prefix is found by walking the prefix only.
+    def __init__(self):
+        self._root = PrefixTrieNode()
+
+    def add(self, command, sequence):
+        # the sequence must grow with every command added
+        entry = (sequence, command)
+        node = self._root
+        node.count += 1
+        node.newest = entry
+        for c in command:
+            child = node.children.get(c)
+            if child is None:
+                child = PrefixTrieNode()
+                node.children[c] = child
+            node = child
+            node.count += 1
+            node.newest = entry
+        node.entry = entry
+
+    def remove(self, command):
+        # commands are only removed when they are the oldest one or when they are
+        # added again right away, so the newest command of a node that still has
+        # commands below it never is the removed one
+        path = [self._root]
+        for c in command:
+            node = path[-1].children.get(c)
+            if node is None:
+                return
+            path.append(node)
+        if path[-1].entry is None:
+            return
+        path[-1].entry = None
+        for node in path:
+            node.count -= 1
+        for i in range(1, len(path)):
+            if path[i].count == 0:
+                del path[i - 1].children[command[i - 1]]
+                break
+
+    def _find(self, prefix):
+        node = self._root
+        for c in prefix:
+            node = node.children.get(c)
+            if node is None:
+                return None
+        if node.count == 0:
+            return None
+        return node
+
+    def newest(self, prefix):
+        node = self._find(prefix)
+        if node is None:
+            return None
+        return node.newest[1]
+
+    def matches(self, prefix):
+        # all commands with the prefix, the newest first
+        node = self._find(prefix)
+        if node is None:
+            return []
+        entries = []
+        nodes = [node]
+        while nodes:
+            node = nodes.pop()
+            if node.entry is not None:
+                entries.append(node.entry)
+            nodes.extend(node.children.values())
+        entries.sort(reverse=True)
+        return [command for sequence, command in entries]
+
+
+class CommandHistorian:
+    # The entered commands, at most capacity of them and each one once, entering a
+    # command again makes it the newest one. Commands are linked in [older, newer,
+    # command] nodes, so pushing and navigating do not depend on the size of the
+    # history. Pushed commands are appended to the file, if any.
+    def __init__(self, path=None, capacity=1000):
+        self._capacity = capacity
+        self._nodes = {}
+        self._oldest = None
+        self._newest = None
+        self._sequence = 0
+        self._trie = PrefixTrie()
+        self._matches = None
+        # the node shown while navigating and the line that was edited before
+        self._current = None
+        self._draft = ""
+        self._file = None
+        if path is not None:
+            self._load(path)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def _load(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        lines = 0
+        try:
+            with open(path, encoding='utf8', errors='replace') as f:
+                for line in f:
+                    lines += 1
+                    self._add(line.rstrip("\n"))
+        except FileNotFoundError:
+            pass
+        if lines > 2 * self._capacity:
+            # drop the duplicates and the commands that fell out of the history
+            with open(path + ".tmp", "w", encoding='utf8') as f:
+                node = self._oldest
+                while node is not None:
+                    f.write(node[2] + "\n")
+                    node = node[1]
+            os.replace(path + ".tmp", path)
+        self._file = open(path, "a", encoding='utf8')
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def push(self, command):
+        self._current = None
+        if not command:
+            return
+        self._add(command)
+        if self._file is not None:
+            self._file.write(command + "\n")
+            self._file.flush()
+
+    def _add(self, command):
+        if not command:
+            return
+        self._matches = None
+        node = self._nodes.pop(command, None)
+        if node is not None:
+            self._unlink(node)
+            self._trie.remove(command)
+        elif len(self._nodes) >= self._capacity:
+            node = self._oldest
+            del self._nodes[node[2]]
+            self._unlink(node)
+            self._trie.remove(node[2])
+        node = [self._newest, None, command]
+        if self._newest is None:
+            self._oldest = node
+        else:
+            self._newest[1] = node
+        self._newest = node
+        self._nodes[command] = node
+        self._sequence += 1
+        self._trie.add(command, self._sequence)
+
+    def _unlink(self, node):
+        older, newer, command = node
+        if older is None:
+            self._oldest = newer
+        else:
+            older[1] = newer
+        if newer is None:
+            self._newest = older
+        else:
+            newer[0] = older
+
+    def older(self, line):
+        # the line being edited comes back after navigating past the newest command
+        if self._current is None:
+            if self._newest is None:
+                return None
+            self._draft = line
+            self._current = self._newest
+        elif self._current[0] is not None:
+            self._current = self._current[0]
+        return self._current[2]
+
+    def newer(self):
+        if self._current is None:
+            return None
+        self._current = self._current[1]
+        if self._current is None:
+            return self._draft
+        return self._current[2]
+
+    def find(self, prefix, skip=0):
+        # the newest command with the prefix, or an older one when skipping
+        if skip == 0:
+            return self._trie.newest(prefix)
+        if self._matches is None or self._matches[0] != prefix:
+            self._matches = (prefix, self._trie.matches(prefix))
+        matches = self._matches[1]
+        if skip >= len(matches):
+            return None
+        return matches[skip]
+
+
+class ChatWindow:
+    # the messages of a channel, the oldest ones fall out once the scrollback is
+    # full. Messages added from any thread wait in the inbox, which is drawn every
+    # frame while the window is shown and left alone otherwise, so a busy channel
+    # in the background costs nothing but its bounded inbox.
+    def __init__(self, name, scrollback):
+        self.name = name
+        self.messages = collections.deque(maxlen=scrollback)
+        self.inbox = collections.deque(maxlen=scrollback)
+        self.history = None
 
 
 class ChatUI:
-    def __init__(self, stdscr):
+    KEY_CTRL_G = 7
+    KEY_CTRL_N = 14
+    KEY_CTRL_P = 16
+    KEY_CTRL_R = 18
+    KEY_ESCAPE = 27
+    # the window of the messages that do not belong to a channel
+    STATUS_WINDOW = ""
+
+    def __init__(self, stdscr, scrollback=1000, fps=30, inputhistory_path=None, inputhistory_size=1000, metrics=None):
         self._stdscr = stdscr
         self._inputbuffer = ""
-        self._chatbuffer = []
-        self._inputhistory = CommandHistorian()
+        self._scrollback = scrollback
+        # windows are opened and closed by the input loop only, other threads only
+        # add messages to them
+        self._windows = {self.STATUS_WINDOW: ChatWindow(self.STATUS_WINDOW, scrollback)}
+        self._window = self._windows[self.STATUS_WINDOW]
+        # the messages, the inbox and the history of the shown window
+        self._chatbuffer = self._window.messages
+        self._inbox = self._window.inbox
+        # the window list as it was drawn last
+        self._drawn_windows = None
+        self._frame_interval = 1.0 / fps
+        self._next_frame_on = 0
+        # adding a message writes to this pipe to wake up the input loop
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        # the number of visible messages by the length of their author
+        self._author_lengths = {}
+        self._author_maxlength = 0
+        # the history of the channel is shown instead of the chat buffer while
+        # scrolling back, the end is the number of the record after the last line
+        self._history = None
+        self._history_end = None
+        self._inputhistory = CommandHistorian(inputhistory_path, inputhistory_size)
+        # the prefix searched in the input history, None unless searching
+        self._search_prefix = None
+        self._search_skip = 0
+        self._search_match = None
+        # the seconds it takes to draw everything and to draw the new messages of a frame
+        self._render_seconds = None
+        self._frame_seconds = None
+        if metrics is not None:
+            self._render_seconds = metrics.histogram("chat_render_seconds", "Seconds to draw the chat.", labels={"kind": "full"})
+            self._frame_seconds = metrics.histogram("chat_render_seconds", "Seconds to draw the chat.", labels={"kind": "frame"})
+            metrics.gauge("chat_inbox", "Messages waiting for the next frame in all windows.", lambda: sum(len(window.inbox) for window in list(self._windows.values())))
 
         self._chatbuffer_window = stdscr.derwin(curses.LINES - 2, curses.COLS, 0, 0)
+        self._chatbuffer_window.scrollok(True)
         self._inputbuffer_window = stdscr.derwin(1, curses.COLS, curses.LINES - 1, 0)
     
     def __enter__(self):
@@ -48,6 +305,7 @@ class ChatUI:
         self._stdscr.clear()
         curses.curs_set(0)
         self._stdscr.keypad(1)
+        self._stdscr.nodelay(True)
         curses.mousemask(1)
         curses.noecho()
         curses.cbreak()
@@ -55,22 +313,58 @@ class ChatUI:
         curses.use_default_colors()
         for i in range(0, 15):
             curses.init_pair(i + 1, i, -1)
+        self._render()
         return self
     
     def __exit__(self, type, value, tb):
         # clean up
         curses.nocbreak()
         curses.echo()
+        self._inputhistory.close()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
         return False
 
     def readinput(self, prefix):
         self._inputbuffer = prefix
         self._render_inputbuffer()
         self._inputbuffer_window.cursyncup()
-        self._inputhistory.push("")
+        while True:
+            result = self._read_keys(prefix)
+            if result is not None:
+                self._inputhistory.push(result)
+                return result
+            if self._has_changes() and time.monotonic() >= self._next_frame_on:
+                self._flush_inbox()
+            self._wait()
+
+    def _has_changes(self):
+        # new messages in the shown window or in the window list
+        return bool(self._inbox) or self._get_window_list() != self._drawn_windows
+
+    def _wait(self):
+        # wait for a key stroke, a new message or the next frame, resizes are picked
+        # up by getch, so do not wait forever
+        timeout = 0.5
+        if self._has_changes():
+            timeout = max(self._next_frame_on - time.monotonic(), 0)
+        readable, _, _ = select.select([sys.stdin, self._wakeup_r], [], [], timeout)
+        if self._wakeup_r in readable:
+            try:
+                os.read(self._wakeup_r, 4096)
+            except BlockingIOError:
+                pass
+
+    def _read_keys(self, prefix):
         while True:
             i = self._stdscr.getch()
-            if i == curses.KEY_MOUSE:
+            if i == -1:
+                return None
+            if self._search_prefix is not None:
+                result = self._read_search_key(i, prefix)
+                if result is not None:
+                    return result
+            elif i == curses.KEY_MOUSE:
                 # pop mouse event
                 try:
                     m = curses.getmouse()
@@ -88,84 +382,695 @@ class ChatUI:
                     continue
                 # remove last char from inputbuffer
                 self._inputbuffer = self._inputbuffer[:-1]
-                self._inputhistory.put(self._inputbuffer[len(prefix):])
                 self._render_inputbuffer()
             elif i == curses.KEY_RESIZE:
                 self._resize()
+            elif i == curses.KEY_PPAGE:
+                self._scroll_history(-1)
+            elif i == curses.KEY_NPAGE:
+                self._scroll_history(1)
             elif i == curses.KEY_DOWN:
                 # navigate in the input history
-                self._inputhistory.navDown()
-                command = self._inputhistory.get()
-                self._inputbuffer = "{0}{1}".format(prefix, command)
-                self._render_inputbuffer()
+                command = self._inputhistory.newer()
+                if command is not None:
+                    self._inputbuffer = "{0}{1}".format(prefix, command)
+                    self._render_inputbuffer()
             elif i == curses.KEY_UP:
                 # navigate in the input history
-                self._inputhistory.navUp()
-                command = self._inputhistory.get()
-                self._inputbuffer = "{0}{1}".format(prefix, command)
+                command = self._inputhistory.older(self._inputbuffer[len(prefix):])
+                if command is not None:
+                    self._inputbuffer = "{0}{1}".format(prefix, command)
+                    self._render_inputbuffer()
+            elif i == self.KEY_CTRL_N:
+                self._cycle_window(1)
+            elif i == self.KEY_CTRL_P:
+                self._cycle_window(-1)
+            elif i == self.KEY_CTRL_R:
+                # search the input history
+                self._search_prefix = ""
+                self._search_skip = 0
+                self._search_match = None
                 self._render_inputbuffer()
             else:
                 c = chr(i)
                 if c in string.printable[:-5]:
                     # printable char
                     self._inputbuffer += c
-                    self._inputhistory.put(self._inputbuffer[len(prefix):])
                     self._render_inputbuffer()
                 else:
                     # unhandled key stroke
                     pass
-    
-    def chatbuffer_addmessage(self, author, message):
-        self._chatbuffer.append((author, message))
+
+    def _read_search_key(self, i, prefix):
+        # returns the command to run once the search is accepted
+        if i == ord('\n'):
+            match = self._search_match
+            self._search_prefix = None
+            if match is None:
+                self._render_inputbuffer()
+                return None
+            self._inputbuffer = ""
+            self._render_inputbuffer()
+            self._inputbuffer_window.cursyncup()
+            return match
+        if i == self.KEY_CTRL_R:
+            # the next older match, the last one stays if there is none
+            match = self._inputhistory.find(self._search_prefix, self._search_skip + 1)
+            if match is not None:
+                self._search_skip += 1
+                self._search_match = match
+        elif i in [curses.KEY_BACKSPACE]:
+            self._search_prefix = self._search_prefix[:-1]
+            self._search_skip = 0
+            self._search_match = self._inputhistory.find(self._search_prefix)
+        elif i in [self.KEY_CTRL_G, self.KEY_ESCAPE]:
+            # cancel
+            self._search_prefix = None
+        elif i == curses.KEY_RESIZE:
+            self._resize()
+        elif 0 <= i < 256 and chr(i) in string.printable[:-5]:
+            self._search_prefix += chr(i)
+            self._search_skip = 0
+            self._search_match = self._inputhistory.find(self._search_prefix)
+        else:
+            # any other key stroke continues with editing the match
+            if self._search_match is not None:
+                self._inputbuffer = "{0}{1}".format(prefix, self._search_match)
+            self._search_prefix = None
+        self._render_inputbuffer()
+        return None
+
+    def set_history(self, history, name=STATUS_WINDOW):
+        # may be called from any thread, scrolling picks up the new history
+        window = self._windows.get(name)
+        if window is None:
+            return
+        window.history = history
+        if window is self._window:
+            self._history = history
+
+    def open_window(self, name):
+        if name not in self._windows:
+            self._windows[name] = ChatWindow(name, self._scrollback)
+
+    def close_window(self, name):
+        if name == self.STATUS_WINDOW:
+            return
+        window = self._windows.pop(name, None)
+        if window is self._window:
+            self.switch_window(self.STATUS_WINDOW)
+
+    def get_window(self):
+        return self._window.name
+
+    def get_windows(self):
+        return list(self._windows)
+
+    def switch_window(self, name):
+        window = self._windows.get(name)
+        if window is None or window is self._window:
+            return
+        self._window = window
+        self._chatbuffer = window.messages
+        self._inbox = window.inbox
+        self._history = window.history
+        self._history_end = None
+        # the messages that arrived in the background are drawn all at once
+        while self._inbox:
+            self._chatbuffer.append(self._inbox.popleft())
+        self._count_visible_authors()
+        self._render()
+
+    def _cycle_window(self, direction):
+        names = list(self._windows)
+        self.switch_window(names[(names.index(self._window.name) + direction) % len(names)])
+
+    def _get_window_list(self):
+        # the shown window is marked, the others show how many messages they got
+        # since they were shown last
+        names = []
+        for name, window in list(self._windows.items()):
+            if not name:
+                name = "status"
+            if window is self._window:
+                names.append("[{0}]".format(name))
+            elif len(window.inbox) >= self._scrollback:
+                names.append("{0}({1}+)".format(name, len(window.inbox)))
+            elif window.inbox:
+                names.append("{0}({1})".format(name, len(window.inbox)))
+            else:
+                names.append(name)
+        return " {0} ".format(" ".join(names))
+
+    def _render_window_list(self):
+        h, w = self._stdscr.getmaxyx()
+        self._drawn_windows = self._get_window_list()
+        self._stdscr.hline(h - 2, 0, "-", w)
+        self._stdscr.addnstr(h - 2, 1, self._drawn_windows, max(w - 2, 0))
+        self._stdscr.refresh()
+
+    def _scroll_history(self, direction):
+        history = self._history
+        h, w = self._chatbuffer_window.getmaxyx()
+        visible = max(h - 1, 1)
+        if history is None or self._history_end is None and direction > 0:
+            end = None
+        elif self._history_end is None:
+            end = max(len(history) - visible, min(visible, len(history)))
+        else:
+            end = min(max(self._history_end + direction * visible, visible), len(history))
+            if end == len(history) and direction > 0:
+                end = None
+        if end == self._history_end:
+            return
+        self._history_end = end
+        if end is None:
+            self._count_visible_authors()
         self._render()
+
+    def chatbuffer_addmessage(self, author, message, name=None):
+        # may be called from any thread, the message is drawn by the input loop,
+        # messages without a window go to the shown one
+        if name is None:
+            window = self._window
+        else:
+            window = self._windows.get(name)
+            if window is None:
+                # the window was closed in the meantime
+                return
+        window.inbox.append((author, message))
+        try:
+            os.write(self._wakeup_w, b"\0")
+        except BlockingIOError:
+            # the input loop is woken up already
+            pass
+
+    def _flush_inbox(self):
+        if self._frame_seconds is None:
+            self._draw_inbox()
+            return
+        started_on = time.perf_counter()
+        self._draw_inbox()
+        self._frame_seconds.observe(time.perf_counter() - started_on)
+
+    def _draw_inbox(self):
+        self._next_frame_on = time.monotonic() + self._frame_interval
+        if self._get_window_list() != self._drawn_windows:
+            self._render_window_list()
+            self._inputbuffer_window.cursyncup()
+        if not self._inbox:
+            return
+        h, w = self._chatbuffer_window.getmaxyx()
+        visible = h - 1
+        rows = min(len(self._chatbuffer), max(visible, 0))
+        added = 0
+        while self._inbox:
+            author, message = self._inbox.popleft()
+            if visible > 0 and len(self._chatbuffer) >= visible:
+                self._count_author(self._chatbuffer[-visible][0], -1)
+            self._chatbuffer.append((author, message))
+            self._count_author(author, 1)
+            added += 1
+        if visible <= 0 or self._history_end is not None:
+            # new messages show up once the user scrolled back down
+            return
+        author_maxlength = max(self._author_lengths)
+        if author_maxlength != self._author_maxlength or added >= visible:
+            # the alignment of all visible messages changes or all of them are new
+            self._author_maxlength = author_maxlength
+            self._render_chatbuffer()
+        else:
+            # only scroll up and draw the new messages
+            new_rows = min(len(self._chatbuffer), visible)
+            scrolled = rows + added - new_rows
+            if scrolled > 0:
+                self._chatbuffer_window.scroll(scrolled)
+            for row in range(new_rows - added, new_rows):
+                author, message = self._chatbuffer[len(self._chatbuffer) - new_rows + row]
+                self._render_chatline(row, author, message, w, self._author_maxlength)
+            self._chatbuffer_window.refresh()
         self._inputbuffer_window.cursyncup()
+
+    def _count_author(self, author, delta):
+        length = len(author)
+        count = self._author_lengths.get(length, 0) + delta
+        if count > 0:
+            self._author_lengths[length] = count
+        else:
+            self._author_lengths.pop(length, None)
+
+    def _count_visible_authors(self):
+        h, w = self._chatbuffer_window.getmaxyx()
+        self._author_lengths = {}
+        for i in range(max(len(self._chatbuffer) - (h - 1), 0), len(self._chatbuffer)):
+            self._count_author(self._chatbuffer[i][0], 1)
+        if self._author_lengths:
+            self._author_maxlength = max(self._author_lengths)
+        else:
+            self._author_maxlength = 0
     
     def _resize(self):
         h, w = self._stdscr.getmaxyx()
         self._inputbuffer_window.resize(1, w)
         self._chatbuffer_window.resize(h - 2, w)
         self._inputbuffer_window.mvwin(h - 1, 0)
+        self._count_visible_authors()
         self._render()
 
     def _render(self):
+        if self._render_seconds is None:
+            self._draw()
+            return
+        started_on = time.perf_counter()
+        self._draw()
+        self._render_seconds.observe(time.perf_counter() - started_on)
+
+    def _draw(self):
         h, w = self._stdscr.getmaxyx()
         self._stdscr.clear()
-        self._stdscr.hline(h - 2, 0, "-", w)
-        self._stdscr.refresh()
+        self._render_window_list()
         self._render_chatbuffer()
         self._render_inputbuffer()
 
     def _render_chatbuffer(self):
-        self._chatbuffer_window.clear()
+        if self._history_end is not None:
+            self._render_history()
+            return
+        self._chatbuffer_window.erase()
         h, w = self._chatbuffer_window.getmaxyx()
-        messages = list(self._chatbuffer)
-        messages.reverse()
-        messages = messages[:h-1]
-        messages.reverse()
-        if messages:
-            author_maxlength = max([len(author) for author, _ in messages])
-            i = 0
-            for author, message in messages:
-                if i >= h:
-                    break
-                if author:
-                    line = "{0}: {1}".format(author.rjust(author_maxlength), message)
-                    self._chatbuffer_window.addstr(i, 0, line)
-                else:
-                    line = "{0}".format(message)
-                    self._chatbuffer_window.addstr(i, 0, line, curses.color_pair(7))
-                i += 1
+        # only the visible messages are drawn
+        first = max(len(self._chatbuffer) - (h - 1), 0)
+        for row, i in enumerate(range(first, len(self._chatbuffer))):
+            author, message = self._chatbuffer[i]
+            self._render_chatline(row, author, message, w, self._author_maxlength)
         self._chatbuffer_window.refresh()
 
+    def _render_history(self):
+        self._chatbuffer_window.erase()
+        h, w = self._chatbuffer_window.getmaxyx()
+        history = self._history
+        if history is None:
+            records = []
+        else:
+            # only the visible records are read from the log
+            records = history.read(max(self._history_end - (h - 1), 0), self._history_end)
+        author_maxlength = max([len(author) for timestamp, author, message in records] + [0])
+        for row, (timestamp, author, message) in enumerate(records):
+            self._render_chatline(row, author, message, w, author_maxlength)
+        if records:
+            status = " history of {0}, page down to return ".format(time.strftime("%Y-%m-%d %H:%M", time.localtime(records[0][0])))
+            self._chatbuffer_window.addnstr(h - 1, 0, status.center(w - 1, "-"), w - 1, curses.A_REVERSE)
+        self._chatbuffer_window.refresh()
+
+    def _render_chatline(self, row, author, message, width, author_maxlength):
+        # lines are cut at the window width so that every message takes up one row
+        if author:
+            line = "{0}: {1}".format(author.rjust(author_maxlength), message)
+            self._chatbuffer_window.addnstr(row, 0, line, width - 1)
+        else:
+            line = "{0}".format(message)
+            self._chatbuffer_window.addnstr(row, 0, line, width - 1, curses.color_pair(7))
+
     def _render_inputbuffer(self):
         self._inputbuffer_window.clear()
         h, w = self._inputbuffer_window.getmaxyx()
-        self._inputbuffer_window.addstr(0, 0, self._inputbuffer)
+        if self._search_prefix is not None:
+            match = self._search_match
+            if match is None:
+                match = ""
+            line = "(reverse-i-search)'{0}': {1}".format(self._search_prefix, match)
+            self._inputbuffer_window.addnstr(0, 0, line, w - 1)
+        else:
+            self._inputbuffer_window.addstr(0, 0, self._inputbuffer)
         self._inputbuffer_window.refresh()
 
+class CompactEncoder:
+    # Compact binary frames. Every frame starts with a version byte that a json
+    # tuple never starts with, followed by the frame type and the id of the
+    # sender, which scopes the author ids. Authors are announced once in an
+    # author frame and referenced by their id afterwards. A batch frame carries
+    # several frames without their headers, optionally compressed.
+    VERSION = 0xc1
+    HEADER = struct.Struct("!BBI")
+    FRAME_AUTHOR = 1
+    FRAME_MESSAGE = 2
+    FRAME_BATCH = 3
+    FIELDS = struct.Struct("!HH")
+    COMPRESSIONS = ["none", "zlib", "zstd"]
+    # smaller batches do not get smaller by compressing them
+    COMPRESSION_THRESHOLD = 256
+
+    def __init__(self, sender_id, compression="zlib"):
+        if compression == "zstd" and zstandard is None:
+            compression = "zlib"
+        self._sender_id = sender_id
+        self._compression = compression
+        self._author_ids = {}
+
+    def get_authors(self):
+        return dict(self._author_ids)
+
+    def has_author(self, author):
+        return author in self._author_ids
+
+    def reset(self):
+        # authors are announced again, e.g. in a new channel
+        self._author_ids = {}
+
+    def encode(self, author, message):
+        return self.encode_batch([(author, message)])
+
+    def encode_batch(self, messages):
+        items = []
+        for author, message in messages:
+            author_id = self._author_ids.get(author)
+            if author_id is None:
+                author_id = len(self._author_ids)
+                self._author_ids[author] = author_id
+                items.append(self._encode_item(self.FRAME_AUTHOR, author_id, author))
+            items.append(self._encode_item(self.FRAME_MESSAGE, author_id, message))
+        if len(items) == 1:
+            return self.HEADER.pack(self.VERSION, items[0][0], self._sender_id) + items[0][1:]
+        body = b"".join(items)
+        compression = "none"
+        if self._compression != "none" and len(body) >= self.COMPRESSION_THRESHOLD:
+            compression = self._compression
+            if compression == "zstd":
+                body = zstandard.ZstdCompressor().compress(body)
+            else:
+                body = zlib.compress(body)
+        return self.HEADER.pack(self.VERSION, self.FRAME_BATCH, self._sender_id) + bytes([self.COMPRESSIONS.index(compression)]) + body
+
+    def _encode_item(self, frame_type, author_id, text):
+        # chat messages fit into a single line, longer ones are cut
+        text = text.encode('utf8')[:0xffff]
+        return bytes([frame_type]) + self.FIELDS.pack(author_id, len(text)) + text
+
+
+class CompactDecoder:
+    def __init__(self):
+        # the authors of each sender by their id
+        self._authors = {}
+
+    def is_compact(self, payload):
+        return len(payload) > 0 and payload[0] == CompactEncoder.VERSION
+
+    def add_authors(self, sender_id, authors):
+        senders_authors = self._authors.setdefault(sender_id, {})
+        for author, author_id in authors.items():
+            senders_authors[author_id] = author
+
+    def decode(self, payload):
+        version, frame_type, sender_id = CompactEncoder.HEADER.unpack_from(payload, 0)
+        if version != CompactEncoder.VERSION:
+            raise ValueError("unsupported frame version {0}".format(version))
+        senders_authors = self._authors.setdefault(sender_id, {})
+        offset = CompactEncoder.HEADER.size
+        if frame_type == CompactEncoder.FRAME_BATCH:
+            compression = CompactEncoder.COMPRESSIONS[payload[offset]]
+            body = payload[offset + 1:]
+            if compression == "zlib":
+                body = zlib.decompress(body)
+            elif compression == "zstd":
+                if zstandard is None:
+                    raise ValueError("zstd compressed frames require the zstandard module")
+                body = zstandard.ZstdDecompressor().decompress(body)
+            return self._decode_items(senders_authors, body, 0, None)
+        return self._decode_items(senders_authors, payload, offset, frame_type)
+
+    def _decode_items(self, senders_authors, body, offset, frame_type):
+        messages = []
+        fields = CompactEncoder.FIELDS
+        while offset < len(body):
+            if frame_type is None:
+                item_type = body[offset]
+                offset += 1
+            else:
+                item_type = frame_type
+            author_id, length = fields.unpack_from(body, offset)
+            offset += fields.size
+            text = body[offset:offset + length].decode('utf8')
+            offset += length
+            if item_type == CompactEncoder.FRAME_AUTHOR:
+                senders_authors[author_id] = text
+            elif item_type == CompactEncoder.FRAME_MESSAGE:
+                # authors announced before we joined are known from the channel metadata
+                author = senders_authors.get(author_id)
+                if author is None:
+                    author = "unknown-{0}".format(author_id)
+                messages.append((author, text))
+            if frame_type is not None:
+                break
+        return messages
+
+
+class ChatHistory:
+    # The messages of a channel in an append-only log and an index with the offset
+    # of every record. Both are memory mapped for reading, so scrolling back does
+    # not keep old messages in memory. Searches use an inverted index of the words
+    # of every record, which is saved on close and only extended by the records
+    # logged since.
+    RECORD = struct.Struct("!dHH")
+    OFFSET = struct.Struct("!Q")
+    WORDS_MAGIC = b"CHATWRD1"
+    WORDS_HEADER = struct.Struct("!8sI")
+    WORD = struct.Struct("!HI")
+    _word_pattern = re.compile(r"\w+")
+
+    def __init__(self, directory, channel):
+        os.makedirs(directory, exist_ok=True)
+        name = urllib.parse.quote(channel, safe="")
+        self._words_path = os.path.join(directory, "{0}.words".format(name))
+        self._lock = threading.Lock()
+        self._log = open(os.path.join(directory, "{0}.log".format(name)), "a+b")
+        self._index = open(os.path.join(directory, "{0}.index".format(name)), "a+b")
+        self._log_map = None
+        self._index_map = None
+        self._count = os.fstat(self._index.fileno()).st_size // self.OFFSET.size
+        self._size = 0
+        self._recover()
+        # the numbers of the records by the words in them
+        self._words = {}
+        self._indexed = 0
+        self._load_words()
+        for number, (timestamp, author, message) in enumerate(self._read(self._indexed, self._count), self._indexed):
+            self._add_words(number, author, message)
+        self._indexed = self._count
+
+    def __len__(self):
+        return self._count
+
+    def _recover(self):
+        # records logged after the last index entry, e.g. when the client crashed
+        # in between, are indexed again and a partially written record is cut off
+        self._index.truncate(self._count * self.OFFSET.size)
+        log_fd = self._log.fileno()
+        if self._count > 0:
+            offset, = self.OFFSET.unpack(os.pread(self._index.fileno(), self.OFFSET.size, (self._count - 1) * self.OFFSET.size))
+            self._size = offset + self._get_record_length(os.pread(log_fd, self.RECORD.size, offset))
+        size = os.fstat(log_fd).st_size
+        while self._size + self.RECORD.size <= size:
+            length = self._get_record_length(os.pread(log_fd, self.RECORD.size, self._size))
+            if self._size + length > size:
+                break
+            self._index.write(self.OFFSET.pack(self._size))
+            self._count += 1
+            self._size += length
+        self._log.truncate(self._size)
+        self._index.flush()
+
+    def _get_record_length(self, header):
+        timestamp, author_length, message_length = self.RECORD.unpack(header)
+        return self.RECORD.size + author_length + message_length
+
+    def append(self, timestamp, messages):
+        with self._lock:
+            if self._log is None:
+                return
+            offsets = []
+            records = []
+            for author, message in messages:
+                author_bytes = author.encode('utf8')[:0xffff]
+                message_bytes = message.encode('utf8')[:0xffff]
+                offsets.append(self.OFFSET.pack(self._size))
+                records.append(self.RECORD.pack(timestamp, len(author_bytes), len(message_bytes)) + author_bytes + message_bytes)
+                self._size += len(records[-1])
+            # the log is written before the index, so every index entry is complete
+            self._log.write(b"".join(records))
+            self._log.flush()
+            self._index.write(b"".join(offsets))
+            self._index.flush()
+            for author, message in messages:
+                self._add_words(self._count, author, message)
+                self._count += 1
+            self._indexed = self._count
+
+    def read(self, first, end):
+        with self._lock:
+            if self._log is None:
+                return []
+            return self._read(first, min(end, self._count))
+
+    def _read(self, first, end):
+        if first >= end:
+            return []
+        if self._index_map is None or len(self._index_map) < end * self.OFFSET.size:
+            self._map()
+        records = []
+        for number in range(first, end):
+            offset, = self.OFFSET.unpack_from(self._index_map, number * self.OFFSET.size)
+            records.append(self._read_record(offset))
+        return records
+
+    def _map(self):
+        # the log only grows, so mapping it again covers the new records
+        self._unmap()
+        self._log_map = mmap.mmap(self._log.fileno(), 0, access=mmap.ACCESS_READ)
+        self._index_map = mmap.mmap(self._index.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _unmap(self):
+        if self._log_map is not None:
+            self._log_map.close()
+            self._index_map.close()
+            self._log_map = None
+            self._index_map = None
+
+    def _read_record(self, offset):
+        timestamp, author_length, message_length = self.RECORD.unpack_from(self._log_map, offset)
+        offset += self.RECORD.size
+        author = self._log_map[offset:offset + author_length].decode('utf8', 'replace')
+        offset += author_length
+        message = self._log_map[offset:offset + message_length].decode('utf8', 'replace')
+        return (timestamp, author, message)
+
+    def search(self, query, limit):
+        # returns the number of records that contain all words of the query and
+        # the last ones of them
+        words = set(self._word_pattern.findall(query.lower()))
+        with self._lock:
+            if self._log is None or not words:
+                return (0, [])
+            postings = [self._words.get(word) for word in words]
+            if None in postings:
+                return (0, [])
+            postings.sort(key=len)
+            if len(postings) == 1:
+                numbers = postings[0]
+            else:
+                matches = set(postings[0])
+                for numbers in postings[1:]:
+                    matches.intersection_update(numbers)
+                numbers = sorted(matches)
+            return (len(numbers), [self._read(number, number + 1)[0] for number in numbers[-limit:]])
+
+    def _add_words(self, number, author, message):
+        for word in set(self._word_pattern.findall(author.lower())).union(self._word_pattern.findall(message.lower())):
+            numbers = self._words.get(word)
+            if numbers is None:
+                numbers = array.array("I")
+                self._words[word] = numbers
+            numbers.append(number)
+
+    def _load_words(self):
+        try:
+            with open(self._words_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        try:
+            magic, indexed = self.WORDS_HEADER.unpack_from(data, 0)
+            if magic != self.WORDS_MAGIC or indexed > self._count:
+                raise ValueError("the word index does not match the log")
+            words = {}
+            offset = self.WORDS_HEADER.size
+            while offset < len(data):
+                word_length, count = self.WORD.unpack_from(data, offset)
+                offset += self.WORD.size
+                word = data[offset:offset + word_length].decode('utf8')
+                offset += word_length
+                numbers = array.array("I")
+                numbers.frombytes(data[offset:offset + count * numbers.itemsize])
+                if len(numbers) != count:
+                    raise ValueError("the word index is incomplete")
+                offset += count * numbers.itemsize
+                words[word] = numbers
+        except (struct.error, ValueError):
+            # the words are indexed again from the log
+            return
+        self._words = words
+        self._indexed = indexed
+
+    def _save_words(self):
+        items = [self.WORDS_HEADER.pack(self.WORDS_MAGIC, self._indexed)]
+        for word, numbers in self._words.items():
+            word = word.encode('utf8')
+            items.append(self.WORD.pack(len(word), len(numbers)))
+            items.append(word)
+            items.append(numbers.tobytes())
+        with open(self._words_path + ".tmp", "wb") as f:
+            f.write(b"".join(items))
+        os.replace(self._words_path + ".tmp", self._words_path)
+
+    def close(self):
+        with self._lock:
+            if self._log is None:
+                return
+            self._save_words()
+            self._unmap()
+            self._log.close()
+            self._index.close()
+            self._log = None
+            self._index = None
+
+
+def is_valid_channel_name(name):
+    # a channel is a single level of its topics, wildcards would subscribe to
+    # other channels and paho refuses to publish to them
+    return name != "" and not any(c in name for c in "+#/")
+
+
+class ChatChannel:
+    # a joined channel with the topics it is recognized by and the state of the
+    # compact format in it, the topics are built once and not per message
+    def __init__(self, name, sender_id, compression):
+        self.name = name
+        self.topic = "chat/channel/{0}/message".format(name)
+        self.meta_prefix = "chat/channel/{0}/meta".format(name)
+        self.meta_filter = "{0}/+".format(self.meta_prefix)
+        self.encoder = CompactEncoder(sender_id, compression)
+        self.decoder = CompactDecoder()
+        # messages are sent as json until every client that announced itself in
+        # the metadata understands the compact format
+        self.compact = False
+        # the metadata of the other clients by client id
+        self.peers = {}
+        # set once a json message shows up while every client we know of sends
+        # compact frames, it comes from a client that does not announce itself
+        self.legacy = False
+        # our own json messages come back as well, they are not taken for the ones
+        # of such a client
+        self.json_pending = 0
+        self.history = None
+
+    def get_meta_topic(self, client_id):
+        return "{0}/{1}".format(self.meta_prefix, client_id)
+
+
 class ChatClient:
-    def __init__(self, ui, mqtt_host=None, nickname=None, client_id=None, clean_session=None):
+    COMPACT_FORMAT = "compact1"
+    # the filters that cover all channels once so many are joined that one
+    # subscription per channel costs more than receiving the others
+    WILDCARD_TOPICS = ["chat/channel/+/message", "chat/channel/+/meta/+"]
+    # the number of matches printed by /search
+    SEARCH_LIMIT = 20
+    # received messages wait here for the chat, once it is full the broker has to
+    # hold on to the rest
+    QUEUE_SIZE = 1000
+
+    def __init__(self, ui, mqtt_host=None, nickname=None, client_id=None, clean_session=None, wire_format=None, compression=None, history_dir=None, metrics=None, metrics_interval=60.0, metrics_file=None, channels=None, wildcard_channels=16):
         self._ui = ui
+        # the client lives in the event loop thread, the input loop hands work over to it
+        self._loop_thread = None
         self._mqtt_client = None
         self._mqtt_host = mqtt_host
         self._mqtt_port = None
@@ -179,8 +1084,42 @@ class ChatClient:
         if clean_session is None:
             clean_session = False
         self._clean_session = clean_session
-        self._channel = "hta"
         self._qos = 2
+        if wire_format is None:
+            wire_format = "json"
+        self._wire_format = wire_format
+        if compression is None:
+            compression = "zlib"
+        self._compression = compression
+        # the sender id scopes the ids of our authors in compact frames
+        self._sender_id = random.getrandbits(32)
+        # the history of the channels is not kept if there is no directory for it
+        self._history_dir = history_dir
+        # the joined channels by name, and by the topics of their messages and of
+        # their metadata, so that a message finds its channel with a single lookup.
+        # The input loop joins and leaves them, the event loop thread changes their
+        # state on connect and on messages. Both hold the lock while they do and
+        # never wait for each other while holding it.
+        self._lock = threading.RLock()
+        self._channels = {}
+        self._message_topics = {}
+        self._meta_prefixes = {}
+        # from this many channels on the wildcard topics are subscribed instead
+        self._wildcard_channels = wildcard_channels
+        self._wildcard = False
+        if channels is None:
+            channels = ["hta"]
+        # the channels are joined once connected
+        for channel in channels:
+            self._add_channel(channel)
+        if self._channels:
+            self._ui.switch_window(channels[0])
+        # while connected the metrics are published retained to <client id>/metrics
+        # and written to the metrics file every metrics interval
+        self._metrics = metrics
+        self._metrics_interval = metrics_interval
+        self._metrics_file = metrics_file
+        self._reporter = None
     
     def run(self):
         self._print_appmessage("Hello!")
@@ -194,6 +1133,8 @@ class ChatClient:
                 self._print_appmessage(input)
                 if input in ["/q", "/quit"]:
                     break
+                elif input.startswith("/search"):
+                    self._search(input[len("/search "):].strip())
                 elif input.startswith("/connect"):
                     m = re.match("^\/connect[ ]?([^ $]*)[ ]?(.*)[ ]?([\d]*)$", input)
                     if not m:
@@ -216,10 +1157,14 @@ class ChatClient:
                 elif input in ["/disconnect"]:
                     self._disconnect()
                 elif input.startswith("/join"):
-                    channel = input[len("/join "):].strip()
-                    self._join_channel(channel)
-                elif input in ["/leave"]:
-                    self._leave_channel()
+                    self._join_channels(input[len("/join "):].split())
+                elif input.startswith("/leave"):
+                    channels = input[len("/leave "):].split()
+                    if not channels:
+                        channels = [self._ui.get_window()]
+                    self._leave_channels(channels)
+                elif input.startswith("/switch"):
+                    self._switch_channel(input[len("/switch "):].strip())
                 elif input.startswith("/nickname"):
                     nickname = input[len("/nickname "):]
                     self._change_nickname(nickname)
@@ -230,12 +1175,20 @@ class ChatClient:
                     self._print_appmessage("    connect to an mqtt broker, the port and transport is optional")
                     self._print_appmessage("/disconnect")
                     self._print_appmessage("    disconnect from the mqtt broker")
-                    self._print_appmessage("/join CHANNEL")
-                    self._print_appmessage("    join a channel")
-                    self._print_appmessage("/leave")
-                    self._print_appmessage("    leave channel")
+                    self._print_appmessage("/join CHANNEL [CHANNEL ..]")
+                    self._print_appmessage("    join one or more channels, each in a window of its own")
+                    self._print_appmessage("/leave [CHANNEL ..]")
+                    self._print_appmessage("    leave the channels, defaults to the channel of this window")
+                    self._print_appmessage("/switch CHANNEL")
+                    self._print_appmessage("    switch to the window of a joined channel")
+                    self._print_appmessage("ctrl+n, ctrl+p")
+                    self._print_appmessage("    switch to the next or previous window")
                     self._print_appmessage("/nickname NAME")
                     self._print_appmessage("    change your nickname")
+                    self._print_appmessage("/search WORDS")
+                    self._print_appmessage("    print the last messages of the channel of this window that contain all words")
+                    self._print_appmessage("page up, page down")
+                    self._print_appmessage("    scroll through the history of the channel")
                     self._print_appmessage("/q /quit")
                     self._print_appmessage("    leave the chat and close the application")
                 else:
@@ -243,6 +1196,9 @@ class ChatClient:
             else:
                 # publish message
                 self._send_message(input)
+        with self._lock:
+            for channel in list(self._channels.values()):
+                self._close_history(channel)
 
     def _connect(self, host=None, port=None, transport=None):
         if self._mqtt_client is not None:
@@ -260,71 +1216,255 @@ class ChatClient:
             elif transport == "websockets":
                 port = 8000
         self._print_appmessage("Connecting to {0}:{1} using {2} ..".format(host, port, transport))
-        mqtt_client = mqtt.Client(client_id=self._client_id, clean_session=self._clean_session, transport=transport)
+        if self._loop_thread is None:
+            self._loop_thread = async_mqtt.EventLoopThread()
+        mqtt_client = async_mqtt.AsyncClient(host, port, client_id=self._client_id, clean_session=self._clean_session, transport=transport, queue_size=self.QUEUE_SIZE, overflow=async_mqtt.BLOCK)
         mqtt_client.on_connect = self._on_connect
-        mqtt_client.on_message = self._on_message
         mqtt_client.on_disconnect = self._on_disconnect
+        if self._metrics is not None:
+            mqtt_client.register_metrics(self._metrics)
+        self._mqtt_host = host
+        self._mqtt_port = port
+        self._mqtt_transport = transport
+        # joins the channel right away if there is one
+        self._mqtt_client = mqtt_client
         try:
-            mqtt_client.connect(host, port)
+            self._loop_thread.run(mqtt_client.connect()).result()
         except Exception as ex:
+            self._mqtt_client = None
             self._print_appmessage("Could not connect: {0}".format(str(ex)))
             return
-        # this only runs if we can connect to the broker
-        self._mqtt_client = mqtt_client
-        self._mqtt_client.loop_start()
-        self._mqtt_host = host
-        self._mqtt_port = port
-        self._mqtt_transport = transport
+        self._loop_thread.run(self._receive(mqtt_client))
+        if self._metrics is not None and self._metrics_interval > 0:
+            self._reporter = self._loop_thread.run(metrics.report(self._metrics, mqtt_client, "{0}/metrics".format(self._client_id), self._metrics_interval, self._metrics_file))
     
     def _disconnect(self):
         if self._mqtt_client is None:
             self._print_appmessage("Cannot disconnect: not connected yet")
             return
         
-        self._mqtt_client.disconnect()
-        self._mqtt_client.loop_stop()
+        if self._reporter is not None:
+            self._reporter.cancel()
+            self._reporter = None
+        self._loop_thread.run(self._mqtt_client.close()).result()
         self._mqtt_client = None
 
-    def _join_channel(self, channel):
-        if not channel:
-            self._print_appmessage("Channel name cannot be empty")
+    async def _receive(self, mqtt_client):
+        async for msg in mqtt_client:
+            self._on_message(msg)
+
+    def _publish(self, topic, payload=None, qos=0, retain=False):
+        # waits for room in the window in the event loop thread, not in the input loop
+        self._loop_thread.run(self._mqtt_client.publish(topic, payload, qos, retain))
+
+    def _join_channels(self, names):
+        if not names:
+            self._print_appmessage("Usage: /join CHANNEL [CHANNEL ..]")
             return
-        if channel.strip() != channel:
-            self._print_appmessage("Channel name must not contain leading or trailing whitespaces")
+        with self._lock:
+            self._join_channels_locked(names)
+
+    def _join_channels_locked(self, names):
+        channels = []
+        for name in names:
+            if not is_valid_channel_name(name):
+                self._print_appmessage("Cannot join {0}: channel names must not contain +, # or /".format(name))
+                continue
+            if name in self._channels:
+                self._print_appmessage("Already joined {0}".format(name))
+                continue
+            channels.append(self._add_channel(name))
+        if not channels:
             return
-        if self._channel and self._channel != channel:
-            # leave first
-            self._leave_channel()
-        self._channel = channel
-        self._mqtt_client.subscribe(self._get_channel_topic(), qos=self._qos)
-        self._send_channel_message("{0} joined the channel".format(self._nickname))
-    
-    def _leave_channel(self):
-        if not self._channel:
-            self._print_appmessage("Cannot leave channel: join a channel first")
+        if self._mqtt_client is not None:
+            self._subscribe_channels(channels)
+            for channel in channels:
+                self._announce_channel(channel)
+        else:
+            self._print_appmessage("Joining {0} once connected".format(" ".join(channel.name for channel in channels)))
+        self._ui.switch_window(channels[-1].name)
+
+    def _add_channel(self, name):
+        channel = ChatChannel(name, self._sender_id, self._compression)
+        self._ui.open_window(name)
+        if self._history_dir is not None:
+            channel.history = ChatHistory(self._history_dir, name)
+            self._ui.set_history(channel.history, name)
+        self._message_topics[channel.topic] = channel
+        self._meta_prefixes[channel.meta_prefix] = channel
+        self._channels[name] = channel
+        return channel
+
+    def _subscribe_channels(self, channels):
+        # all channels are subscribed with a single request, past the threshold the
+        # wildcards cover them and the messages of other channels are dropped
+        if self._wildcard:
             return
-        
-        self._mqtt_client.unsubscribe(self._get_channel_topic())
-        self._send_channel_message("{0} left the channel".format(self._nickname))
-        self._channel = None
+        if len(self._channels) >= self._wildcard_channels:
+            self._wildcard = True
+            subscribed = [channel for channel in self._channels.values() if channel not in channels]
+            self._loop_thread.call(self._mqtt_client.subscribe, [(topic, self._qos) for topic in self.WILDCARD_TOPICS])
+            if subscribed:
+                # a message may arrive twice while both subscriptions exist
+                self._loop_thread.call(self._mqtt_client.unsubscribe, self._get_channel_filters(subscribed))
+        else:
+            self._loop_thread.call(self._mqtt_client.subscribe, [(topic, self._qos) for topic in self._get_channel_filters(channels)])
+
+    def _unsubscribe_channels(self, channels):
+        if not self._wildcard:
+            self._loop_thread.call(self._mqtt_client.unsubscribe, self._get_channel_filters(channels))
+        elif len(self._channels) < self._wildcard_channels:
+            # the remaining channels are subscribed one by one again
+            self._wildcard = False
+            if self._channels:
+                self._loop_thread.call(self._mqtt_client.subscribe, [(topic, self._qos) for topic in self._get_channel_filters(self._channels.values())])
+            self._loop_thread.call(self._mqtt_client.unsubscribe, self.WILDCARD_TOPICS)
+
+    def _get_channel_filters(self, channels):
+        topics = []
+        for channel in channels:
+            topics.append(channel.topic)
+            topics.append(channel.meta_filter)
+        return topics
+
+    def _announce_channel(self, channel):
+        channel.encoder.reset()
+        # the other clients learn what we understand before our first message
+        self._publish_channel_meta(channel)
+        self._send_channel_message(channel, "{0} joined the channel".format(self._nickname))
+
+    def _leave_channels(self, names):
+        with self._lock:
+            self._leave_channels_locked(names)
+
+    def _leave_channels_locked(self, names):
+        channels = []
+        for name in names:
+            channel = self._channels.get(name)
+            if channel is None:
+                self._print_appmessage("Cannot leave channel: join {0} first".format(name or "a channel"))
+                continue
+            channels.append(channel)
+        if not channels:
+            return
+        for channel in channels:
+            if self._mqtt_client is not None:
+                self._send_channel_message(channel, "{0} left the channel".format(self._nickname))
+                self._publish(channel.get_meta_topic(self._client_id), None, qos=self._qos, retain=True)
+            del self._channels[channel.name]
+            del self._message_topics[channel.topic]
+            del self._meta_prefixes[channel.meta_prefix]
+        if self._mqtt_client is not None:
+            self._unsubscribe_channels(channels)
+        for channel in channels:
+            self._close_history(channel)
+            self._ui.close_window(channel.name)
+
+    def _switch_channel(self, name):
+        if name not in self._channels:
+            self._print_appmessage("Cannot switch: join {0} first".format(name or "a channel"))
+            return
+        self._ui.switch_window(name)
+
+    def _close_history(self, channel):
+        if channel.history is not None:
+            self._ui.set_history(None, channel.name)
+            channel.history.close()
+            channel.history = None
+
+    def _search(self, query):
+        if not query:
+            self._print_appmessage("Usage: /search WORDS")
+            return
+        channel = self._channels.get(self._ui.get_window())
+        if channel is None or channel.history is None:
+            self._print_appmessage("Cannot search: switch to a channel with a history first")
+            return
+        started_on = time.perf_counter()
+        count, records = channel.history.search(query, self.SEARCH_LIMIT)
+        elapsed = time.perf_counter() - started_on
+        for timestamp, author, message in records:
+            date = time.strftime("%Y-%m-%d %H:%M", time.localtime(timestamp))
+            if author:
+                self._print_appmessage("{0} {1}: {2}".format(date, author, message))
+            else:
+                self._print_appmessage("{0} {1}".format(date, message))
+        self._print_appmessage("{0} messages found in {1:.1f} ms".format(count, elapsed * 1000))
 
     def _send_message(self, message):
         self._send_message_as(self._nickname, message)
 
-    def _send_channel_message(self, message):
-        self._send_message_as("", message)
+    def _send_channel_message(self, channel, message):
+        self._send_message_as("", message, channel)
+
+    def _send_message_as(self, author, message, channel=None):
+        with self._lock:
+            self._send_message_as_locked(author, message, channel)
 
-    def _send_message_as(self, author, message):
+    def _send_message_as_locked(self, author, message, channel):
+        # messages go to the channel of the shown window unless told otherwise
+        if channel is None:
+            channel = self._channels.get(self._ui.get_window())
         if self._mqtt_client is None:
             self._print_message(author, message)
             self._print_appmessage("Cannot send message: not connected yet")
             return
-        if self._channel is None:
+        if channel is None:
             self._print_message(author, message)
-            self._print_appmessage("Cannot send message: join a channel first")
+            self._print_appmessage("Cannot send message: join a channel or switch to one first")
+            return
+        if not channel.compact:
+            payload = json.dumps((author, message)).encode('utf8')
+            channel.json_pending += 1
+        else:
+            new_author = not channel.encoder.has_author(author)
+            payload = channel.encoder.encode(author, message)
+            if new_author:
+                # clients that join later learn about the author from the metadata
+                self._publish_channel_meta(channel)
+        self._publish(channel.topic, payload, qos=self._qos)
+
+    def _publish_channel_meta(self, channel):
+        formats = ["json"]
+        if self._wire_format != "json":
+            formats.insert(0, self.COMPACT_FORMAT)
+        if channel.compact:
+            current_format = self.COMPACT_FORMAT
+        else:
+            current_format = "json"
+        meta = {
+            "formats": formats,
+            "format": current_format,
+            "sender": self._sender_id,
+            "authors": channel.encoder.get_authors(),
+        }
+        self._publish(channel.get_meta_topic(self._client_id), json.dumps(meta), qos=self._qos, retain=True)
+
+    def _update_channel_format(self, channel):
+        # compact only once every client seen in the channel advertised it
+        peers = list(channel.peers.values())
+        compact = self._wire_format == "compact" and not channel.legacy and len(peers) > 0 and all(self.COMPACT_FORMAT in peer["formats"] for peer in peers)
+        if compact == channel.compact:
             return
-        payload = json.dumps((author, message)).encode('utf8')
-        self._mqtt_client.publish(self._get_channel_topic(), payload, qos=self._qos)
+        channel.compact = compact
+        if compact:
+            self._print_message("", "Every client in this channel understands the compact format, switching to it", channel)
+        else:
+            self._print_message("", "A client in this channel only understands json, falling back to it", channel)
+        # the other clients learn which format we send now
+        self._publish_channel_meta(channel)
+
+    def _on_json_message(self, channel):
+        if channel.json_pending > 0:
+            channel.json_pending -= 1
+            return
+        if not channel.compact:
+            return
+        # the clients that announced themselves send compact frames by now, their
+        # json messages were sent before their metadata said otherwise
+        if all(peer.get("format") == self.COMPACT_FORMAT for peer in list(channel.peers.values())):
+            channel.legacy = True
+            self._update_channel_format(channel)
     
     def _change_nickname(self, nickname):
         if not nickname:
@@ -333,36 +1473,80 @@ class ChatClient:
         if nickname.strip() != nickname:
             self._print_appmessage("Nickname must not contain leading or trailing whitespaces")
             return
-        if self._mqtt_client is not None and self._channel is not None:
-            self._send_channel_message("{0} changed nickname to {1}".format(self._nickname, nickname))
+        with self._lock:
+            channels = list(self._channels.values())
+        if self._mqtt_client is not None and channels:
+            for channel in channels:
+                self._send_channel_message(channel, "{0} changed nickname to {1}".format(self._nickname, nickname))
         else:
             self._print_appmessage("Your nickname is now {0}".format(nickname))
         self._nickname = nickname
     
-    def _get_channel_topic(self):
-        return "chat/channel/{0}/message".format(self._channel)
-
-    def _print_message(self, author, message):
-        self._ui.chatbuffer_addmessage(author, message)
+    def _print_message(self, author, message, channel=None):
+        if channel is None:
+            self._ui.chatbuffer_addmessage(author, message)
+        else:
+            self._ui.chatbuffer_addmessage(author, message, channel.name)
     
     def _print_appmessage(self, message):
         self._ui.chatbuffer_addmessage("", message)
 
-    def _on_connect(self, client, userdata, flags, rc):
+    def _on_connect(self):
         self._print_appmessage("Connected to {0}:{1}".format(self._mqtt_host, self._mqtt_port))
-        if self._channel:
-            # join again
-            self._join_channel(self._channel)
+        with self._lock:
+            self._rejoin_channels()
 
-    def _on_disconnect(self, client, userdata, rc):
+    def _rejoin_channels(self):
+        channels = list(self._channels.values())
+        if channels:
+            # the other clients announce themselves again with their retained metadata
+            for channel in channels:
+                channel.peers = {}
+                channel.compact = False
+                channel.legacy = False
+                channel.json_pending = 0
+            # join all channels again with a single subscription
+            self._wildcard = False
+            self._subscribe_channels(channels)
+            for channel in channels:
+                self._announce_channel(channel)
+
+    def _on_disconnect(self):
         self._print_appmessage("Disconnected from {0}:{1}".format(self._mqtt_host, self._mqtt_port))
 
-    def _on_message(self, client, userdata, msg):
+    def _on_message(self, msg):
+        with self._lock:
+            self._handle_message(msg)
+
+    def _handle_message(self, msg):
         try:
-            if msg.topic == self._get_channel_topic():
-                payload = msg.payload.decode('utf8')
-                author, message = json.loads(payload)
-                self._print_message(author, message)
+            channel = self._message_topics.get(msg.topic)
+            if channel is not None:
+                if channel.decoder.is_compact(msg.payload):
+                    messages = channel.decoder.decode(msg.payload)
+                else:
+                    # older clients send json only
+                    payload = msg.payload.decode('utf8')
+                    messages = [json.loads(payload)]
+                    self._on_json_message(channel)
+                for author, message in messages:
+                    self._print_message(author, message, channel)
+                history = channel.history
+                if history is not None:
+                    history.append(time.time(), messages)
+                return
+            # the wildcards bring the messages of channels that are not joined
+            prefix, _, client_id = msg.topic.rpartition("/")
+            channel = self._meta_prefixes.get(prefix)
+            if channel is not None and client_id != self._client_id:
+                if not msg.payload:
+                    # the client left the channel
+                    channel.peers.pop(client_id, None)
+                else:
+                    meta = json.loads(msg.payload.decode('utf8'))
+                    channel.decoder.add_authors(meta["sender"], meta["authors"])
+                    channel.peers[client_id] = meta
+                self._update_channel_format(channel)
         except Exception as ex:
             #print("An unhandled exception occurred while processing a message on topic {0}: {1}".format(msg.topic, ex))
             pass
@@ -373,6 +1557,17 @@ def main(stdscr):
     parser.add_argument("--nickname", help="the nickname to use")
     parser.add_argument("--client-id", help="the client id to use when connecting to the broker")
     parser.add_argument("--clean-session", choices=["yes", "no"])
+    parser.add_argument("--scrollback", type=int, help="the number of messages to keep, defaults to 1000")
+    parser.add_argument("--wire-format", choices=["compact", "json"], help="the format to send messages in, compact is only used in channels where every other client advertised it and json is sent otherwise, defaults to json")
+    parser.add_argument("--compression", choices=CompactEncoder.COMPRESSIONS, help="the compression of compact batches, defaults to zlib")
+    parser.add_argument("--fps", type=int, help="the maximum number of times per second new messages are drawn, defaults to 30")
+    parser.add_argument("--history", choices=["yes", "no"], help="keep the history of the channels, defaults to yes")
+    parser.add_argument("--history-dir", help="the directory to keep the history of the channels and of the input in, defaults to ~/.mqtt-chat")
+    parser.add_argument("--input-history-size", type=int, help="the number of different commands to remember, defaults to 1000")
+    parser.add_argument("--metrics-interval", type=float, help="the seconds between publishing the metrics to CLIENT_ID/metrics while connected, defaults to 60.0, 0 disables the metrics")
+    parser.add_argument("--metrics-file", help="a file the metrics are written to in the prometheus text format every metrics interval while connected")
+    parser.add_argument("--channels", nargs="+", help="the channels to join once connected, defaults to hta")
+    parser.add_argument("--wildcard-channels", type=int, help="the number of joined channels from which on all channels are subscribed with a wildcard instead of one by one, defaults to 16")
     args = parser.parse_args()
 
     if args.host:
@@ -387,10 +1582,52 @@ def main(stdscr):
         clean_session = True
     elif args.clean_session == "no":
         clean_session = False
+    if args.scrollback:
+        scrollback = args.scrollback
+    else:
+        scrollback = 1000
+    if args.fps:
+        fps = args.fps
+    else:
+        fps = 30
+    if args.history == "no":
+        history_dir = None
+    elif args.history_dir:
+        history_dir = args.history_dir
+    else:
+        history_dir = os.path.join(os.path.expanduser("~"), ".mqtt-chat")
+    if history_dir is None:
+        inputhistory_path = None
+    else:
+        inputhistory_path = os.path.join(history_dir, "input.history")
+    if args.input_history_size:
+        inputhistory_size = args.input_history_size
+    else:
+        inputhistory_size = 1000
+    if args.metrics_interval is not None:
+        metrics_interval = args.metrics_interval
+    else:
+        metrics_interval = 60.0
+    if args.channels:
+        channels = args.channels
+    else:
+        channels = ["hta"]
+    for channel in channels:
+        if not is_valid_channel_name(channel):
+            parser.error("channel names must not contain +, # or /: {0}".format(channel))
+    if args.wildcard_channels:
+        wildcard_channels = args.wildcard_channels
+    else:
+        wildcard_channels = 16
+    if metrics_interval > 0:
+        chat_metrics = metrics.Metrics({"client_id": nickname})
+    else:
+        chat_metrics = None
     
     print("heyho!")
-    with ChatUI(stdscr) as ui:
-        chatclient = ChatClient(ui, host, nickname=nickname, client_id=nickname, clean_session=clean_session)
+    with ChatUI(stdscr, scrollback, fps, inputhistory_path, inputhistory_size, chat_metrics) as ui:
+        chatclient = ChatClient(ui, host, nickname=nickname, client_id=nickname, clean_session=clean_session, wire_format=args.wire_format, compression=args.compression, history_dir=history_dir, metrics=chat_metrics, metrics_interval=metrics_interval, metrics_file=args.metrics_file, channels=channels, wildcard_channels=wildcard_channels)
         chatclient.run()
 
-curses.wrapper(main)
+if __name__ == "__main__":
+    curses.wrapper(main)
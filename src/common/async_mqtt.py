@@ -0,0 +1,488 @@
+import paho.mqtt.client as mqtt
+import asyncio
+import collections
+import random
+import socket
+import threading
+import time
+
+# What happens to a message that arrives while the inbound queue is full. Block
+# stops reading from the socket until the queue has room again, the broker then
+# holds on to the messages. The drop policies keep reading and drop the oldest
+# queued message or the one that just arrived.
+BLOCK = "block"
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+OVERFLOW_POLICIES = [BLOCK, DROP_OLDEST, DROP_NEWEST]
+
+
+class WindowFull(Exception):
+    pass
+
+
+class AsyncClient:
+    # A paho client driven by the readers and writers of the running asyncio event
+    # loop instead of a network thread. Received messages are iterated with async
+    # for, publishes complete once the broker acknowledged them with a PUBACK or a
+    # PUBCOMP, or once they are written for qos 0. At most max_inflight publishes
+    # are unacknowledged and at most queue_size messages wait to be iterated.
+    MAX_BACKOFF = 120.0
+    # the most packets read at once before other clients get their turn
+    READ_BATCH = 100
+
+    def __init__(self, host, port=1883, client_id="", clean_session=True, transport="tcp", keepalive=60, max_inflight=100, queue_size=1000, overflow=BLOCK, connect_timeout=10.0):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("overflow must be one of {0}".format(OVERFLOW_POLICIES))
+        self._host = host
+        self._port = port
+        self._keepalive = keepalive
+        # the seconds a connect may take until the connack, including the websocket handshake
+        self._connect_timeout = connect_timeout
+        self.max_inflight = max_inflight
+        self.queue_size = queue_size
+        self._overflow = overflow
+        self._client = mqtt.Client(client_id=client_id, clean_session=clean_session, transport=transport)
+        self._client.on_connect = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
+        self._client.on_message = self._on_message
+        self._client.on_publish = self._on_publish
+        self._client.on_subscribe = self._on_subscribe
+        self._client.on_unsubscribe = self._on_unsubscribe
+        self._client.on_socket_open = self._on_socket_open
+        self._client.on_socket_close = self._on_socket_close
+        self._client.on_socket_register_write = self._on_socket_register_write
+        self._client.on_socket_unregister_write = self._on_socket_unregister_write
+        # the window bounds the publishes in flight, paho would queue the ones over
+        # its own limit and look through all of them on every acknowledgement
+        self._client.max_inflight_messages_set(0)
+        self._loop = None
+        self._task = None
+        self._keep_alive_handle = None
+        self._first_connect = None
+        # a connect that timed out but still runs in its thread
+        self._abandoned_connect = None
+        self._disconnected = asyncio.Event()
+        self._closed = asyncio.Event()
+        self._failures = 0
+        # the seconds to wait before the next reconnect instead of backing off
+        self._downtime = None
+        # futures of the unacknowledged publishes by message id, paho resends the
+        # ones with qos 1 and 2 after a reconnect, the ones with qos 0 that were not
+        # written yet are lost with the connection
+        self._publishes = {}
+        self._unsent = set()
+        self._window_waiters = []
+        # the histogram of each qos and the time each publish was sent by message id,
+        # only while metrics are registered
+        self._ack_seconds = None
+        self._sent_on = {}
+        # futures of the unacknowledged subscribes and unsubscribes by message id
+        self._requests = {}
+        self._messages = collections.deque()
+        self._message_waiter = None
+        self._reading_paused = False
+        # counts the packets that paho handed over, to tell whether a read got one
+        self._received = 0
+        # called without arguments after every connect and disconnect
+        self.on_connect = None
+        self.on_disconnect = None
+        self.connected = False
+        self.published = 0
+        self.last_published_on = 0
+        self.dropped = 0
+        self.disconnects = 0
+
+    @property
+    def in_flight(self):
+        return len(self._publishes)
+
+    @property
+    def queued(self):
+        return len(self._messages)
+
+    def register_metrics(self, metrics, **labels):
+        # the counters are read from the client when the metrics are exported, only
+        # the latency of the publishes is recorded as they are acknowledged
+        metrics.counter("mqtt_published_total", "Publishes acknowledged by the broker, or written for qos 0.", lambda: self.published, labels)
+        metrics.counter("mqtt_dropped_total", "Received messages dropped because the inbound queue was full.", lambda: self.dropped, labels)
+        metrics.counter("mqtt_disconnects_total", "Connections lost or closed.", lambda: self.disconnects, labels)
+        metrics.gauge("mqtt_connected", "Whether the client is connected.", lambda: int(self.connected), labels)
+        metrics.gauge("mqtt_in_flight", "Publishes waiting for their acknowledgement.", lambda: len(self._publishes), labels)
+        metrics.gauge("mqtt_queued", "Received messages waiting to be handled.", lambda: len(self._messages), labels)
+        self._ack_seconds = [metrics.histogram("mqtt_publish_ack_seconds", "Seconds from a publish to its acknowledgement, or until it is written for qos 0.", labels=dict(labels, qos=qos)) for qos in range(3)]
+
+    def will_set(self, topic, payload=None, qos=0, retain=False):
+        self._client.will_set(topic, payload, qos, retain)
+
+    def start(self):
+        # keeps connecting in the background until the client is closed
+        self._loop = asyncio.get_running_loop()
+        self._task = self._loop.create_task(self._keep_connected())
+        self._keep_alive_handle = self._loop.call_later(1.0, self._keep_alive)
+
+    async def connect(self):
+        # like start, but fails if the first connect fails
+        self._first_connect = asyncio.get_running_loop().create_future()
+        self.start()
+        try:
+            try:
+                await asyncio.wait_for(asyncio.shield(self._first_connect), self._connect_timeout)
+            except asyncio.TimeoutError:
+                # the connect in the background must not fail it later
+                self._first_connect.cancel()
+                raise TimeoutError("no connack from {0}:{1} within {2} seconds".format(self._host, self._port, self._connect_timeout))
+        except Exception:
+            await self.close()
+            raise
+
+    async def close(self, timeout=5.0):
+        # waits for the publishes in flight and disconnects cleanly, which drops the will
+        if self._closed.is_set():
+            return
+        if self.connected and self._publishes:
+            try:
+                await asyncio.wait_for(self.drain(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self._closed.set()
+        if self._keep_alive_handle is not None:
+            self._keep_alive_handle.cancel()
+        if self._client.socket() is not None:
+            self._client.disconnect()
+        if self._task is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(self._task), timeout)
+            except asyncio.TimeoutError:
+                # the disconnect did not get through, close the socket instead, a full
+                # queue may have stopped reading, so read again to see it closed
+                if self._reading_paused:
+                    self._resume_reading()
+                sock = self._client.socket()
+                if sock is not None:
+                    sock.shutdown(socket.SHUT_RDWR)
+                try:
+                    await asyncio.wait_for(self._task, timeout)
+                except asyncio.TimeoutError:
+                    # give up on the connection without waiting for paho to notice
+                    if sock is not None:
+                        self._remove_socket(sock.fileno())
+                        sock.close()
+                    self._on_disconnect(self._client, None, mqtt.MQTT_ERR_CONN_LOST)
+        for future in list(self._publishes.values()):
+            if not future.done():
+                future.set_result(False)
+        self._publishes = {}
+        self._unsent = set()
+        self._sent_on = {}
+        self._wake_up_window_waiters()
+        self._cancel_requests()
+        self._wake_up_message_waiter()
+
+    def drop(self, clean=False, downtime=None):
+        # disconnects without closing the client, it reconnects after the downtime or
+        # backs off as usual, the broker publishes the will unless the drop is clean
+        sock = self._client.socket()
+        if sock is None:
+            return
+        self._downtime = downtime
+        if clean:
+            self._client.disconnect()
+        else:
+            sock.shutdown(socket.SHUT_RDWR)
+
+    def publish_nowait(self, topic, payload=None, qos=0, retain=False):
+        # the future completes with True once the publish is acknowledged, or with
+        # False if it is lost because the client is disconnected or closed
+        if len(self._publishes) >= self.max_inflight:
+            raise WindowFull("{0} publishes are in flight".format(len(self._publishes)))
+        future = self._loop.create_future()
+        info = self._client.publish(topic, payload, qos, retain)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS and (qos == 0 or info.rc != mqtt.MQTT_ERR_NO_CONN):
+            future.set_result(False)
+            return future
+        self._publishes[info.mid] = future
+        if qos == 0:
+            self._unsent.add(info.mid)
+        if self._ack_seconds is not None:
+            self._sent_on[info.mid] = (self._ack_seconds[qos], time.perf_counter())
+        return future
+
+    async def publish(self, topic, payload=None, qos=0, retain=False):
+        await self.wait_for_window()
+        return await self.publish_nowait(topic, payload, qos, retain)
+
+    async def wait_for_window(self, slots=1):
+        # waits until there is room for this many publishes in the window
+        slots = min(slots, self.max_inflight)
+        while self.max_inflight - len(self._publishes) < slots:
+            waiter = self._loop.create_future()
+            self._window_waiters.append(waiter)
+            await waiter
+
+    async def drain(self):
+        await self.wait_for_window(self.max_inflight)
+
+    def subscribe(self, topics, qos=0):
+        # takes a topic filter or a list of topic filters and qos like paho, the
+        # future completes with the granted qos, or with None if not connected
+        return self._request(self._client.subscribe(topics, qos))
+
+    def unsubscribe(self, topics):
+        return self._request(self._client.unsubscribe(topics))
+
+    def _request(self, result):
+        rc, mid = result
+        future = self._loop.create_future()
+        if rc == mqtt.MQTT_ERR_SUCCESS:
+            self._requests[mid] = future
+        else:
+            future.set_result(None)
+        return future
+
+    def _cancel_requests(self):
+        # paho does not send subscribes again after a reconnect
+        requests = self._requests
+        self._requests = {}
+        for future in requests.values():
+            if not future.done():
+                future.set_result(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._messages:
+            if self._closed.is_set():
+                raise StopAsyncIteration
+            self._message_waiter = self._loop.create_future()
+            await self._message_waiter
+        msg = self._messages.popleft()
+        if self._reading_paused and len(self._messages) <= self.queue_size // 2:
+            self._resume_reading()
+        return msg
+
+    async def _keep_connected(self):
+        while not self._closed.is_set():
+            self._disconnected.clear()
+            try:
+                await self._connect_once()
+            except Exception as ex:
+                # refused or unreachable brokers, failed websocket handshakes and
+                # timeouts all back off, only the first connect gives up
+                if self._first_connect is not None and not self._first_connect.done():
+                    self._first_connect.set_exception(ex)
+                    return
+            else:
+                if self._closed.is_set():
+                    self._client.disconnect()
+                await self._disconnected.wait()
+            if self._closed.is_set():
+                break
+            if self._downtime is not None:
+                delay = self._downtime
+                self._downtime = None
+            else:
+                # back off like paho does, the jitter spreads a reconnect storm
+                delay = min(2 ** self._failures, self.MAX_BACKOFF) * random.uniform(0.5, 1.0)
+                self._failures += 1
+            try:
+                await asyncio.wait_for(self._closed.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _connect_once(self):
+        # paho connects and does the websocket handshake blocking, so in a thread,
+        # a connect that timed out must finish before paho connects again
+        if self._abandoned_connect is not None:
+            await asyncio.wait([self._abandoned_connect])
+            self._abandoned_connect = None
+        future = self._loop.run_in_executor(None, self._client.connect, self._host, self._port, self._keepalive)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self._connect_timeout)
+        except asyncio.TimeoutError:
+            self._abandoned_connect = future
+            future.add_done_callback(self._drop_abandoned_connect)
+            raise TimeoutError("could not connect to {0}:{1} within {2} seconds".format(self._host, self._port, self._connect_timeout))
+
+    def _drop_abandoned_connect(self, future):
+        # the connection the abandoned connect made after all is not wanted once closed
+        if not future.cancelled() and future.exception() is None and self._closed.is_set():
+            self._client.disconnect()
+
+    def _keep_alive(self):
+        self._keep_alive_handle = self._loop.call_later(1.0, self._keep_alive)
+        if self.connected:
+            self._client.loop_misc()
+
+    def _pause_reading(self):
+        self._reading_paused = True
+        sock = self._client.socket()
+        if sock is not None:
+            self._loop.remove_reader(sock.fileno())
+
+    def _resume_reading(self):
+        self._reading_paused = False
+        sock = self._client.socket()
+        if sock is not None:
+            self._loop.add_reader(sock.fileno(), self._read)
+
+    def _read(self):
+        # paho reads a single packet per call unless publishes are in flight, so
+        # keep reading until a read does not get a message or an acknowledgement
+        for _ in range(self.READ_BATCH):
+            received = self._received
+            if self._client.loop_read() != mqtt.MQTT_ERR_SUCCESS or self._received == received or self._reading_paused:
+                break
+
+    def _wake_up_window_waiters(self):
+        waiters = self._window_waiters
+        self._window_waiters = []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def _wake_up_message_waiter(self):
+        waiter = self._message_waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def _on_connect(self, client, userdata, flags, rc):
+        first_connect = self._first_connect
+        if rc != 0:
+            # paho closes the connection after this
+            if first_connect is not None and not first_connect.done():
+                first_connect.set_exception(ConnectionRefusedError(mqtt.connack_string(rc)))
+            return
+        self.connected = True
+        self._failures = 0
+        if first_connect is not None and not first_connect.done():
+            first_connect.set_result(None)
+        if self.on_connect is not None:
+            self.on_connect()
+
+    def _on_disconnect(self, client, userdata, rc):
+        was_connected = self.connected
+        self.connected = False
+        if was_connected:
+            self.disconnects += 1
+        for mid in self._unsent:
+            self._sent_on.pop(mid, None)
+            future = self._publishes.pop(mid, None)
+            if future is not None and not future.done():
+                future.set_result(False)
+        self._unsent = set()
+        self._wake_up_window_waiters()
+        self._cancel_requests()
+        first_connect = self._first_connect
+        if first_connect is not None and not first_connect.done():
+            first_connect.set_exception(ConnectionError("Disconnected from {0}:{1} before the connect was acknowledged".format(self._host, self._port)))
+        if was_connected and self.on_disconnect is not None:
+            self.on_disconnect()
+        self._disconnected.set()
+
+    def _on_message(self, client, userdata, msg):
+        self._received += 1
+        messages = self._messages
+        if len(messages) >= self.queue_size:
+            if self._overflow == DROP_NEWEST:
+                self.dropped += 1
+                return
+            if self._overflow == DROP_OLDEST:
+                messages.popleft()
+                self.dropped += 1
+        messages.append(msg)
+        if self._overflow == BLOCK and len(messages) >= self.queue_size and not self._reading_paused:
+            # the messages of the current read still go into the queue, no more
+            # are read until it is half empty, a reader that stalls for longer than
+            # the keepalive misses the ping response and gets disconnected
+            self._pause_reading()
+        self._wake_up_message_waiter()
+
+    def _on_publish(self, client, userdata, mid):
+        self._received += 1
+        future = self._publishes.pop(mid, None)
+        if future is None:
+            return
+        self._unsent.discard(mid)
+        if self._ack_seconds is not None:
+            sent = self._sent_on.pop(mid, None)
+            if sent is not None:
+                sent[0].observe(time.perf_counter() - sent[1])
+        self.published += 1
+        self.last_published_on = time.monotonic()
+        if not future.done():
+            future.set_result(True)
+        if self._window_waiters:
+            self._wake_up_window_waiters()
+
+    def _on_subscribe(self, client, userdata, mid, granted_qos):
+        future = self._requests.pop(mid, None)
+        if future is not None and not future.done():
+            future.set_result(granted_qos)
+
+    def _on_unsubscribe(self, client, userdata, mid):
+        future = self._requests.pop(mid, None)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    # paho calls the socket callbacks from the thread that connects as well, so they
+    # are queued to the loop in order, by file descriptor because the socket may be
+    # closed by the time the loop gets to them
+    def _on_socket_open(self, client, userdata, sock):
+        try:
+            # paho leaves nagle on, so publishes with qos 1 and 2 would wait for the
+            # delayed ack of the broker
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (AttributeError, OSError):
+            # websockets wrap the socket
+            pass
+        self._call_soon(self._add_socket, sock.fileno())
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._call_soon(self._remove_socket, sock.fileno())
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._call_soon(self._loop.add_writer, sock.fileno(), self._client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._call_soon(self._remove_writer, sock.fileno())
+
+    def _call_soon(self, callback, *args):
+        # paho closes the socket when it is garbage collected, the loop may be gone by then
+        if not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(callback, *args)
+
+    def _add_socket(self, fd):
+        if not self._reading_paused:
+            self._loop.add_reader(fd, self._read)
+
+    def _remove_writer(self, fd):
+        try:
+            self._loop.remove_writer(fd)
+        except OSError:
+            # the socket was closed in the meantime, the loop forgets about it
+            pass
+
+    def _remove_socket(self, fd):
+        self._loop.remove_reader(fd)
+        self._loop.remove_writer(fd)
+
+
+class EventLoopThread:
+    # an event loop in a thread of its own for programs whose main thread is busy
+    # with something else, like paho's loop_start
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def call(self, callback, *args):
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
@@ -0,0 +1,193 @@
+import asyncio
+import bisect
+import json
+import os
+
+import async_mqtt
+
+# the upper bounds of the buckets of latencies in seconds, from 100 us to 10 s
+LATENCY_BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Histogram:
+    # counts observations in fixed buckets. An observation is a bisection and
+    # three additions, about 300 ns, and it allocates: the running sum is a new
+    # float and a bucket count above 256 a new int every time. The counts are a
+    # list rather than an array, which would box a new int on every increment.
+    __slots__ = ["bounds", "counts", "count", "sum"]
+
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = tuple(bounds)
+        # the last bucket counts the observations above the last bound
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        # the upper bound of the bucket the quantile falls into
+        count = self.count
+        if count == 0:
+            return None
+        rank = q * count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank and bucket_count > 0:
+                if i < len(self.bounds):
+                    return self.bounds[i]
+                return float("inf")
+        return float("inf")
+
+
+class Metrics:
+    # The metrics of a program by name and labels. Counters and gauges may be
+    # read from a function when they are exported, so that values the program
+    # keeps anyway are not counted twice. The labels of the registry are added
+    # to all of its metrics.
+    COUNTER = "counter"
+    GAUGE = "gauge"
+    HISTOGRAM = "histogram"
+
+    def __init__(self, labels=None):
+        self._labels = dict(labels or {})
+        # (name, labels) mapped to the kind, help and metric or function
+        self._metrics = {}
+
+    def counter(self, name, help, function=None, labels=None):
+        return self._register(name, labels, self.COUNTER, help, function, Counter)
+
+    def gauge(self, name, help, function, labels=None):
+        return self._register(name, labels, self.GAUGE, help, function, None)
+
+    def histogram(self, name, help, bounds=LATENCY_BOUNDS, labels=None):
+        return self._register(name, labels, self.HISTOGRAM, help, None, lambda: Histogram(bounds))
+
+    def _register(self, name, labels, kind, help, function, create):
+        labels = self._get_labels(labels)
+        key = (name, labels)
+        if function is None:
+            # registering again returns the same metric, it keeps counting
+            existing = self._metrics.get(key)
+            if existing is not None and existing[0] == kind:
+                return existing[2]
+            metric = create()
+        else:
+            metric = function
+        self._metrics[key] = (kind, help, metric)
+        return metric
+
+    def unregister(self, name, labels=None):
+        labels = self._get_labels(labels)
+        self._metrics.pop((name, labels), None)
+
+    def _get_labels(self, labels):
+        # label values are text, sorted by name so that the same labels make the same key
+        labels = dict(self._labels, **(labels or {}))
+        return tuple(sorted((name, "{0}".format(value)) for name, value in labels.items()))
+
+    def items(self):
+        for (name, labels), (kind, help, metric) in sorted(self._metrics.items(), key=lambda item: item[0]):
+            if kind != self.HISTOGRAM:
+                if callable(metric):
+                    metric = metric()
+                elif isinstance(metric, Counter):
+                    metric = metric.value
+            yield name, labels, kind, help, metric
+
+    def to_dict(self):
+        result = {}
+        for name, labels, kind, help, metric in self.items():
+            key = name + format_labels(labels)
+            if kind == self.HISTOGRAM:
+                result[key] = {
+                    "count": metric.count,
+                    "sum": metric.sum,
+                    "p50": json_quantile(metric, 0.5),
+                    "p90": json_quantile(metric, 0.9),
+                    "p99": json_quantile(metric, 0.99),
+                    "buckets": list(zip(metric.bounds + ("+Inf",), metric.counts)),
+                }
+            else:
+                result[key] = metric
+        return result
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), separators=(",", ":"))
+
+
+def json_quantile(histogram, q):
+    # infinity is not json, the quantiles above the last bound are null
+    value = histogram.quantile(q)
+    if value == float("inf"):
+        return None
+    return value
+
+def escape_label_value(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join("{0}=\"{1}\"".format(name, escape_label_value(value)) for name, value in labels) + "}"
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return "{0}".format(value)
+
+def to_prometheus(registries):
+    # the text exposition format, the series of all registries are grouped by name
+    # so that every metric is described once
+    groups = {}
+    for registry in registries:
+        for name, labels, kind, help, metric in registry.items():
+            groups.setdefault(name, (kind, help, []))[2].append((labels, metric))
+    lines = []
+    for name in sorted(groups):
+        kind, help, series = groups[name]
+        lines.append("# HELP {0} {1}".format(name, help.replace("\\", "\\\\").replace("\n", "\\n")))
+        lines.append("# TYPE {0} {1}".format(name, kind))
+        for labels, metric in series:
+            if kind != Metrics.HISTOGRAM:
+                lines.append("{0}{1} {2}".format(name, format_labels(labels), format_value(metric)))
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.bounds + (float("inf"),), metric.counts):
+                cumulative += count
+                lines.append("{0}_bucket{1} {2}".format(name, format_labels(labels + (("le", format_value(bound)),)), cumulative))
+            lines.append("{0}_sum{1} {2}".format(name, format_labels(labels), metric.sum))
+            lines.append("{0}_count{1} {2}".format(name, format_labels(labels), cumulative))
+    return "\n".join(lines) + "\n"
+
+def write_prometheus(path, registries):
+    # written next to the file and renamed, so a collector never reads half of it
+    temporary_path = "{0}.tmp".format(path)
+    with open(temporary_path, "w") as f:
+        f.write(to_prometheus(registries))
+    os.replace(temporary_path, path)
+
+async def report(metrics, client, topic, interval, path=None):
+    # publishes the metrics retained and writes them for prometheus every interval
+    # until cancelled, a full window skips a publication
+    while True:
+        await asyncio.sleep(interval)
+        if client is not None and client.connected:
+            try:
+                client.publish_nowait(topic, metrics.to_json(), retain=True)
+            except async_mqtt.WindowFull:
+                pass
+        if path is not None:
+            write_prometheus(path, [metrics])
@@ -0,0 +1,128 @@
+class NodeCommand:
+    # a command of a node, run by publishing anything to <id>/command/<name>
+    def __init__(self, name, handler):
+        self.name = name
+        self._handler = handler
+
+    def run(self, payload):
+        self._handler()
+
+
+class NodeProperty:
+    # A property of a node that is published retained to <id>/property/<name>.
+    # With a setter it is changed through <id>/property/<name>/set, the payload
+    # is parsed and checked against the bounds before the setter sees it.
+    def __init__(self, name, type, get, set=None, parse=float, format="{0}".format, minimum=None, maximum=None, quantity=None, unit=None):
+        self.name = name
+        self.type = type
+        self.get = get
+        self.set = set
+        self.parse = parse
+        self.format = format
+        self.minimum = minimum
+        self.maximum = maximum
+        self.quantity = quantity
+        self.unit = unit
+
+    def get_label(self):
+        return self.name.replace("_", " ")
+
+    def check(self, value):
+        # returns why the value is refused or None, the comparisons are written so
+        # that nan is refused as well
+        if self.minimum is not None and not value >= self.minimum:
+            return "it must be at least {0}".format(self.minimum)
+        if self.maximum is not None and not value <= self.maximum:
+            return "it must be at most {0}".format(self.maximum)
+        return None
+
+
+class NodeRegistry:
+    # The commands and properties of a node. The subscriptions, the entries of the
+    # birth and the dispatch of incoming messages are all derived from it, so a
+    # property is added in one place.
+    def __init__(self, application_id, publish):
+        self._application_id = application_id
+        # publishes a payload retained to a topic of the node
+        self._publish = publish
+        self._commands = []
+        self._properties = []
+        # the topics mapped to the handlers of their payloads
+        self._handlers = {}
+
+    def add_command(self, name, handler):
+        command = NodeCommand(name, handler)
+        self._commands.append(command)
+        self._handlers[self._get_topic("command/{0}".format(name))] = command.run
+        return command
+
+    def add_property(self, name, type, get, set=None, **kwargs):
+        node_property = NodeProperty(name, type, get, set, **kwargs)
+        self._properties.append(node_property)
+        if set is not None:
+            self._handlers[self._get_topic("property/{0}/set".format(name))] = lambda payload: self._change(node_property, payload)
+        return node_property
+
+    def _get_topic(self, topic):
+        return "{0}/{1}".format(self._application_id, topic)
+
+    def get_subscriptions(self, qos=0):
+        return [(topic, qos) for topic in self._handlers]
+
+    def dispatch(self, msg):
+        # returns False for topics that are not registered
+        handler = self._handlers.get(msg.topic)
+        if handler is None:
+            return False
+        handler(msg.payload)
+        return True
+
+    def _change(self, node_property, payload):
+        label = node_property.get_label()
+        try:
+            value = node_property.parse(payload.decode('utf-8'))
+        except ValueError as ex:
+            print("Refusing to change the {0}: {1}".format(label, ex))
+            return
+        reason = node_property.check(value)
+        if reason is not None:
+            print("Refusing to change the {0} to {1}, {2}".format(label, value, reason))
+            return
+        print("Changing {0} from {1} to {2}".format(label, node_property.get(), value))
+        node_property.set(value)
+        self.publish(node_property)
+
+    def publish(self, node_property):
+        self._publish("property/{0}".format(node_property.name), node_property.format(node_property.get()))
+
+    def publish_all(self):
+        for node_property in self._properties:
+            self.publish(node_property)
+
+    def get_birth_topics(self):
+        for command in self._commands:
+            yield {
+                "topic": self._get_topic("command/{0}".format(command.name)),
+                "modes": ["sub"],
+                "type": "null",
+            }
+        for node_property in self._properties:
+            topic = self._get_topic("property/{0}".format(node_property.name))
+            entry = {
+                "topic": topic,
+                "modes": ["pub"],
+                "type": node_property.type,
+            }
+            if node_property.quantity is not None:
+                entry["quantity"] = node_property.quantity
+            if node_property.unit is not None:
+                entry["unit"] = node_property.unit
+            yield entry
+            if node_property.set is None:
+                continue
+            entry = dict(entry, topic="{0}/set".format(topic), modes=["sub"])
+            if node_property.minimum is not None:
+                entry["minimum"] = node_property.minimum
+            if node_property.maximum is not None:
+                entry["maximum"] = node_property.maximum
+            yield entry
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+import argparse
+import array
+import asyncio
+import collections
+import heapq
+import json
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+import async_mqtt
+
+class LivenessIndex:
+    # The state of every node in flat arrays indexed by a slot per node, so an
+    # update is a dict lookup and a few array writes. The times of the last
+    # transitions of each node are kept in a ring of flap_history entries.
+    UNKNOWN = 0
+    ALIVE = 1
+    DEAD = 2
+
+    def __init__(self, flap_history=8, flap_window=300.0, flap_threshold=4, recent_deaths=10):
+        self._flap_history = flap_history
+        self._flap_window = flap_window
+        self._flap_threshold = flap_threshold
+        self._slots = {}
+        self._nodes = []
+        self._states = bytearray()
+        self._changed_on = array.array("d")
+        self._transitions = array.array("d")
+        self._ring_positions = array.array("I")
+        self._counts = [0, 0, 0]
+        # slots of the nodes with at least flap_threshold transitions in the flap window
+        self._flapping = set()
+        self._recent_deaths = collections.deque(maxlen=recent_deaths)
+        self._births = 0
+        self._deaths = 0
+
+    def update(self, node, state, now, retained=False):
+        # retained states describe how things are, not what just happened
+        slot = self._slots.get(node)
+        if slot is None:
+            slot = len(self._nodes)
+            self._slots[node] = slot
+            self._nodes.append(node)
+            self._states.append(self.UNKNOWN)
+            self._changed_on.append(now)
+            # empty entries of the ring are older than any flap window
+            self._transitions.extend([-math.inf] * self._flap_history)
+            self._ring_positions.append(0)
+            self._counts[self.UNKNOWN] += 1
+        old_state = self._states[slot]
+        if old_state == state:
+            return
+        self._counts[old_state] -= 1
+        self._counts[state] += 1
+        self._states[slot] = state
+        self._changed_on[slot] = now
+        if retained:
+            return
+        if state == self.ALIVE:
+            self._births += 1
+        elif state == self.DEAD:
+            self._deaths += 1
+            self._recent_deaths.append(node)
+        if old_state != self.UNKNOWN and state != self.UNKNOWN:
+            position = self._ring_positions[slot]
+            self._transitions[slot * self._flap_history + position] = now
+            self._ring_positions[slot] = (position + 1) % self._flap_history
+            if slot not in self._flapping and self._count_recent_transitions(slot, now) >= self._flap_threshold:
+                self._flapping.add(slot)
+
+    def _count_recent_transitions(self, slot, now):
+        since = now - self._flap_window
+        first = slot * self._flap_history
+        count = 0
+        for i in range(first, first + self._flap_history):
+            if self._transitions[i] > since:
+                count += 1
+        return count
+
+    def _get_node_id(self, node):
+        # nodes are known by their state topic
+        return node.rsplit("/", 1)[0]
+
+    def summarize(self, now, top=10):
+        # only the flapping nodes are looked at, not all of them
+        transitions = {}
+        for slot in list(self._flapping):
+            count = self._count_recent_transitions(slot, now)
+            if count < self._flap_threshold:
+                self._flapping.discard(slot)
+            else:
+                transitions[slot] = count
+        flapping = heapq.nsmallest(top, transitions, key=lambda slot: (-transitions[slot], -self._changed_on[slot]))
+        summary = {
+            "nodes": len(self._nodes) - self._counts[self.UNKNOWN],
+            "alive": self._counts[self.ALIVE],
+            "dead": self._counts[self.DEAD],
+            "births": self._births,
+            "deaths": self._deaths,
+            "flapping": len(transitions),
+            "top_flapping": [{"node": self._get_node_id(self._nodes[slot]), "transitions": transitions[slot]} for slot in flapping],
+            "recent_deaths": [self._get_node_id(node) for node in self._recent_deaths],
+        }
+        # births and deaths are counted per summary
+        self._births = 0
+        self._deaths = 0
+        return summary
+
+
+class LivenessMonitor:
+    # SensorNode announces itself on <id>/STATE and SomeNode on <id>/state, both
+    # publish a retained ALIVE and leave a retained DEAD as their last will
+    STATE_TOPICS = ["+/STATE", "+/state"]
+    STATES = {
+        b"ALIVE": LivenessIndex.ALIVE,
+        b"DEAD": LivenessIndex.DEAD,
+        b"": LivenessIndex.UNKNOWN,
+    }
+
+    def __init__(self, host, port, application_id, interval, index, top=10):
+        self._host = host
+        self._port = port
+        self._application_id = application_id
+        self._interval = interval
+        self._index = index
+        self._top = top
+        self._own_state_topic = "{0}/STATE".format(application_id)
+        self._client = None
+
+    def run(self):
+        asyncio.run(self._run())
+
+    async def _run(self):
+        # every state change counts, so the broker is made to wait rather than
+        # dropping any of them
+        self._client = async_mqtt.AsyncClient(self._host, self._port, queue_size=10000, overflow=async_mqtt.BLOCK)
+        self._client.on_connect = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
+        self._client.will_set(self._own_state_topic, "DEAD", retain=True)
+        await self._client.connect()
+        receiver = asyncio.ensure_future(self._receive())
+        try:
+            # summaries are due on a fixed grid, however long one takes
+            due_on = time.monotonic() + self._interval
+            while True:
+                await asyncio.sleep(max(due_on - time.monotonic(), 0))
+                self._publish_summary()
+                due_on += self._interval
+                if due_on < time.monotonic():
+                    # skip the summaries that were missed
+                    due_on = time.monotonic() + self._interval
+        finally:
+            # the monitor runs until it is cancelled, e.g. by ctrl-c
+            if self._client.connected:
+                # a clean disconnect drops the will, so publish DEAD ourselves
+                self._client.publish_nowait(self._own_state_topic, "DEAD", retain=True)
+            await self._client.close()
+            await receiver
+
+    def _publish_summary(self):
+        summary = self._index.summarize(time.monotonic(), self._top)
+        summary["timestamp"] = time.time()
+        summary["interval"] = self._interval
+        print("{0} nodes, {1} alive, {2} dead, {3} births, {4} deaths, {5} flapping".format(
+            summary["nodes"], summary["alive"], summary["dead"], summary["births"], summary["deaths"], summary["flapping"]))
+        try:
+            self._client.publish_nowait("{0}/summary".format(self._application_id), json.dumps(summary, separators=(",", ":")), qos=1, retain=True)
+        except async_mqtt.WindowFull:
+            print("The broker does not keep up, skipping the summary")
+
+    async def _receive(self):
+        async for msg in self._client:
+            self._on_message(msg)
+
+    def _on_message(self, msg):
+        state = self.STATES.get(msg.payload)
+        if state is None or msg.topic == self._own_state_topic:
+            return
+        self._index.update(msg.topic, state, time.monotonic(), msg.retain)
+
+    def _on_connect(self):
+        print("Connected to {0}:{1}".format(self._host, self._port))
+        self._client.subscribe([(topic, 1) for topic in self.STATE_TOPICS])
+        self._client.publish_nowait(self._own_state_topic, "ALIVE", retain=True)
+
+    def _on_disconnect(self):
+        print("Disconnected from {0}:{1}".format(self._host, self._port))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Monitor the liveness of all nodes that follow the state and last will convention.")
+    parser.add_argument("--host", help="the host of the mqtt broker")
+    parser.add_argument("--port", type=int, help="the port of the mqtt broker")
+    parser.add_argument("--application-id", help="the application id of the monitor, the summary is published to APPLICATION_ID/summary, defaults to liveness-monitor")
+    parser.add_argument("--interval", type=float, help="the seconds between summaries, defaults to 10.0")
+    parser.add_argument("--flap-window", type=float, help="the seconds in which a node must change its state flap-threshold times to count as flapping, defaults to 300.0")
+    parser.add_argument("--flap-threshold", type=int, help="the number of state changes within the flap window that make a node flapping, defaults to 4")
+    parser.add_argument("--flap-history", type=int, help="the number of state changes to remember per node, defaults to 8")
+    parser.add_argument("--top", type=int, help="the number of flapping nodes to list in the summary, defaults to 10")
+    args = parser.parse_args()
+
+    if args.host:
+        host = args.host
+    else:
+        host = "localhost"
+    if args.port:
+        port = args.port
+    else:
+        port = 1883
+    if args.application_id:
+        application_id = args.application_id
+    else:
+        application_id = "liveness-monitor"
+    if args.interval:
+        interval = args.interval
+    else:
+        interval = 10.0
+    if args.flap_window:
+        flap_window = args.flap_window
+    else:
+        flap_window = 300.0
+    if args.flap_threshold:
+        flap_threshold = args.flap_threshold
+    else:
+        flap_threshold = 4
+    if args.flap_history:
+        flap_history = args.flap_history
+    else:
+        flap_history = 8
+    if args.top:
+        top = args.top
+    else:
+        top = 10
+    if flap_threshold > flap_history:
+        parser.error("the flap threshold must not exceed the flap history")
+
+    index = LivenessIndex(flap_history, flap_window, flap_threshold)
+    monitor = LivenessMonitor(host, port, application_id, interval, index, top)
+    monitor.run()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+import argparse
+import time
+
+from main import HwmonBackend, SensorsCommandBackend
+
+def benchmark(name, backend, scans):
+    # warm up, the first scan may fault in pages and fill caches
+    sensors = len(list(backend.read()))
+    started_on = time.perf_counter()
+    cpu_started_on = time.process_time()
+    for _ in range(scans):
+        for _ in backend.read():
+            pass
+    elapsed = time.perf_counter() - started_on
+    cpu_elapsed = time.process_time() - cpu_started_on
+    print("{0:>8}: {1} sensors, {2:.1f} us/scan, {3:.1f} us cpu/scan".format(
+        name, sensors, elapsed / scans * 1e6, cpu_elapsed / scans * 1e6))
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the time it takes the sensor backends to scan all sensors.")
+    parser.add_argument("--scans", type=int, help="the number of scans per backend, defaults to 1000")
+    parser.add_argument("--hwmon-root", help="the hwmon sysfs directory, defaults to /sys/class/hwmon")
+    args = parser.parse_args()
+
+    if args.scans:
+        scans = args.scans
+    else:
+        scans = 1000
+    if args.hwmon_root:
+        hwmon_root = args.hwmon_root
+    else:
+        hwmon_root = "/sys/class/hwmon"
+
+    hwmon = HwmonBackend(hwmon_root)
+    if len(hwmon) > 0:
+        benchmark("hwmon", hwmon, scans)
+    else:
+        print("   hwmon: no sensors found in {0}".format(hwmon_root))
+    hwmon.close()
+    try:
+        # forking is much slower, a tenth of the scans is plenty
+        benchmark("sensors", SensorsCommandBackend(), max(scans // 10, 1))
+    except FileNotFoundError:
+        print(" sensors: the sensors command is not installed")
+
+if __name__ == "__main__":
+    main()
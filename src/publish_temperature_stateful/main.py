@@ -1,101 +1,654 @@
 #!/usr/bin/env python3
-import paho.mqtt.client as mqtt
 import argparse
+import asyncio
+import collections
+import glob
+import hashlib
+import heapq
 import json
+import os
+import random
 import re
 import socket
+import struct
 import subprocess
+import sys
+import tempfile
 import time
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+import async_mqtt
+import metrics
+import node_registry
+
+class SensorsCommandBackend:
+    # parses the human readable output of the sensors command
+    _line_pattern = re.compile("^([^:]+):[^0-9]+([0-9\\.]+)[ ]?([^ ]+)")
+
+    def read(self, sensors=None):
+        output = subprocess.check_output(["sensors"]).decode('utf8')
+        for line in output.splitlines():
+            m = self._line_pattern.match(line)
+            if m:
+                sensor = m.group(1)
+                if sensors is not None and sensor not in sensors:
+                    continue
+                raw_value = float(m.group(2))
+                unit = m.group(3)
+                yield sensor, raw_value, unit
+
+    def close(self):
+        pass
+
+
+class HwmonBackend:
+    # reads the hwmon channels that the sensors command reads from sysfs directly,
+    # the channels are discovered once and their files are kept open
+    _channel_types = {
+        "temp": (0.001, "°C"),
+        "fan": (1.0, "RPM"),
+    }
+    _input_pattern = re.compile("^(temp|fan)([0-9]+)_input$")
+
+    def __init__(self, root="/sys/class/hwmon"):
+        self._channels = []
+        for chip in sorted(glob.glob(os.path.join(root, "hwmon*"))):
+            for path in sorted(glob.glob(os.path.join(chip, "*_input"))):
+                m = self._input_pattern.match(os.path.basename(path))
+                if not m:
+                    continue
+                channel = "{0}{1}".format(m.group(1), m.group(2))
+                scale, unit = self._channel_types[m.group(1)]
+                try:
+                    with open(os.path.join(chip, "{0}_label".format(channel))) as f:
+                        sensor = f.read().strip()
+                except OSError:
+                    sensor = channel
+                try:
+                    fd = os.open(path, os.O_RDONLY)
+                except OSError:
+                    continue
+                self._channels.append((sensor, fd, scale, unit))
+
+    def __len__(self):
+        return len(self._channels)
+
+    def read(self, sensors=None):
+        for sensor, fd, scale, unit in self._channels:
+            if sensors is not None and sensor not in sensors:
+                continue
+            try:
+                raw_value = int(os.pread(fd, 32, 0)) * scale
+            except (OSError, ValueError):
+                # sensors that are powered down fail to read, skip them like the sensors command does
+                continue
+            yield sensor, raw_value, unit
+
+    def close(self):
+        for _, fd, _, _ in self._channels:
+            os.close(fd)
+        self._channels = []
+
+
+def get_quantity(unit):
+    if unit in ["RPM"]:
+        return "rate", "rotations_per_minute"
+    elif unit in ["°C"]:
+        return "temperature", "degree_celsius"
+    return None, unit
+
+
+def parse_deadbands(payload):
+    # the deadbands are a json object that maps quantities to an absolute and/or
+    # relative change that a sensor value must exceed to be published
+    deadbands = json.loads(payload)
+    if not isinstance(deadbands, dict):
+        raise ValueError("deadbands must be a json object")
+    for quantity, deadband in deadbands.items():
+        if not isinstance(deadband, dict):
+            raise ValueError("the deadband of {0} must be a json object".format(quantity))
+        for key, value in deadband.items():
+            if key not in ["absolute", "relative"]:
+                raise ValueError("the deadband of {0} has an unknown key {1}".format(quantity, key))
+            if not isinstance(value, (int, float)) or value < 0:
+                raise ValueError("the {0} deadband of {1} must be a non negative number".format(key, quantity))
+    return deadbands
+
+
+def parse_sensor_scan_rates(payload):
+    # the scan rates are a json object that maps sensors or quantities to the
+    # seconds between two scans of the matching sensors
+    scan_rates = json.loads(payload)
+    if not isinstance(scan_rates, dict):
+        raise ValueError("sensor scan rates must be a json object")
+    for key, scan_rate in scan_rates.items():
+        if not isinstance(scan_rate, (int, float)) or scan_rate <= 0:
+            raise ValueError("the scan rate of {0} must be a positive number".format(key))
+    return scan_rates
+
+
+class StoreAndForwardBuffer:
+    # holds the readings taken while disconnected until they can be replayed, the
+    # newest readings are kept in memory and the oldest ones spill over to an
+    # append only segment file, so the backlog survives long outages and restarts
+    _record = struct.Struct("!ddH")
+
+    def __init__(self, path, capacity=1000, max_spill_size=64 * 1024 * 1024):
+        self._memory = collections.deque()
+        self._capacity = capacity
+        self._max_spill_size = max_spill_size
+        self._spill = open(path, "ab")
+        self._spill_size = self._spill.tell()
+        self._replay = open(path, "rb")
+        self._replay_offset = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._memory)
+
+    def has_backlog(self):
+        return bool(self._memory) or self._replay_offset < self._spill_size
+
+    def append(self, timestamp, topic, value):
+        if len(self._memory) >= self._capacity:
+            # the spilled readings are always older than the ones in memory
+            self._write_spill(*self._memory.popleft())
+        self._memory.append((timestamp, topic, value))
+
+    def peek(self):
+        # the reading that pop returns next, it stays in the buffer
+        if self._replay_offset < self._spill_size:
+            replay_offset = self._replay_offset
+            reading = self._read_spill()
+            if reading is not None:
+                self._replay_offset = replay_offset
+                return reading
+        if self._memory:
+            return self._memory[0]
+        return None
+
+    def pop(self):
+        if self._replay_offset < self._spill_size:
+            reading = self._read_spill()
+            if reading is not None:
+                return reading
+        if self._spill_size > 0:
+            # the segment is replayed completely, start over with an empty one
+            self._spill.truncate(0)
+            self._spill_size = 0
+            self._replay_offset = 0
+        if self._memory:
+            return self._memory.popleft()
+        return None
+
+    def close(self):
+        # keep the readings in memory for the next run
+        while self._memory:
+            self._write_spill(*self._memory.popleft())
+        self._spill.close()
+        self._replay.close()
+
+    def _write_spill(self, timestamp, topic, value):
+        topic = topic.encode('utf8')
+        size = self._record.size + len(topic)
+        if self._spill_size + size > self._max_spill_size:
+            if self.dropped == 0:
+                print("The store and forward buffer is full, dropping readings")
+            self.dropped += 1
+            return
+        self._spill.write(self._record.pack(timestamp, value, len(topic)))
+        self._spill.write(topic)
+        self._spill.flush()
+        self._spill_size += size
+
+    def _read_spill(self):
+        self._replay.seek(self._replay_offset)
+        header = self._replay.read(self._record.size)
+        if len(header) < self._record.size:
+            # a record that was cut off by a crash
+            self._replay_offset = self._spill_size
+            return None
+        timestamp, value, topic_length = self._record.unpack(header)
+        topic = self._replay.read(topic_length)
+        if len(topic) < topic_length:
+            self._replay_offset = self._spill_size
+            return None
+        self._replay_offset += self._record.size + topic_length
+        return timestamp, topic.decode('utf8'), value
+
+
+class RollingWindows:
+    # The samples of the last length sample periods of every sensor in a
+    # preallocated ring, one row per sensor and one column per sample. A sensor
+    # that was not read in a sample period has no value in its column.
+    def __init__(self, sensors, length):
+        self.sensors = list(sensors)
+        self._rows = {sensor: row for row, sensor in enumerate(self.sensors)}
+        self._samples = numpy.full((len(self.sensors), length), numpy.nan)
+        self._position = 0
+        self._filled = 0
+
+    def __len__(self):
+        return self._samples.shape[1]
+
+    def append(self, readings):
+        column = self._samples[:, self._position]
+        column.fill(numpy.nan)
+        for sensor, value in readings:
+            row = self._rows.get(sensor)
+            if row is not None:
+                column[row] = value
+        self._position = (self._position + 1) % len(self)
+        self._filled = min(self._filled + 1, len(self))
+
+    def _ordered(self):
+        # the samples from the oldest to the newest
+        if self._filled < len(self):
+            return self._samples[:, :self._filled]
+        return numpy.concatenate((self._samples[:, self._position:], self._samples[:, :self._position]), axis=1)
+
+    def resize(self, length):
+        # keeps the newest samples that fit
+        samples = self._ordered()[:, -length:]
+        self._samples = numpy.full((len(self.sensors), length), numpy.nan)
+        self._filled = samples.shape[1]
+        self._samples[:, :self._filled] = samples
+        self._position = self._filled % length
+
+    def summarize(self):
+        # the min, max, mean and 95th percentile of the samples of every sensor
+        # that has samples in the window, all sensors at once
+        samples = self._samples[:, :self._filled]
+        counts = numpy.count_nonzero(~numpy.isnan(samples), axis=1)
+        rows = numpy.flatnonzero(counts)
+        if len(rows) == 0:
+            return {}
+        samples = samples[rows]
+        minimums = numpy.nanmin(samples, axis=1)
+        maximums = numpy.nanmax(samples, axis=1)
+        means = numpy.nanmean(samples, axis=1)
+        p95s = numpy.nanpercentile(samples, 95, axis=1)
+        summary = {}
+        for i, row in enumerate(rows.tolist()):
+            summary[self.sensors[row]] = {
+                "min": float(minimums[i]),
+                "max": float(maximums[i]),
+                "mean": round(float(means[i]), 3),
+                "p95": round(float(p95s[i]), 3),
+                "samples": int(counts[row]),
+            }
+        return summary
+
+
+def create_sensor_backend(name):
+    if name == "hwmon":
+        backend = HwmonBackend()
+        if len(backend) > 0:
+            return backend
+        print("No hwmon sensors found, falling back to the sensors command")
+    return SensorsCommandBackend()
+
+
 class SensorNode:
-    def __init__(self, host, port, application_id, scan_rate):
+    # a scan publishes every sensor at once, the window leaves room for many scans
+    MAX_INFLIGHT = 1000
+    # the node only receives commands and property changes, the newest ones count
+    QUEUE_SIZE = 100
+    # marks the publication of the aggregates in the schedule of the aggregation mode
+    AGGREGATE = "aggregate"
+    MAX_WINDOW = 3600.0
+    MIN_SCAN_RATE = 1.0
+
+    def __init__(self, host, port, application_id, scan_rate, sensor_backend, deadbands=None, max_silence=60.0, rebirth_holdoff=1.0, sensor_scan_rates=None, buffer=None, replay_rate=50.0, metrics=None, metrics_interval=60.0, metrics_file=None, sample_rate=None, window=None):
         self._host = host
         self._port = port
         self._application_id = application_id
         self._scan_rate = scan_rate
+        # sensors or quantities that are scanned at their own rate instead of the scan rate
+        self._sensor_scan_rates = sensor_scan_rates or {}
+        # a heap of the next scans, each one is due on, a tie breaker, its scan
+        # rate and the sensors it scans or None for all remaining sensors
+        self._schedule = []
+        self._dedicated_sensors = set()
+        self._reschedule = True
+        # wakes the scheduler up early, e.g. to shut down or to reschedule
+        self._wakeup = asyncio.Event()
+        # readings taken while disconnected are replayed at the replay rate after reconnecting
+        self._buffer = buffer
+        self._replay_rate = replay_rate
+        self._replay_interval = 0.1
+        self._replay_due_on = 0
+        self._sensor_backend = sensor_backend
+        # sensors of quantities without a deadband are published on every scan
+        self._deadbands = deadbands or {}
+        self._max_silence = max_silence
+        # the last published value of each sensor and when it was published
+        self._last_published_values = {}
+        # the encoded birth and its version, rebuilt only when the sensors change
+        self._birth = None
+        self._birth_sensors = None
+        self._rebirth_holdoff = rebirth_holdoff
+        self._rebirth_due_on = None
+        # readings that neither fit into the window nor into the buffer
+        self._dropped = 0
         self._connected = False
+        # readings are only buffered once the node lost a connection, the ones taken
+        # before the first connect are published as current values on connect
+        self._was_connected = False
         self._alive = False
         self._client = None
-        self._last_published_on = 0
+        self._loop = None
+        # with a sample rate the sensors are sampled at the sample rate into rolling
+        # windows, and a summary of the windows is published at the scan rate
+        # instead of the readings
+        self._sample_rate = sample_rate
+        self._window = window or scan_rate
+        self._windows = None
+        # the metrics are published retained to <id>/metrics and written to the
+        # metrics file every metrics interval, without metrics nothing is measured
+        self._metrics = metrics
+        self._metrics_interval = metrics_interval
+        self._metrics_file = metrics_file
+        self._read_seconds = None
+        self._scans = None
+        if metrics is not None:
+            self._read_seconds = metrics.histogram("sensor_read_seconds", "Seconds to read the sensors of a scan.")
+            self._scans = metrics.counter("sensor_scans_total", "Scans of the sensors.")
+            metrics.counter("sensor_readings_dropped_total", "Readings that neither fit into the window nor into the buffer.", lambda: self._dropped)
+            if buffer is not None:
+                metrics.gauge("sensor_buffered", "Readings in the memory of the store and forward buffer.", lambda: len(buffer))
+                metrics.counter("sensor_buffer_dropped_total", "Readings dropped because the buffer file is full.", lambda: buffer.dropped)
+        self._registry = self._create_registry()
+
+    def _create_registry(self):
+        registry = node_registry.NodeRegistry(self._application_id, lambda topic, payload: self._publish_application_topic(topic, payload, retain=True))
+        registry.add_command("rebirth", self._request_rebirth)
+        registry.add_command("shutdown", self._shutdown)
+        registry.add_property("scan_rate", "numeric", lambda: self._scan_rate, self._set_scan_rate, minimum=self.MIN_SCAN_RATE, quantity="duration", unit="seconds")
+        registry.add_property("deadband", "json", lambda: self._deadbands, self._set_deadbands, parse=parse_deadbands, format=json.dumps)
+        if self._sample_rate is not None:
+            registry.add_property("window", "numeric", lambda: self._window, self._set_window, minimum=self._sample_rate, maximum=self.MAX_WINDOW, quantity="duration", unit="seconds")
+        return registry
 
     def run(self):
-        self._client = mqtt.Client()
-        self._client.on_connect = self._on_connect
-        self._client.on_message = self._on_message
-        self._client.on_disconnect = self._on_disconnect
-        self._client.will_set("{0}/STATE".format(self._application_id), "DEAD", retain=True)
-        self._client.connect(self._host, self._port, 60)
-        self._client.loop_start()
+        asyncio.run(self._run())
+
+    async def _run(self):
+        self._loop = asyncio.get_running_loop()
+        self._client = self._create_client()
+        self._client.start()
+        receiver = asyncio.ensure_future(self._receive())
+        reporter = None
+        if self._metrics is not None and self._metrics_interval > 0:
+            reporter = asyncio.ensure_future(metrics.report(self._metrics, self._client, self._get_application_topic("metrics"), self._metrics_interval, self._metrics_file))
         self._alive = True
         while self._alive:
-            if time.time() - self._last_published_on > self._scan_rate:
-                self._publish_sensors()
-                self._last_published_on = time.time()
-            time.sleep(0.1)
-        self._client.loop_stop()
+            next_due_on = self._run_due()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(next_due_on - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+        if reporter is not None:
+            reporter.cancel()
+        if self._connected:
+            # a clean disconnect drops the will, so publish DEAD ourselves
+            self._publish_application_topic("STATE", "DEAD", retain=True)
+        await self._client.close()
+        await receiver
         self._client = None
+        self._sensor_backend.close()
+        if self._buffer is not None:
+            self._buffer.close()
         self._alive = False
-    
-    def _subscribe_application_topic(self, topic, qos=0):
-        self._client.subscribe(self._get_application_topic(topic), qos)
+
+    def _create_client(self):
+        client = async_mqtt.AsyncClient(self._host, self._port, max_inflight=self.MAX_INFLIGHT, queue_size=self.QUEUE_SIZE, overflow=async_mqtt.DROP_OLDEST)
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        client.will_set("{0}/STATE".format(self._application_id), "DEAD", retain=True)
+        if self._metrics is not None:
+            client.register_metrics(self._metrics)
+        return client
+
+    async def _receive(self):
+        async for msg in self._client:
+            self._on_message(msg)
+
+    def _run_due(self):
+        # runs the scans, the birth and the replay that are due and returns when
+        # the next one is due
+        if self._reschedule:
+            self._reschedule = False
+            self._schedule_scans()
+        now = time.monotonic()
+        while self._schedule[0][0] <= now:
+            due_on, key, scan_rate, sensors = heapq.heappop(self._schedule)
+            if self._sample_rate is None:
+                self._publish_sensors(sensors)
+            elif sensors == self.AGGREGATE:
+                self._publish_aggregates()
+            else:
+                self._sample_sensors()
+            # the next scan is due relative to this deadline rather than to now so
+            # that scans do not drift, scans that were missed are skipped
+            missed = int((now - due_on) // scan_rate)
+            heapq.heappush(self._schedule, (due_on + (missed + 1) * scan_rate, key, scan_rate, sensors))
+        rebirth_due_on = self._rebirth_due_on
+        if rebirth_due_on is not None and now >= rebirth_due_on:
+            self._rebirth_due_on = None
+            self._publish_birth()
+            rebirth_due_on = None
+        next_due_on = self._schedule[0][0]
+        if rebirth_due_on is not None:
+            next_due_on = min(next_due_on, rebirth_due_on)
+        if self._connected and self._buffer is not None and self._buffer.has_backlog():
+            if now >= self._replay_due_on:
+                self._replay_backlog()
+                self._replay_due_on = now + self._replay_interval
+            next_due_on = min(next_due_on, self._replay_due_on)
+        return next_due_on
 
     def _publish_application_topic(self, topic, payload=None, qos=0, retain=False):
-        self._client.publish(self._get_application_topic(topic), payload, qos, retain)
+        # returns False if the window is full because the broker does not keep up
+        try:
+            self._client.publish_nowait(self._get_application_topic(topic), payload, qos, retain)
+        except async_mqtt.WindowFull:
+            return False
+        return True
 
-    def _read_sensors(self):
-        sensors = subprocess.check_output(["sensors"]).decode('utf8')
-        for line in sensors.splitlines():
-            m = re.match("^([^:]+):[^0-9]+([0-9\.]+)[ ]?([^ ]+)", line)
-            if m:
-                sensor = m.group(1)
-                raw_value = float(m.group(2))
-                unit = m.group(3)
-                yield sensor, raw_value, unit
+    def _read_sensors(self, sensors=None):
+        if self._read_seconds is None:
+            return self._sensor_backend.read(sensors)
+        # the backends read lazily, so the readings are taken before they are timed
+        started_on = time.perf_counter()
+        readings = list(self._sensor_backend.read(sensors))
+        self._read_seconds.observe(time.perf_counter() - started_on)
+        return readings
+
+    def _wake_up(self, reschedule=False):
+        if reschedule:
+            self._reschedule = True
+        self._wakeup.set()
+
+    def _schedule_scans(self):
+        if self._birth_sensors is None:
+            self._update_birth([(sensor, unit) for sensor, _, unit in self._read_sensors()])
+        now = time.monotonic()
+        if self._sample_rate is not None:
+            # sampling starts right away, the first summary is due after a scan rate
+            if self._windows is None or self._windows.sensors != [sensor for sensor, _ in self._birth_sensors]:
+                self._windows = RollingWindows([sensor for sensor, _ in self._birth_sensors], self._get_window_length())
+            self._schedule = [(now, 0, self._sample_rate, None), (now + self._scan_rate, 1, self._scan_rate, self.AGGREGATE)]
+            heapq.heapify(self._schedule)
+            return
+        groups = {}
+        for sensor, unit in self._birth_sensors:
+            quantity, _ = get_quantity(unit)
+            scan_rate = self._sensor_scan_rates.get(sensor, self._sensor_scan_rates.get(quantity))
+            if scan_rate is not None and scan_rate != self._scan_rate:
+                groups.setdefault(scan_rate, set()).add(sensor)
+        self._dedicated_sensors = set()
+        for sensors in groups.values():
+            self._dedicated_sensors |= sensors
+        # all scans are due immediately, the remaining sensors are scanned at the scan rate
+        self._schedule = [(now, 0, self._scan_rate, None)]
+        for key, (scan_rate, sensors) in enumerate(sorted(groups.items()), 1):
+            self._schedule.append((now, key, scan_rate, frozenset(sensors)))
+        heapq.heapify(self._schedule)
+
+    def _get_window_length(self):
+        return max(int(round(self._window / self._sample_rate)), 1)
 
     def _get_application_topic(self, topic):
         return "{0}/{1}".format(self._application_id, topic)
 
-    def _publish_scan_rate(self):
-        self._publish_application_topic("property/scan_rate", "{0}".format(scan_rate))
+    def _set_scan_rate(self, scan_rate):
+        self._scan_rate = scan_rate
+        self._wake_up(reschedule=True)
+
+    def _set_window(self, window):
+        self._window = window
+        self._windows.resize(self._get_window_length())
 
-    def _publish_sensors(self):
-        for sensor, value, unit in self._read_sensors():
+    def _set_deadbands(self, deadbands):
+        self._deadbands = deadbands
+
+    def _is_exception(self, sensor, value, unit, now):
+        quantity, _ = get_quantity(unit)
+        deadband = self._deadbands.get(quantity)
+        if deadband is None:
+            return True
+        last_published = self._last_published_values.get(sensor)
+        if last_published is None:
+            return True
+        last_value, last_published_on = last_published
+        if now - last_published_on >= self._max_silence:
+            # heartbeat, let subscribers know that the sensor is still there
+            return True
+        change = abs(value - last_value)
+        if "absolute" not in deadband and "relative" not in deadband:
+            return change > 0
+        if "absolute" in deadband and change > deadband["absolute"]:
+            return True
+        if "relative" in deadband and change > deadband["relative"] * abs(last_value):
+            return True
+        return False
+
+    def _publish_sensors(self, sensors=None):
+        # a scan of all sensors discovers new sensors, the ones with a scan rate of their own are not published by it
+        now = time.monotonic()
+        discovered = []
+        if self._scans is not None:
+            self._scans.inc()
+        for sensor, value, unit in self._read_sensors(sensors):
+            if sensors is None:
+                discovered.append((sensor, unit))
+                if sensor in self._dedicated_sensors:
+                    continue
+            if not self._is_exception(sensor, value, unit, now):
+                continue
+            self._last_published_values[sensor] = (value, now)
             topic = "property/{0}".format(sensor)
+            if not self._connected and self._buffer is not None:
+                if self._was_connected:
+                    self._buffer.append(time.time(), topic, value)
+                continue
             payload = "{0}".format(value)
-            self._publish_application_topic(topic, payload)
-
-    def _get_birth_topics(self):
-        yield {
-            "topic": self._get_application_topic("command/rebirth"),
-            "modes": ["sub"],
-            "type": "null",
-        }
-        yield {
-            "topic": self._get_application_topic("command/shutdown"),
-            "modes": ["sub"],
-            "type": "null",
-        }
-        yield {
-            "topic": self._get_application_topic("property/scan_rate"),
-            "modes": ["pub"],
-            "type": "numeric",
-            "quantity": "duration",
-            "unit": "seconds",
-        }
-        yield {
-            "topic": self._get_application_topic("property/scan_rate/set"),
-            "modes": ["sub"],
-            "type": "numeric",
-            "quantity": "duration",
-            "unit": "seconds",
-        }
+            if not self._publish_application_topic(topic, payload):
+                # keep the reading like one taken while disconnected
+                if self._buffer is not None:
+                    self._buffer.append(time.time(), topic, value)
+                else:
+                    if self._dropped == 0:
+                        print("The broker does not keep up, dropping readings")
+                    self._dropped += 1
+        if sensors is None and discovered != self._birth_sensors:
+            if self._birth_sensors is not None:
+                print("The sensors changed, publishing a new birth")
+                self._reschedule = True
+            self._update_birth(discovered)
+            if self._connected:
+                self._publish_birth()
+
+    def _sample_sensors(self):
+        discovered = []
+        samples = []
         for sensor, value, unit in self._read_sensors():
-            if unit in ["RPM"]:
-                quantity = "rate"
-                unit = "rotations_per_minute"
-            elif unit in ["°C"]:
-                quantity = "temperature"
-                unit = "degree_celsius"
+            discovered.append((sensor, unit))
+            samples.append((sensor, value))
+        if discovered != self._birth_sensors:
+            # the windows of the new sensors start over
+            print("The sensors changed, publishing a new birth")
+            self._update_birth(discovered)
+            self._windows = RollingWindows([sensor for sensor, _ in discovered], self._get_window_length())
+            if self._connected:
+                self._publish_birth()
+        self._windows.append(samples)
+
+    def _publish_aggregates(self):
+        # the summaries of windows that end while disconnected are not kept, the
+        # next one covers the window again
+        if not self._connected:
+            return
+        summary = self._windows.summarize()
+        if not summary:
+            return
+        payload = json.dumps({"timestamp": time.time(), "window": self._window, "sensors": summary}, separators=(",", ":"))
+        if not self._publish_application_topic("aggregate", payload):
+            if self._dropped == 0:
+                print("The broker does not keep up, dropping aggregates")
+            self._dropped += 1
+
+    def _replay_backlog(self):
+        # the backlog is replayed into the room that is left in the window
+        count = max(int(self._replay_rate * self._replay_interval), 1)
+        for _ in range(min(count, self._client.max_inflight - self._client.in_flight)):
+            reading = self._buffer.peek()
+            if reading is None:
+                break
+            timestamp, topic, value = reading
+            payload = json.dumps({"timestamp": timestamp, "value": value})
+            if not self._publish_application_topic("history/{0}".format(topic), payload, qos=1):
+                # the reading stays in the buffer until there is room in the window again
+                break
+            self._buffer.pop()
+
+    def _get_birth_topics(self, sensors):
+        yield from self._registry.get_birth_topics()
+        if self._metrics is not None and self._metrics_interval > 0:
+            yield {
+                "topic": self._get_application_topic("metrics"),
+                "modes": ["pub"],
+                "type": "json",
+            }
+        if self._buffer is not None:
+            yield {
+                "topic": self._get_application_topic("history/#"),
+                "modes": ["pub"],
+                "type": "json",
+            }
+        if self._sample_rate is not None:
+            # the sensors are published as part of the aggregates only
+            aggregated = []
+            for sensor, unit in sensors:
+                quantity, unit = get_quantity(unit)
+                aggregated.append({"sensor": sensor, "quantity": quantity, "unit": unit})
+            yield {
+                "topic": self._get_application_topic("aggregate"),
+                "modes": ["pub"],
+                "type": "json",
+                "statistics": ["min", "max", "mean", "p95"],
+                "sensors": aggregated,
+            }
+            return
+        for sensor, unit in sensors:
+            quantity, unit = get_quantity(unit)
             yield {
                 "topic": self._get_application_topic("property/{0}".format(sensor)),
                 "modes": ["pub"],
@@ -104,41 +657,56 @@ class SensorNode:
                 "unit": unit,
             }
 
+    def _update_birth(self, sensors):
+        payload = json.dumps(list(self._get_birth_topics(sensors)), separators=(",", ":")).encode('utf8')
+        version = hashlib.sha1(payload).hexdigest()[:16]
+        self._birth = (payload, version)
+        self._birth_sensors = sensors
+
     def _publish_birth(self):
+        if self._birth is None:
+            self._update_birth([(sensor, unit) for sensor, _, unit in self._read_sensors()])
+        payload, version = self._birth
         self._publish_application_topic("STATE", "ALIVE", retain=True)
-        self._publish_application_topic("BIRTH", json.dumps(list(self._get_birth_topics()), indent=2), retain=True)
+        self._publish_application_topic("BIRTH", payload, retain=True)
+        # lets subscribers tell whether the birth changed without parsing it
+        self._publish_application_topic("BIRTH/version", version, retain=True)
+
+    def _request_rebirth(self):
+        # coalesce bursts of rebirth requests into a single birth, the jitter spreads
+        # the births of a fleet that was asked to rebirth at once
+        if self._rebirth_due_on is None:
+            print("Publishing birth as requested from remote")
+            self._rebirth_due_on = time.monotonic() + self._rebirth_holdoff * random.uniform(0.5, 1.0)
+            self._wake_up()
 
-    # The callback for when a PUBLISH message is received from the server.
-    def _on_message(self, client, userdata, msg):
+    def _shutdown(self):
+        print("Shutting down by remote request")
+        self._alive = False
+        self._wake_up()
+
+    # Called for every message received from the server.
+    def _on_message(self, msg):
         try:
-            if msg.topic == self._get_application_topic("property/scan_rate/set"):
-                new_scan_rate = float(msg.payload.decode('utf-8'))
-                if new_scan_rate >= 1.0:
-                    print("Changing scan rate from {0} to {1}".format(self._scan_rate, new_scan_rate))
-                    self._scan_rate = new_scan_rate
-                else:
-                    print("Refusing to change the scan rate below 1.0")
-            elif msg.topic == self._get_application_topic("command/shutdown"):
-                print("Shutting down by remote request")
-                self._alive = False
-            elif msg.topic == self._get_application_topic("command/rebirth"):
-                print("Publishing birth as requested from remote")
-                self._publish_birth()
-            else:
+            if not self._registry.dispatch(msg):
                 print("Received an unhandled message on topic {0}".format(msg.topic))
         except Exception as ex:
             print("An unhandled exception occurred while processing a message on topic {0}: {1}".format(msg.topic, ex))
 
-    def _on_connect(self, client, userdata, flags, rc):
+    def _on_connect(self):
         print("Connected to {0}:{1}".format(self._host, self._port))
-        self._subscribe_application_topic("command/rebirth")
-        self._subscribe_application_topic("command/shutdown")
-        self._subscribe_application_topic("property/scan_rate/set")
+        self._client.subscribe(self._registry.get_subscriptions())
         self._publish_birth()
-        self._last_published_on = 0
+        self._registry.publish_all()
+        # subscribers may have missed values while we were away, publish all of them again
+        self._last_published_values = {}
+        # spread the replays of a fleet that reconnects at once
+        self._replay_due_on = time.monotonic() + random.uniform(0, 1.0)
         self._connected = True
+        self._was_connected = True
+        self._wake_up(reschedule=True)
 
-    def _on_disconnect(self, client, userdata, rc):
+    def _on_disconnect(self):
         print("Disconnected from {0}:{1}".format(self._host, self._port))
         self._connected = False
 
@@ -148,6 +716,20 @@ def main():
     parser.add_argument("--port", type=int, help="the port of the mqtt broker")
     parser.add_argument("--application-id", help="a custom application id, defaults to the hostname of the machine")
     parser.add_argument("--scan-rate", type=float, help="the initial scan rate, defaults to 1.0")
+    parser.add_argument("--deadband", help="a json object that maps quantities to the absolute and/or relative change required to publish a sensor, e.g. '{\"temperature\": {\"absolute\": 0.5}}', defaults to publishing on every scan")
+    parser.add_argument("--max-silence", type=float, help="the seconds after which a sensor is published even if it did not change, defaults to 60.0")
+    parser.add_argument("--rebirth-holdoff", type=float, help="the seconds to collect rebirth requests before publishing a single birth, defaults to 1.0")
+    parser.add_argument("--sensor-scan-rates", help="a json object that maps sensors or quantities to their own scan rate, e.g. '{\"rate\": 10}'")
+    parser.add_argument("--buffer-size", type=int, help="the number of readings taken while disconnected that are kept in memory, defaults to 1000, 0 disables store and forward")
+    parser.add_argument("--buffer-file", help="the file older readings taken while disconnected spill over to, defaults to APPLICATION_ID.buffer in the temporary directory")
+    parser.add_argument("--buffer-max-bytes", type=int, help="the maximum size of the buffer file, defaults to 64 MiB")
+    parser.add_argument("--replay-rate", type=float, help="the readings per second that are replayed after reconnecting, defaults to 50")
+    parser.add_argument("--aggregate", action="store_true", help="sample the sensors at the sample rate and publish the min, max, mean and 95th percentile of each sensor over the window to APPLICATION_ID/aggregate at the scan rate instead of the readings, needs numpy")
+    parser.add_argument("--sample-rate", type=float, help="the seconds between two samples when aggregating, defaults to 0.1")
+    parser.add_argument("--window", type=float, help="the seconds of samples that are summarized when aggregating, defaults to the scan rate")
+    parser.add_argument("--metrics-interval", type=float, help="the seconds between publishing the metrics to APPLICATION_ID/metrics, defaults to 60.0, 0 disables the metrics")
+    parser.add_argument("--metrics-file", help="a file the metrics are written to in the prometheus text format every metrics interval, e.g. for the textfile collector of the node exporter")
+    parser.add_argument("--sensor-backend", choices=["hwmon", "sensors"], help="read sensors from sysfs or by running the sensors command, defaults to hwmon")
     args = parser.parse_args()
 
     if args.host:
@@ -166,7 +748,72 @@ def main():
         scan_rate = args.scan_rate
     else:
         scan_rate = 1.0
-    sensor_node = SensorNode(host, port, application_id, scan_rate)
+    if args.sensor_backend:
+        sensor_backend = args.sensor_backend
+    else:
+        sensor_backend = "hwmon"
+    if args.deadband:
+        deadbands = parse_deadbands(args.deadband)
+    else:
+        deadbands = {}
+    if args.max_silence:
+        max_silence = args.max_silence
+    else:
+        max_silence = 60.0
+    if args.rebirth_holdoff is not None:
+        rebirth_holdoff = args.rebirth_holdoff
+    else:
+        rebirth_holdoff = 1.0
+    if args.sensor_scan_rates:
+        sensor_scan_rates = parse_sensor_scan_rates(args.sensor_scan_rates)
+    else:
+        sensor_scan_rates = {}
+    if args.buffer_size is not None:
+        buffer_size = args.buffer_size
+    else:
+        buffer_size = 1000
+    if args.buffer_file:
+        buffer_file = args.buffer_file
+    else:
+        buffer_file = os.path.join(tempfile.gettempdir(), "{0}.buffer".format(application_id))
+    if args.buffer_max_bytes:
+        buffer_max_bytes = args.buffer_max_bytes
+    else:
+        buffer_max_bytes = 64 * 1024 * 1024
+    if args.replay_rate:
+        replay_rate = args.replay_rate
+    else:
+        replay_rate = 50.0
+    if args.aggregate:
+        if numpy is None:
+            parser.error("aggregating needs numpy, install it with pip3 install numpy")
+        if args.sample_rate:
+            sample_rate = args.sample_rate
+        else:
+            sample_rate = 0.1
+        if args.window:
+            window = args.window
+        else:
+            window = scan_rate
+        if window < sample_rate or window > SensorNode.MAX_WINDOW:
+            parser.error("the window must be between the sample rate and {0} seconds".format(SensorNode.MAX_WINDOW))
+    else:
+        sample_rate = None
+        window = None
+    if args.metrics_interval is not None:
+        metrics_interval = args.metrics_interval
+    else:
+        metrics_interval = 60.0
+    if metrics_interval > 0:
+        node_metrics = metrics.Metrics({"application_id": application_id})
+    else:
+        node_metrics = None
+    if buffer_size > 0:
+        buffer = StoreAndForwardBuffer(buffer_file, buffer_size, buffer_max_bytes)
+    else:
+        buffer = None
+    sensor_node = SensorNode(host, port, application_id, scan_rate, create_sensor_backend(sensor_backend), deadbands, max_silence, rebirth_holdoff, sensor_scan_rates, buffer, replay_rate, node_metrics, metrics_interval, args.metrics_file, sample_rate, window)
     sensor_node.run()
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -10,7 +10,7 @@ then
     # activate venv
     source $ACTIVATE
     # install requirements
-    pip3 install paho-mqtt
+    pip3 install paho-mqtt numpy
 else
     source $ACTIVATE
 fi
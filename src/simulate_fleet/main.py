@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import concurrent.futures
+import importlib.util
+import math
+import multiprocessing
+import os
+import random
+import resource
+import signal
+import sys
+import time
+import zlib
+
+DIRNAME = os.path.dirname(os.path.abspath(__file__))
+
+def load_program(name):
+    # the nodes are the real ones, loaded from the main.py of their program
+    spec = importlib.util.spec_from_file_location(name, os.path.join(DIRNAME, "..", name, "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+application_state = load_program("application_state")
+publish_temperature_stateful = load_program("publish_temperature_stateful")
+
+
+class SimulatedSensorBackend:
+    # a seeded model of a machine instead of the sensors command, the cores heat
+    # up and cool down with a slow load curve and the fans follow the load
+    def __init__(self, seed, cores=4, fans=2):
+        self._random = random.Random(seed)
+        self._phase = self._random.uniform(0, 2 * math.pi)
+        self._period = self._random.uniform(300, 900)
+        self._cores = [("Core {0}".format(i), self._random.uniform(30, 45)) for i in range(cores)]
+        self._fans = [("fan{0}".format(i + 1), self._random.uniform(600, 1000)) for i in range(fans)]
+
+    def read(self, sensors=None):
+        load = 0.5 + 0.5 * math.sin(2 * math.pi * time.monotonic() / self._period + self._phase)
+        for sensor, idle in self._cores:
+            if sensors is None or sensor in sensors:
+                yield sensor, round(idle + 35 * load + self._random.gauss(0, 0.3), 1), "°C"
+        for sensor, idle in self._fans:
+            if sensors is None or sensor in sensors:
+                yield sensor, float(round(idle + 1800 * load + self._random.gauss(0, 20))), "RPM"
+
+    def close(self):
+        pass
+
+
+class FleetProcess:
+    # Runs many nodes in a single event loop. The nodes run like they do on their
+    # own, the process ramps them up, churns them and counts what they do.
+    # Connecting blocks, so connects run on a few worker threads.
+    CONNECT_THREADS = 8
+
+    def __init__(self, nodes, connect_rate, churn_rate, churn_mode, downtime, stats, index, stop):
+        self._nodes = nodes
+        self._connect_rate = connect_rate
+        self._churn_rate = churn_rate
+        self._churn_mode = churn_mode
+        self._downtime = downtime
+        self._stats = stats
+        self._index = index
+        self._stop = stop
+        self._random = random.Random(index)
+
+    def run(self):
+        # the fleet shuts down when the parent tells it to
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        asyncio.run(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(max_workers=self.CONNECT_THREADS))
+        # ramp up instead of connecting all nodes at once
+        tasks = [asyncio.ensure_future(self._run_node(node, i / self._connect_rate)) for i, node in enumerate(self._nodes)]
+        if self._churn_rate > 0:
+            tasks.append(asyncio.ensure_future(self._churn()))
+        while not self._stop.is_set():
+            await asyncio.sleep(1.0)
+            self._count()
+        # the nodes are cancelled and their sockets close with the process, so the
+        # broker publishes the wills as it would for nodes that were shut down
+
+    async def _run_node(self, node, delay):
+        await asyncio.sleep(delay)
+        await node._run()
+
+    async def _churn(self):
+        while True:
+            await asyncio.sleep(self._random.expovariate(self._churn_rate))
+            client = self._random.choice(self._nodes)._client
+            if client is None or not client.connected:
+                continue
+            # an abrupt drop is like a node that loses its network, the broker
+            # publishes its will
+            client.drop(self._churn_mode == "clean", self._downtime)
+
+    def _count(self):
+        connected = 0
+        published = 0
+        disconnects = 0
+        for node in self._nodes:
+            client = node._client
+            if client is None:
+                continue
+            connected += client.connected
+            published += client.published
+            disconnects += client.disconnects
+        self._stats[self._index * 3] = connected
+        self._stats[self._index * 3 + 1] = published
+        self._stats[self._index * 3 + 2] = disconnects
+
+
+def create_nodes(host, port, application_ids, sensor_nodes, scan_rate, deadbands, seed):
+    nodes = []
+    for i, application_id in enumerate(application_ids):
+        if i < sensor_nodes:
+            backend = SimulatedSensorBackend(zlib.crc32("{0}/{1}".format(seed, application_id).encode('utf8')))
+            nodes.append(publish_temperature_stateful.SensorNode(host, port, application_id, scan_rate, backend, deadbands))
+        else:
+            nodes.append(application_state.SomeNode(host, port, application_id))
+    return nodes
+
+def run_process(host, port, application_ids, sensor_nodes, scan_rate, deadbands, seed, connect_rate, churn_rate, churn_mode, downtime, stats, index, stop, verbose):
+    if not verbose:
+        # every node prints its connects and disconnects
+        sys.stdout = open(os.devnull, "w")
+    nodes = create_nodes(host, port, application_ids, sensor_nodes, scan_rate, deadbands, seed)
+    FleetProcess(nodes, connect_rate, churn_rate, churn_mode, downtime, stats, index, stop).run()
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a fleet of sensor nodes and application state nodes.")
+    parser.add_argument("--host", help="the host of the mqtt broker")
+    parser.add_argument("--port", type=int, help="the port of the mqtt broker")
+    parser.add_argument("--sensor-nodes", type=int, help="the number of sensor nodes, defaults to 100")
+    parser.add_argument("--some-nodes", type=int, help="the number of application state nodes, defaults to 0")
+    parser.add_argument("--id-prefix", help="the prefix of the application ids, defaults to sim")
+    parser.add_argument("--processes", type=int, help="the number of processes to spread the nodes over, defaults to the number of cpus")
+    parser.add_argument("--scan-rate", type=float, help="the scan rate of the sensor nodes, defaults to 1.0")
+    parser.add_argument("--deadband", help="the deadbands of the sensor nodes as a json object, see publish_temperature_stateful")
+    parser.add_argument("--seed", type=int, help="the seed of the simulated sensor values, defaults to 0")
+    parser.add_argument("--connect-rate", type=float, help="the number of nodes that connect per second while ramping up, defaults to 500")
+    parser.add_argument("--churn-rate", type=float, help="the number of nodes that disconnect per second, defaults to 0")
+    parser.add_argument("--churn-mode", choices=["abrupt", "clean"], help="abrupt disconnects make the broker publish the will, clean ones do not, defaults to abrupt")
+    parser.add_argument("--downtime", type=float, help="the seconds a node stays disconnected after a churn, defaults to 5.0")
+    parser.add_argument("--duration", type=float, help="the seconds to run, defaults to running until interrupted")
+    parser.add_argument("--report-interval", type=float, help="the seconds between reports, defaults to 5.0")
+    parser.add_argument("--verbose", action="store_true", help="let the nodes print what they do")
+    args = parser.parse_args()
+
+    if args.host:
+        host = args.host
+    else:
+        host = "localhost"
+    if args.port:
+        port = args.port
+    else:
+        port = 1883
+    if args.sensor_nodes is not None:
+        sensor_nodes = args.sensor_nodes
+    else:
+        sensor_nodes = 100
+    if args.some_nodes:
+        some_nodes = args.some_nodes
+    else:
+        some_nodes = 0
+    if args.id_prefix:
+        id_prefix = args.id_prefix
+    else:
+        id_prefix = "sim"
+    if args.processes:
+        processes = args.processes
+    else:
+        processes = os.cpu_count()
+    if args.scan_rate:
+        scan_rate = args.scan_rate
+    else:
+        scan_rate = 1.0
+    if args.deadband:
+        deadbands = publish_temperature_stateful.parse_deadbands(args.deadband)
+    else:
+        deadbands = {}
+    if args.seed:
+        seed = args.seed
+    else:
+        seed = 0
+    if args.connect_rate:
+        connect_rate = args.connect_rate
+    else:
+        connect_rate = 500.0
+    if args.churn_rate:
+        churn_rate = args.churn_rate
+    else:
+        churn_rate = 0.0
+    if args.churn_mode:
+        churn_mode = args.churn_mode
+    else:
+        churn_mode = "abrupt"
+    if args.downtime is not None:
+        downtime = args.downtime
+    else:
+        downtime = 5.0
+    if args.report_interval:
+        report_interval = args.report_interval
+    else:
+        report_interval = 5.0
+
+    total = sensor_nodes + some_nodes
+    processes = max(min(processes, total), 1)
+    application_ids = ["{0}-{1:06d}".format(id_prefix, i) for i in range(total)]
+    # connected nodes, publishes and disconnects of each process
+    stats = multiprocessing.Array("q", processes * 3, lock=False)
+    stop = multiprocessing.Event()
+    workers = []
+    for index in range(processes):
+        # every process gets its share of both kinds of nodes
+        ids = application_ids[index:sensor_nodes:processes]
+        ids += application_ids[sensor_nodes + index::processes]
+        worker = multiprocessing.Process(target=run_process, args=(
+            host, port, ids, len(application_ids[index:sensor_nodes:processes]), scan_rate, deadbands, seed,
+            connect_rate / processes, churn_rate / processes, churn_mode, downtime, stats, index, stop, args.verbose))
+        worker.start()
+        workers.append(worker)
+    print("Simulating {0} sensor nodes and {1} application state nodes in {2} processes".format(sensor_nodes, some_nodes, processes))
+
+    started_on = time.monotonic()
+    last_published = 0
+    last_reported_on = started_on
+    try:
+        while args.duration is None or last_reported_on - started_on < args.duration:
+            time.sleep(report_interval)
+            now = time.monotonic()
+            connected = sum(stats[i * 3] for i in range(processes))
+            published = sum(stats[i * 3 + 1] for i in range(processes))
+            disconnects = sum(stats[i * 3 + 2] for i in range(processes))
+            print("{0:.0f}s: {1} of {2} nodes connected, {3:.0f} publishes/s, {4} disconnects".format(
+                now - started_on, connected, total, (published - last_published) / max(now - last_reported_on, 0.001), disconnects))
+            last_published = published
+            last_reported_on = now
+    except KeyboardInterrupt:
+        pass
+    stop.set()
+    for worker in workers:
+        worker.join()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+import async_mqtt
+import metrics
+import node_registry
+
+class TemperatureTable:
+    # The latest temperature of every sensor of every node in columns, one row per
+    # sensor. Rows are handed out from the births of the nodes, so a reading is a
+    # dict lookup by its raw topic and a write into the values, and the alarms of
+    # all sensors are evaluated at once. Rows of sensors that went away are reused.
+    def __init__(self, capacity=1024):
+        self._rows = {}
+        self._node_rows = {}
+        self._free = []
+        self.topics = []
+        self.size = 0
+        self.readings = 0
+        self.values = numpy.full(capacity, numpy.nan)
+        self.alarms = numpy.zeros(capacity, dtype=bool)
+        # scratch space for the evaluation, so that a tick allocates nothing
+        self._raised = numpy.zeros(capacity, dtype=bool)
+        self._resolved = numpy.zeros(capacity, dtype=bool)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def get_active(self):
+        return int(numpy.count_nonzero(self.alarms[:self.size]))
+
+    def update_node(self, node, sensors):
+        # assigns rows to the sensors of a birth and frees the rows of the sensors
+        # that are gone, returns the sensors that are gone while in alarm
+        old_rows = self._node_rows.pop(node, {})
+        rows = {}
+        for sensor in sensors:
+            row = old_rows.pop(sensor, None)
+            if row is not None:
+                rows[sensor] = row
+        # the rows of the sensors that are gone are freed first, so that the new
+        # sensors of the same birth reuse them
+        resolved = []
+        for sensor, row in old_rows.items():
+            if self.alarms[row]:
+                resolved.append(sensor)
+            self._free_row(row)
+        for sensor in sensors:
+            if sensor not in rows:
+                rows[sensor] = self._add_row(node, sensor)
+        if rows:
+            self._node_rows[node] = rows
+        return resolved
+
+    def _add_row(self, node, sensor):
+        if self._free:
+            row = self._free.pop()
+        else:
+            row = self.size
+            if row == len(self.values):
+                self._grow()
+            self.size += 1
+            self.topics.append(None)
+        self.topics[row] = (node, sensor)
+        self._rows["{0}/property/{1}".format(node, sensor).encode('utf8')] = row
+        return row
+
+    def _free_row(self, row):
+        node, sensor = self.topics[row]
+        del self._rows["{0}/property/{1}".format(node, sensor).encode('utf8')]
+        self.values[row] = numpy.nan
+        self.alarms[row] = False
+        self._free.append(row)
+
+    def _grow(self):
+        capacity = len(self.values) * 2
+        self.values = numpy.concatenate((self.values, numpy.full(capacity - len(self.values), numpy.nan)))
+        self.alarms = numpy.concatenate((self.alarms, numpy.zeros(capacity - len(self.alarms), dtype=bool)))
+        self._raised = numpy.zeros(capacity, dtype=bool)
+        self._resolved = numpy.zeros(capacity, dtype=bool)
+
+    def set(self, topic, payload):
+        # returns False for the topics of sensors that are not in a birth
+        row = self._rows.get(topic)
+        if row is None:
+            return False
+        self.values[row] = float(payload)
+        self.readings += 1
+        return True
+
+    def evaluate(self, threshold, hysteresis):
+        # raises the alarms of the sensors at or above the threshold and resolves
+        # the ones below the threshold minus the hysteresis, sensors without a value
+        # keep their state, returns the rows that changed
+        size = self.size
+        values = self.values[:size]
+        alarms = self.alarms[:size]
+        raised = self._raised[:size]
+        resolved = self._resolved[:size]
+        numpy.greater_equal(values, threshold, out=raised)
+        numpy.less(values, threshold - hysteresis, out=resolved)
+        # raised and not in alarm yet, or resolved and in alarm
+        numpy.greater(raised, alarms, out=raised)
+        numpy.logical_and(resolved, alarms, out=resolved)
+        numpy.logical_or(raised, resolved, out=raised)
+        changed = numpy.flatnonzero(raised)
+        alarms[changed] = ~alarms[changed]
+        return changed
+
+
+class TemperatureAlarmEngine:
+    # Evaluates the temperatures that SensorNode publishes to <id>/property/<sensor>
+    # against a threshold on every tick, the sensors are known from the births.
+    # Only the transitions are published, to <application id>/property/alarms/<id>/<sensor>
+    # like the alarm service of publish_temperature_alarms does.
+    BIRTH_TOPIC = "+/BIRTH"
+    READING_TOPIC = "+/property/+"
+    QUEUE_SIZE = 10000
+    MAX_INFLIGHT = 1000
+
+    def __init__(self, host, port, application_id, table, threshold, hysteresis, interval, metrics=None, metrics_interval=60.0, metrics_file=None):
+        self._host = host
+        self._port = port
+        self._application_id = application_id
+        self._table = table
+        self._threshold = threshold
+        self._hysteresis = hysteresis
+        self._interval = interval
+        self._invalid = 0
+        self._alive = False
+        self._stopped = None
+        self._client = None
+        self._registry = self._create_registry()
+        # the metrics are published retained to <application id>/metrics and written
+        # to the metrics file every metrics interval
+        self._metrics = metrics
+        self._metrics_interval = metrics_interval
+        self._metrics_file = metrics_file
+        self._evaluate_seconds = None
+        if metrics is not None:
+            self._evaluate_seconds = metrics.histogram("alarm_evaluate_seconds", "Seconds to evaluate the alarms of all sensors.")
+            metrics.gauge("alarm_sensors", "Sensors known from the births.", lambda: len(table))
+            metrics.gauge("alarm_active", "Sensors in alarm.", table.get_active)
+            metrics.counter("alarm_readings_total", "Readings of known sensors.", lambda: table.readings)
+            metrics.counter("alarm_readings_invalid_total", "Readings of known sensors that are not a number.", lambda: self._invalid)
+
+    def _create_registry(self):
+        registry = node_registry.NodeRegistry(self._application_id, lambda topic, payload: self._publish_application_topic(topic, payload, retain=True))
+        registry.add_command("rebirth", self._publish_birth)
+        registry.add_command("shutdown", self._shutdown)
+        registry.add_property("temperature-threshold", "numeric", lambda: self._threshold, self._set_threshold, minimum=-273.15, quantity="temperature", unit="degree_celsius")
+        registry.add_property("hysteresis", "numeric", lambda: self._hysteresis, self._set_hysteresis, minimum=0.0, quantity="temperature_difference", unit="kelvin")
+        return registry
+
+    def run(self):
+        asyncio.run(self._run())
+
+    async def _run(self):
+        # births must not be dropped, so the broker is made to wait instead
+        self._client = async_mqtt.AsyncClient(self._host, self._port, max_inflight=self.MAX_INFLIGHT, queue_size=self.QUEUE_SIZE, overflow=async_mqtt.BLOCK)
+        self._client.on_connect = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
+        self._client.will_set(self._get_application_topic("STATE"), "DEAD", retain=True)
+        if self._metrics is not None:
+            self._client.register_metrics(self._metrics)
+        self._stopped = asyncio.Event()
+        self._alive = True
+        await self._client.connect()
+        receiver = asyncio.ensure_future(self._receive())
+        reporter = None
+        if self._metrics is not None and self._metrics_interval > 0:
+            reporter = asyncio.ensure_future(metrics.report(self._metrics, self._client, self._get_application_topic("metrics"), self._metrics_interval, self._metrics_file))
+        # ticks are due on a fixed grid, however long one takes
+        due_on = time.monotonic() + self._interval
+        while self._alive:
+            try:
+                await asyncio.wait_for(self._stopped.wait(), max(due_on - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                pass
+            if not self._alive:
+                break
+            self._evaluate()
+            due_on += self._interval
+            if due_on < time.monotonic():
+                # skip the ticks that were missed
+                due_on = time.monotonic() + self._interval
+        if reporter is not None:
+            reporter.cancel()
+        if self._client.connected:
+            # a clean disconnect drops the will, so publish DEAD ourselves
+            self._publish_application_topic("STATE", "DEAD", retain=True)
+        await self._client.close()
+        await receiver
+
+    async def _receive(self):
+        async for msg in self._client:
+            self._on_message(msg)
+
+    def _evaluate(self):
+        started_on = time.perf_counter()
+        changed = self._table.evaluate(self._threshold, self._hysteresis)
+        if self._evaluate_seconds is not None:
+            self._evaluate_seconds.observe(time.perf_counter() - started_on)
+        if len(changed) == 0:
+            return
+        raised = self._publish_alarms(changed)
+        print("{0} alarms raised, {1} resolved, {2} of {3} sensors in alarm".format(
+            raised, len(changed) - raised, self._table.get_active(), len(self._table)))
+
+    def _publish_alarms(self, rows):
+        # the rows that could not be published change back, so the next tick
+        # publishes them again, returns the number of raised alarms
+        table = self._table
+        raised = 0
+        for i, row in enumerate(rows.tolist()):
+            node, sensor = table.topics[row]
+            if table.alarms[row]:
+                payload = "{0}°C".format(table.values[row])
+            else:
+                payload = "resolved"
+            if not self._publish_application_topic("property/alarms/{0}/{1}".format(node, sensor), payload, qos=1):
+                table.alarms[rows[i:]] = ~table.alarms[rows[i:]]
+                print("The broker does not keep up, publishing the remaining {0} alarms with the next tick".format(len(rows) - i))
+                break
+            if table.alarms[row]:
+                raised += 1
+        return raised
+
+    def _publish_application_topic(self, topic, payload=None, qos=0, retain=False):
+        # returns False if the window is full or the client is not connected
+        if not self._client.connected:
+            return False
+        try:
+            self._client.publish_nowait(self._get_application_topic(topic), payload, qos, retain)
+        except async_mqtt.WindowFull:
+            return False
+        return True
+
+    def _get_application_topic(self, topic):
+        return "{0}/{1}".format(self._application_id, topic)
+
+    def _get_birth_topics(self):
+        yield from self._registry.get_birth_topics()
+        yield {
+            "topic": self._get_application_topic("property/alarms/+/+"),
+            "modes": ["pub"],
+            "type": "text",
+        }
+        if self._metrics is not None and self._metrics_interval > 0:
+            yield {
+                "topic": self._get_application_topic("metrics"),
+                "modes": ["pub"],
+                "type": "json",
+            }
+
+    def _publish_birth(self):
+        self._publish_application_topic("STATE", "ALIVE", retain=True)
+        self._publish_application_topic("BIRTH", json.dumps(list(self._get_birth_topics()), separators=(",", ":")), retain=True)
+        self._registry.publish_all()
+        # the alarms are not retained, subscribers that ask for a birth get the active ones again
+        table = self._table
+        rows = numpy.flatnonzero(table.alarms[:table.size])
+        for row in rows.tolist():
+            node, sensor = table.topics[row]
+            if not self._publish_application_topic("property/alarms/{0}/{1}".format(node, sensor), "{0}°C".format(table.values[row]), qos=1):
+                break
+
+    def _set_threshold(self, threshold):
+        self._threshold = threshold
+
+    def _set_hysteresis(self, hysteresis):
+        self._hysteresis = hysteresis
+
+    def _shutdown(self):
+        print("Shutting down by remote request")
+        self._alive = False
+        self._stopped.set()
+
+    def _on_birth(self, node, payload):
+        # the temperatures of a node are the properties it publishes in degree
+        # celsius, the ones that can be set are settings like a threshold
+        sensors = []
+        if payload:
+            prefix = "{0}/property/".format(node)
+            entries = json.loads(payload.decode('utf8'))
+            settable = set(entry.get("topic") for entry in entries if "sub" in entry.get("modes", []))
+            for entry in entries:
+                topic = entry.get("topic", "")
+                if "pub" not in entry.get("modes", []) or entry.get("quantity") != "temperature" or "{0}/set".format(topic) in settable:
+                    continue
+                if topic.startswith(prefix) and "/" not in topic[len(prefix):]:
+                    sensors.append(topic[len(prefix):])
+        for sensor in self._table.update_node(node, sensors):
+            # the sensor is gone, so is its alarm
+            self._publish_application_topic("property/alarms/{0}/{1}".format(node, sensor), "resolved", qos=1)
+
+    # Called for every message received from the server.
+    def _on_message(self, msg):
+        try:
+            # readings are by far the most messages, they are looked up first and by
+            # their raw topic, paho decodes msg.topic anew on every access
+            if self._table.set(msg._topic, msg.payload):
+                return
+        except ValueError:
+            self._invalid += 1
+            return
+        try:
+            if self._registry.dispatch(msg):
+                return
+            node, _, kind = msg.topic.rpartition("/")
+            if kind == "BIRTH" and "/" not in node and node != self._application_id:
+                self._on_birth(node, msg.payload)
+        except Exception as ex:
+            print("An unhandled exception occurred while processing a message on topic {0}: {1}".format(msg.topic, ex))
+
+    def _on_connect(self):
+        print("Connected to {0}:{1}".format(self._host, self._port))
+        # the retained births arrive before the readings of their nodes
+        self._client.subscribe([(self.BIRTH_TOPIC, 1), (self.READING_TOPIC, 0)] + self._registry.get_subscriptions(1))
+        self._publish_birth()
+
+    def _on_disconnect(self):
+        print("Disconnected from {0}:{1}".format(self._host, self._port))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Raise temperature alarms for all sensor nodes that publish their temperatures.")
+    parser.add_argument("--host", help="the host of the mqtt broker")
+    parser.add_argument("--port", type=int, help="the port of the mqtt broker")
+    parser.add_argument("--application-id", help="the application id of the engine, defaults to temperature-alarm")
+    parser.add_argument("--threshold", type=float, help="the temperature in °C at or above which a sensor is in alarm, defaults to 65")
+    parser.add_argument("--hysteresis", type=float, help="how far in °C a temperature must fall below the threshold to resolve the alarm, defaults to 2")
+    parser.add_argument("--interval", type=float, help="the seconds between two evaluations of all sensors, defaults to 1.0")
+    parser.add_argument("--capacity", type=int, help="the number of sensors to make room for up front, defaults to 1024, more are added as needed")
+    parser.add_argument("--metrics-interval", type=float, help="the seconds between publishing the metrics to APPLICATION_ID/metrics, defaults to 60.0, 0 disables the metrics")
+    parser.add_argument("--metrics-file", help="a file the metrics are written to in the prometheus text format every metrics interval")
+    args = parser.parse_args()
+
+    if args.host:
+        host = args.host
+    else:
+        host = "localhost"
+    if args.port:
+        port = args.port
+    else:
+        port = 1883
+    if args.application_id:
+        application_id = args.application_id
+    else:
+        application_id = "temperature-alarm"
+    if args.threshold is not None:
+        threshold = args.threshold
+    else:
+        threshold = 65.0
+    if args.hysteresis is not None:
+        hysteresis = args.hysteresis
+    else:
+        hysteresis = 2.0
+    if args.interval:
+        interval = args.interval
+    else:
+        interval = 1.0
+    if args.capacity:
+        capacity = args.capacity
+    else:
+        capacity = 1024
+    if args.metrics_interval is not None:
+        metrics_interval = args.metrics_interval
+    else:
+        metrics_interval = 60.0
+    if hysteresis < 0:
+        parser.error("the hysteresis must not be negative")
+    if metrics_interval > 0:
+        engine_metrics = metrics.Metrics({"application_id": application_id})
+    else:
+        engine_metrics = None
+
+    table = TemperatureTable(capacity)
+    engine = TemperatureAlarmEngine(host, port, application_id, table, threshold, hysteresis, interval, engine_metrics, metrics_interval, args.metrics_file)
+    engine.run()
+
+if __name__ == "__main__":
+    main()
@@ -1,67 +1,1073 @@
 #!/usr/bin/env python3
-import paho.mqtt.client as mqtt
 import argparse
-import socket
+import array
+import asyncio
+import bisect
+import heapq
+import json
+import math
+import mmap
+import os
+import random
+import signal
+import struct
+import sys
+import tempfile
 import time
-import queue
+import zlib
 
-class PublishNullForeachRetained:
-    def __init__(self, host, port):
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+import async_mqtt
+import metrics
+
+class TopicTrie:
+    def __init__(self, topic_filters=()):
+        self._root = {}
+        for topic_filter in topic_filters:
+            self.add(topic_filter)
+
+    def add(self, topic_filter):
+        node = self._root
+        for level in topic_filter.split("/"):
+            node = node.setdefault(level, {})
+        # None marks the end of a topic filter
+        node[None] = True
+
+    def matches(self, topic):
+        levels = topic.split("/")
+        # topics starting with $ are not matched by leading wildcards
+        wildcards = not levels[0].startswith("$")
+        nodes = [self._root]
+        for level in levels:
+            next_nodes = []
+            for node in nodes:
+                if wildcards:
+                    if "#" in node:
+                        return True
+                    if "+" in node:
+                        next_nodes.append(node["+"])
+                if level in node:
+                    next_nodes.append(node[level])
+            if not next_nodes:
+                return False
+            nodes = next_nodes
+            wildcards = True
+        for node in nodes:
+            # a/# also matches a
+            if None in node or "#" in node:
+                return True
+        return False
+
+
+def topic_filter_covers(topic_filter, other):
+    levels = topic_filter.split("/")
+    other_levels = other.split("/")
+    # a wildcard in the first level does not match topics that start with $, e.g. $SYS
+    if levels[0] in ("+", "#") and other_levels[0].startswith("$"):
+        return False
+    for i, level in enumerate(levels):
+        if level == "#":
+            return True
+        if i >= len(other_levels):
+            return False
+        other_level = other_levels[i]
+        if other_level == "#":
+            return False
+        if level != "+" and (other_level == "+" or level != other_level):
+            return False
+    return len(levels) == len(other_levels)
+
+
+def reduce_topic_filters(topic_filters):
+    # drop filters that are covered by another one, the broker would otherwise
+    # deliver the retained messages that match both more than once
+    reduced = []
+    for topic_filter in topic_filters:
+        if topic_filter in reduced:
+            continue
+        if any(topic_filter_covers(other, topic_filter) for other in topic_filters if other != topic_filter):
+            continue
+        reduced.append(topic_filter)
+    return reduced
+
+
+def shard(publishers, topic, shard_by):
+    if len(publishers) == 1:
+        return publishers[0]
+    if shard_by == "prefix":
+        key = topic.split("/", 1)[0]
+    else:
+        key = topic
+    return publishers[zlib.crc32(key.encode('utf8')) % len(publishers)]
+
+
+class Progress:
+    def __init__(self, quiet):
+        self._quiet = quiet
+        self._last_printed_on = 0
+
+    def print(self, get_line, force=False):
+        if self._quiet:
+            return
+        now = time.monotonic()
+        if sys.stdout.isatty():
+            if not force and now - self._last_printed_on < 0.2:
+                return
+            sys.stdout.write("\r{0}".format(get_line()))
+            if force:
+                sys.stdout.write("\n")
+            sys.stdout.flush()
+        else:
+            if not force and now - self._last_printed_on < 5.0:
+                return
+            print(get_line())
+        self._last_printed_on = now
+
+
+class MetricsWriter:
+    # writes the metrics of a command to a file in the prometheus text format
+    # every interval while it runs and once more when it is done
+    def __init__(self, registry, path, interval):
+        self._registry = registry
+        self._path = path
+        self._interval = interval
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(metrics.report(self._registry, None, None, self._interval, self._path))
+
+    def close(self):
+        self._task.cancel()
+        metrics.write_prometheus(self._path, [self._registry])
+
+
+def create_metrics_writer(registry, path, interval):
+    if registry is None or path is None:
+        return None
+    return MetricsWriter(registry, path, interval)
+
+
+class RetainedScanner:
+    # the qos to subscribe with, retained messages are delivered with at most this qos
+    subscription_qos = 0
+    # the retained messages that wait to be handled, the broker holds on to the
+    # rest until there is room again
+    queue_size = 1000
+
+    def __init__(self, host, port, topic_filters=None, excluded_topic_filters=None, idle_timeout=5.0, quiet=False, metrics=None):
         self._host = host
         self._port = port
-        self._connected = False
-        self._inbound_messages = queue.Queue()
-    
+        if not topic_filters:
+            topic_filters = ["#"]
+        self._topic_filters = reduce_topic_filters(topic_filters)
+        self._excluded = TopicTrie(excluded_topic_filters or [])
+        self._idle_timeout = idle_timeout
+        self._quiet = quiet
+        self._progress = Progress(quiet)
+        self._subscribed = None
+        self._last_received_on = 0
+        self._received = 0
+        self._excluded_count = 0
+        self._metrics = metrics
+        if metrics is not None:
+            metrics.counter("tooling_retained_received_total", "Retained messages received by the scan.", lambda: self._received)
+            metrics.counter("tooling_retained_excluded_total", "Retained messages left out because they are excluded.", lambda: self._excluded_count)
+
+    async def _scan(self):
+        self._client = async_mqtt.AsyncClient(self._host, self._port, queue_size=self.queue_size, overflow=async_mqtt.BLOCK)
+        self._client.on_connect = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
+        if self._metrics is not None:
+            self._client.register_metrics(self._metrics, connection="scan")
+        await self._client.connect()
+
+        # wait for the subscription to be acknowledged, the broker sends the
+        # retained messages right after that
+        await self._subscribed
+
+        started_on = time.monotonic()
+        self._last_received_on = started_on
+        watchdog = asyncio.ensure_future(self._watch())
+        async for msg in self._client:
+            await self._on_message(msg)
+        await watchdog
+        self._progress.print(self._get_progress_line, force=True)
+        return started_on
+
+    async def _watch(self):
+        # ends the scan once it is complete
+        while not self._is_complete():
+            self._progress.print(self._get_progress_line)
+            await asyncio.sleep(0.1)
+        await self._client.close()
+
+    def _is_complete(self):
+        return time.monotonic() - self._last_received_on >= self._idle_timeout
+
+    def _get_progress_line(self):
+        return "Received {0} retained topics".format(self._received)
+
+    async def _on_retained(self, msg):
+        pass
+
+    async def _on_message(self, msg):
+        # the broker echoes our own purges as non retained messages, and a
+        # retained message with an empty payload is already purged
+        if not msg.retain or not msg.payload:
+            return
+        self._last_received_on = time.monotonic()
+        if self._excluded.matches(msg.topic):
+            self._excluded_count += 1
+            return
+        self._received += 1
+        await self._on_retained(msg)
+
+    def _on_connect(self):
+        if not self._quiet:
+            print("Connected to {0}:{1}".format(self._host, self._port))
+        self._subscribed = self._client.subscribe([(topic_filter, self.subscription_qos) for topic_filter in self._topic_filters])
+
+    def _on_disconnect(self):
+        if not self._quiet:
+            print("Disconnected from {0}:{1}".format(self._host, self._port))
+
+
+class PublishNullForeachRetained(RetainedScanner):
+    def __init__(self, host, port, topic_filters=None, excluded_topic_filters=None, connections=1, shard_by="hash", window=100, idle_timeout=5.0, dry_run=False, quiet=False, metrics=None, metrics_file=None, metrics_interval=5.0):
+        super().__init__(host, port, topic_filters, excluded_topic_filters, idle_timeout, quiet, metrics)
+        self._shard_by = shard_by
+        self._dry_run = dry_run
+        self._purgers = []
+        if not dry_run:
+            self._purgers = [async_mqtt.AsyncClient(host, port, max_inflight=window) for _ in range(connections)]
+        if metrics is not None:
+            for i, purger in enumerate(self._purgers):
+                purger.register_metrics(metrics, connection=i)
+        self._metrics_writer = create_metrics_writer(metrics, metrics_file, metrics_interval)
+
+    def run(self):
+        asyncio.run(self._run())
+
+    async def _run(self):
+        if self._metrics_writer is not None:
+            self._metrics_writer.start()
+        for purger in self._purgers:
+            await purger.connect()
+        started_on = await self._scan()
+        for purger in self._purgers:
+            await purger.close()
+        if self._metrics_writer is not None:
+            self._metrics_writer.close()
+        self._print_report(started_on)
+
+    def _is_complete(self):
+        if not super()._is_complete():
+            return False
+        return not any(purger.in_flight for purger in self._purgers)
+
+    def _get_progress_line(self):
+        if self._dry_run:
+            return "Found {0} retained topics to purge".format(self._received)
+        purged = sum(purger.published for purger in self._purgers)
+        in_flight = sum(purger.in_flight for purger in self._purgers)
+        return "Purged {0} of {1} retained topics, {2} in flight".format(purged, self._received, in_flight)
+
+    def _print_report(self, started_on):
+        if self._dry_run:
+            print("Would purge {0} retained topics, excluded {1}".format(self._received, self._excluded_count))
+            return
+        purged = sum(purger.published for purger in self._purgers)
+        last_purged_on = max([started_on] + [purger.last_published_on for purger in self._purgers])
+        elapsed = max(last_purged_on - started_on, 0.001)
+        print("Purged {0} retained topics in {1:.2f} seconds ({2:.0f} topics/s) over {3} connections, excluded {4}".format(
+            purged, elapsed, purged / elapsed, len(self._purgers), self._excluded_count))
+
+    async def _on_retained(self, msg):
+        if not self._dry_run:
+            # a full window stops the scan, and with it the retained messages
+            purger = shard(self._purgers, msg.topic, self._shard_by)
+            await purger.wait_for_window()
+            purger.publish_nowait(msg.topic, None, qos=1, retain=True)
+
+
+class RetainedSnapshotWriter:
+    # A snapshot starts with a header, followed by one record per retained
+    # message, an index of record offsets sorted by topic and a footer that
+    # locates the index. All integers are big endian, like on the wire.
+    MAGIC = b"MQTTSNAP"
+    VERSION = 1
+    HEADER = struct.Struct("!8sB")
+    RECORD = struct.Struct("!HBI")
+    FOOTER = struct.Struct("!QQ8s")
+
+    # the number of records sorted in memory at a time, larger snapshots are
+    # sorted in runs of this size that are merged when the snapshot is closed
+    RUN_SIZE = 1 << 16
+
+    def __init__(self, path):
+        self._path = path
+        self._file = open(path, "wb", buffering=1 << 20)
+        self._file.write(self.HEADER.pack(self.MAGIC, self.VERSION))
+        self._offset = self.HEADER.size
+        # the topics and offsets of the records that are not yet part of a run
+        self._records = []
+        # the offsets of each sorted run, spilled to a temporary file
+        self._runs_file = None
+        self._runs = []
+        self.size = 0
+
+    def append(self, topic, qos, payload):
+        topic = topic.encode('utf8')
+        self._file.write(self.RECORD.pack(len(topic), qos, len(payload)))
+        self._file.write(topic)
+        self._file.write(payload)
+        self._records.append((topic, self._offset))
+        self._offset += self.RECORD.size + len(topic) + len(payload)
+        if len(self._records) >= self.RUN_SIZE:
+            self._spill_run()
+
+    def close(self):
+        self._file.flush()
+        count = self._write_index()
+        self._file.write(self.FOOTER.pack(self._offset, count, self.MAGIC))
+        self._file.close()
+        self.size = self._offset + 8 * count + self.FOOTER.size
+        return count
+
+    def _sort_records(self):
+        # records of the same topic keep their order because offsets only grow
+        self._records.sort()
+        offsets = array.array("Q", [offset for _, offset in self._records])
+        self._records = []
+        return offsets
+
+    def _spill_run(self):
+        if self._runs_file is None:
+            self._runs_file = tempfile.TemporaryFile()
+        offsets = self._sort_records()
+        self._runs.append((self._runs_file.tell(), len(offsets)))
+        self._runs_file.write(offsets.tobytes())
+
+    def _write_index(self):
+        if not self._runs:
+            return self._write_offsets([self._sort_records()])
+        if self._records:
+            self._spill_run()
+        self._runs_file.flush()
+        try:
+            with mmap.mmap(self._runs_file.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                def read_run(start, count, block=4096):
+                    end = start + 8 * count
+                    while start < end:
+                        offsets = array.array("Q", m[start:min(start + 8 * block, end)])
+                        start += len(offsets) * 8
+                        yield from offsets
+                return self._write_offsets([read_run(start, count) for start, count in self._runs])
+        finally:
+            self._runs_file.close()
+            self._runs_file = None
+            self._runs = []
+
+    def _write_offsets(self, runs):
+        # merges the sorted runs, reading the topics back from the file, and writes
+        # the offset of the latest record of each topic
+        count = 0
+        with open(self._path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            def topic_at(offset):
+                topic_length, = struct.unpack_from("!H", m, offset)
+                start = offset + self.RECORD.size
+                return m[start:start + topic_length]
+            index = array.array("Q")
+            last_topic = None
+            last_offset = None
+            # the merge is stable, so the last record of a topic is its latest value
+            for offset in heapq.merge(*runs, key=topic_at):
+                topic = topic_at(offset)
+                if last_offset is not None and topic != last_topic:
+                    index.append(last_offset)
+                    if len(index) >= self.RUN_SIZE:
+                        count += self._write_index_block(index)
+                        index = array.array("Q")
+                last_topic = topic
+                last_offset = offset
+            if last_offset is not None:
+                index.append(last_offset)
+            count += self._write_index_block(index)
+        return count
+
+    def _write_index_block(self, index):
+        if sys.byteorder == "little":
+            index.byteswap()
+        self._file.write(index.tobytes())
+        return len(index)
+
+
+class RetainedSnapshotReader:
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        header = RetainedSnapshotWriter.HEADER
+        footer = RetainedSnapshotWriter.FOOTER
+        if len(self._mmap) < header.size + footer.size:
+            raise ValueError("{0} is not a snapshot".format(path))
+        magic, version = header.unpack_from(self._mmap, 0)
+        if magic != RetainedSnapshotWriter.MAGIC or version != RetainedSnapshotWriter.VERSION:
+            raise ValueError("{0} is not a version {1} snapshot".format(path, RetainedSnapshotWriter.VERSION))
+        index_offset, count, magic = footer.unpack_from(self._mmap, len(self._mmap) - footer.size)
+        if magic != RetainedSnapshotWriter.MAGIC:
+            raise ValueError("{0} is incomplete, the snapshot was interrupted".format(path))
+        self._index_offset = index_offset
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        record = RetainedSnapshotWriter.RECORD
+        for i in range(self._count):
+            offset, = struct.unpack_from("!Q", self._mmap, self._index_offset + 8 * i)
+            topic_length, qos, payload_length = record.unpack_from(self._mmap, offset)
+            start = offset + record.size
+            topic = self._mmap[start:start + topic_length].decode('utf8')
+            start += topic_length
+            yield topic, qos, self._mmap[start:start + payload_length]
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+
+class SnapshotRetained(RetainedScanner):
+    # keep the qos the retained messages were published with
+    subscription_qos = 2
+
+    def __init__(self, host, port, path, topic_filters=None, excluded_topic_filters=None, idle_timeout=5.0, quiet=False, metrics=None, metrics_file=None, metrics_interval=5.0):
+        super().__init__(host, port, topic_filters, excluded_topic_filters, idle_timeout, quiet, metrics)
+        self._path = path
+        self._metrics_writer = create_metrics_writer(metrics, metrics_file, metrics_interval)
+
     def run(self):
-        self._client = mqtt.Client()
+        asyncio.run(self._run())
+
+    async def _run(self):
+        if self._metrics_writer is not None:
+            self._metrics_writer.start()
+        self._writer = RetainedSnapshotWriter(self._path)
+        started_on = await self._scan()
+        if self._metrics_writer is not None:
+            self._metrics_writer.close()
+        elapsed = max(self._last_received_on - started_on, 0.001)
+        count = self._writer.close()
+        print("Saved {0} retained topics ({1} bytes) to {2} in {3:.2f} seconds, excluded {4}".format(
+            count, self._writer.size, self._path, elapsed, self._excluded_count))
+
+    async def _on_retained(self, msg):
+        self._writer.append(msg.topic, msg.qos, msg.payload)
+
+
+class RestoreSnapshot:
+    def __init__(self, host, port, path, connections=1, shard_by="hash", window=100, quiet=False, metrics=None, metrics_file=None, metrics_interval=5.0):
+        self._path = path
+        self._shard_by = shard_by
+        self._quiet = quiet
+        self._progress = Progress(quiet)
+        # the snapshot is read while it is republished, as fast as the windows allow
+        self._publishers = [async_mqtt.AsyncClient(host, port, max_inflight=window) for _ in range(connections)]
+        self._count = 0
+        if metrics is not None:
+            for i, publisher in enumerate(self._publishers):
+                publisher.register_metrics(metrics, connection=i)
+        self._metrics_writer = create_metrics_writer(metrics, metrics_file, metrics_interval)
+
+    def run(self):
+        asyncio.run(self._run())
+
+    async def _run(self):
+        reader = RetainedSnapshotReader(self._path)
+        self._count = len(reader)
+        if self._metrics_writer is not None:
+            self._metrics_writer.start()
+        for publisher in self._publishers:
+            await publisher.connect()
+        started_on = time.monotonic()
+        for topic, qos, payload in reader:
+            publisher = shard(self._publishers, topic, self._shard_by)
+            await publisher.wait_for_window()
+            publisher.publish_nowait(topic, payload, qos, retain=True)
+            self._progress.print(self._get_progress_line)
+        for publisher in self._publishers:
+            await publisher.drain()
+        elapsed = max(time.monotonic() - started_on, 0.001)
+        for publisher in self._publishers:
+            await publisher.close()
+        if self._metrics_writer is not None:
+            self._metrics_writer.close()
+        reader.close()
+        self._progress.print(self._get_progress_line, force=True)
+        restored = sum(publisher.published for publisher in self._publishers)
+        print("Restored {0} retained topics from {1} in {2:.2f} seconds ({3:.0f} topics/s) over {4} connections".format(
+            restored, self._path, elapsed, restored / elapsed, len(self._publishers)))
+
+    def _get_progress_line(self):
+        restored = sum(publisher.published for publisher in self._publishers)
+        in_flight = sum(publisher.in_flight for publisher in self._publishers)
+        return "Restored {0} of {1} retained topics, {2} in flight".format(restored, self._count, in_flight)
+
+
+class SpaceSaving:
+    # The heavy hitters of a stream in bounded memory. At most capacity items are
+    # counted, a new item replaces the one with the smallest count and inherits
+    # that count as its error, so counts are overestimated by at most their error.
+    # Counts only grow, so the heap holds lower bounds and a stale minimum is
+    # pushed again with its current count when it turns up.
+    def __init__(self, capacity):
+        self._capacity = capacity
+        # item mapped to its count, error and the bytes seen while it was counted
+        self._counters = {}
+        self._heap = []
+        # the counts are exact until the first item is evicted
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._counters)
+
+    def add(self, item, size):
+        counter = self._counters.get(item)
+        if counter is not None:
+            counter[0] += 1
+            counter[2] += size
+            return
+        if len(self._counters) < self._capacity:
+            self._counters[item] = [1, 0, size]
+            heapq.heappush(self._heap, (1, item))
+            return
+        while True:
+            count, evicted = self._heap[0]
+            current = self._counters[evicted][0]
+            if current == count:
+                break
+            heapq.heapreplace(self._heap, (current, evicted))
+        del self._counters[evicted]
+        self.evicted += 1
+        self._counters[item] = [count + 1, count, size]
+        heapq.heapreplace(self._heap, (count + 1, item))
+
+    def top(self, n):
+        # the items with the highest counts, as item, count, error and bytes
+        # of items with the same count the ones with the smaller error come first
+        items = heapq.nlargest(n, self._counters.items(), key=lambda item: (item[1][0], -item[1][1]))
+        return [(item, count, error, size) for item, (count, error, size) in items]
+
+
+class Reservoir:
+    # a uniform sample of a stream of unknown length, Li's algorithm L skips ahead
+    # to the next item to keep instead of drawing a random number for every item
+    def __init__(self, size, seed=None):
+        self._size = size
+        self._random = random.Random(seed)
+        self.items = []
+        self._seen = 0
+        self._w = 1.0
+        # the number of the last item that was kept, counted from 0
+        self._next = size - 1
+
+    def _skip(self):
+        self._w *= math.exp(math.log(self._random.random()) / self._size)
+        self._next += int(math.log(self._random.random()) / math.log(1 - self._w)) + 1
+
+    def wants(self):
+        # whether the next item is kept, so that it is only built if it is
+        return self._seen < self._size or self._seen == self._next
+
+    def add(self, item):
+        if self._seen < self._size:
+            self.items.append(item)
+            if len(self.items) == self._size:
+                self._skip()
+        elif self._seen == self._next:
+            self.items[self._random.randrange(self._size)] = item
+            self._skip()
+        self._seen += 1
+
+    def skip(self):
+        self._seen += 1
+
+
+class RetainedInventory(RetainedScanner):
+    # Streams the retained messages once and keeps bounded summaries of them, the
+    # prefixes in a space saving sketch, the largest topics in a heap and a sample
+    # of the payloads in a reservoir, so millions of topics fit into memory.
+    # Counts of prefixes are exact as long as there are no more prefixes than the
+    # sketch holds.
+    SAMPLE_PREVIEW = 64
+
+    def __init__(self, host, port, topic_filters=None, excluded_topic_filters=None, idle_timeout=5.0, quiet=False, depth=1, top=10, sample=10, sketch_size=1000, output_format="table", metrics=None, metrics_file=None, metrics_interval=5.0):
+        super().__init__(host, port, topic_filters, excluded_topic_filters, idle_timeout, quiet, metrics)
+        self._depth = depth
+        self._top = top
+        self._output_format = output_format
+        self._prefixes = SpaceSaving(sketch_size)
+        # a min heap of the sizes and topics of the largest payloads
+        self._largest = []
+        self._sample = Reservoir(sample)
+        self._bytes = 0
+        self._metrics_writer = create_metrics_writer(metrics, metrics_file, metrics_interval)
+
+    def run(self):
+        asyncio.run(self._run())
+
+    async def _run(self):
+        if self._metrics_writer is not None:
+            self._metrics_writer.start()
+        started_on = await self._scan()
+        if self._metrics_writer is not None:
+            self._metrics_writer.close()
+        report = self._get_report(max(self._last_received_on - started_on, 0.001))
+        if self._output_format == "json":
+            print(json.dumps(report, indent=2))
+        else:
+            self._print_table(report)
+
+    def _get_progress_line(self):
+        return "Inventoried {0} retained topics ({1} bytes)".format(self._received, self._bytes)
+
+    async def _on_retained(self, msg):
+        topic = msg.topic
+        size = len(msg.payload)
+        self._bytes += size
+        self._prefixes.add("/".join(topic.split("/", self._depth)[:self._depth]), size)
+        if len(self._largest) < self._top:
+            heapq.heappush(self._largest, (size, topic))
+        elif size > self._largest[0][0]:
+            heapq.heapreplace(self._largest, (size, topic))
+        if self._sample.wants():
+            self._sample.add((topic, msg.payload[:self.SAMPLE_PREVIEW], size))
+        else:
+            self._sample.skip()
+
+    def _get_report(self, elapsed):
+        return {
+            "topics": self._received,
+            "bytes": self._bytes,
+            "excluded": self._excluded_count,
+            "seconds": elapsed,
+            "depth": self._depth,
+            # the prefixes are exact unless the sketch had to evict some
+            "exact": self._prefixes.evicted == 0,
+            "prefixes": [{"prefix": prefix, "topics": count, "error": error, "bytes": size} for prefix, count, error, size in self._prefixes.top(self._top)],
+            "largest_topics": [{"topic": topic, "bytes": size} for size, topic in sorted(self._largest, reverse=True)],
+            "sample": [{"topic": topic, "bytes": size, "payload": preview.decode('utf8', errors="replace")} for topic, preview, size in self._sample.items],
+        }
+
+    def _print_table(self, report):
+        print("{0} retained topics, {1} payload bytes, excluded {2}, scanned in {3:.2f} seconds".format(
+            report["topics"], report["bytes"], report["excluded"], report["seconds"]))
+        print()
+        if report["exact"]:
+            print("Busiest prefixes at depth {0}".format(report["depth"]))
+        else:
+            print("Busiest prefixes at depth {0}, topics are overestimated by at most the error, bytes are counted since the prefix was tracked".format(report["depth"]))
+        print("{0:>10} {1:>8} {2:>14}  {3}".format("topics", "error", "bytes", "prefix"))
+        for prefix in report["prefixes"]:
+            print("{0:>10} {1:>8} {2:>14}  {3}".format(prefix["topics"], prefix["error"], prefix["bytes"], prefix["prefix"]))
+        print()
+        print("Largest topics")
+        print("{0:>10}  {1}".format("bytes", "topic"))
+        for topic in report["largest_topics"]:
+            print("{0:>10}  {1}".format(topic["bytes"], topic["topic"]))
+        print()
+        print("Sampled payloads")
+        for sample in report["sample"]:
+            print("{0:>10}  {1}  {2!r}".format(sample["bytes"], sample["topic"], sample["payload"]))
+
+
+class CaptureWriter:
+    # A capture starts with a header, followed by segments of records. Every
+    # segment starts with a segment record and defines the topics it uses before
+    # their first message, so replaying can start at any segment. Timestamps are
+    # the microseconds since the capture started on the monotonic clock. An index
+    # of the first timestamp and offset of each segment and a footer that locates
+    # it are written on close, a capture that was cut off is indexed by reading it.
+    # All integers are big endian, like on the wire.
+    MAGIC = b"MQTTCAPT"
+    VERSION = 1
+    HEADER = struct.Struct("!8sBd")
+    SEGMENT = struct.Struct("!BQ")
+    TOPIC = struct.Struct("!BHH")
+    MESSAGE = struct.Struct("!BQHBI")
+    INDEX_ENTRY = struct.Struct("!QQ")
+    FOOTER = struct.Struct("!QQQ8s")
+    SEGMENT_RECORD = 1
+    TOPIC_RECORD = 2
+    MESSAGE_RECORD = 3
+    MAX_TOPICS = 0xFFFF
+
+    def __init__(self, path, segment_seconds=10.0, segment_bytes=4 * 1024 * 1024):
+        self._file = open(path, "wb", buffering=1 << 20)
+        self._file.write(self.HEADER.pack(self.MAGIC, self.VERSION, time.time()))
+        self._offset = self.HEADER.size
+        self._started_on = time.monotonic()
+        self._segment_us = int(segment_seconds * 1e6)
+        self._segment_bytes = segment_bytes
+        self._segment_started_on = None
+        self._segment_offset = 0
+        self._segments = array.array("Q")
+        # the ids of the topics defined in the current segment
+        self._topics = {}
+        self._last_us = 0
+        self.messages = 0
+        self.size = self._offset
+
+    def append(self, timestamp, topic, qos, retain, payload):
+        # timestamps before the capture started or out of order are moved up, so
+        # the timestamps in a capture never go back
+        us = max(int((timestamp - self._started_on) * 1e6), self._last_us)
+        self._last_us = us
+        if (self._segment_started_on is None or us - self._segment_started_on >= self._segment_us
+                or self._offset - self._segment_offset >= self._segment_bytes or len(self._topics) >= self.MAX_TOPICS):
+            self._start_segment(us)
+        topic_id = self._topics.get(topic)
+        if topic_id is None:
+            topic_id = len(self._topics)
+            self._topics[topic] = topic_id
+            encoded_topic = topic.encode('utf8')
+            self._file.write(self.TOPIC.pack(self.TOPIC_RECORD, topic_id, len(encoded_topic)))
+            self._file.write(encoded_topic)
+            self._offset += self.TOPIC.size + len(encoded_topic)
+        self._file.write(self.MESSAGE.pack(self.MESSAGE_RECORD, us, topic_id, qos | (retain << 2), len(payload)))
+        self._file.write(payload)
+        self._offset += self.MESSAGE.size + len(payload)
+        self.messages += 1
+
+    def _start_segment(self, us):
+        if self._segment_started_on is not None:
+            # a crash loses at most the segment that is being written
+            self._file.flush()
+        self._segment_started_on = us
+        self._segment_offset = self._offset
+        self._segments.append(us)
+        self._segments.append(self._offset)
+        self._topics = {}
+        self._file.write(self.SEGMENT.pack(self.SEGMENT_RECORD, us))
+        self._offset += self.SEGMENT.size
+
+    def close(self):
+        index_offset = self._offset
+        count = len(self._segments) // 2
+        segments = self._segments
+        if sys.byteorder == "little":
+            segments.byteswap()
+        self._file.write(segments.tobytes())
+        self._file.write(self.FOOTER.pack(index_offset, count, self._last_us, self.MAGIC))
+        self._file.close()
+        self.size = index_offset + self.INDEX_ENTRY.size * count + self.FOOTER.size
+
+
+class CaptureReader:
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        header = CaptureWriter.HEADER
+        footer = CaptureWriter.FOOTER
+        if len(self._mmap) < header.size:
+            raise ValueError("{0} is not a capture".format(path))
+        magic, version, self.started_on = header.unpack_from(self._mmap, 0)
+        if magic != CaptureWriter.MAGIC or version != CaptureWriter.VERSION:
+            raise ValueError("{0} is not a version {1} capture".format(path, CaptureWriter.VERSION))
+        self.complete = False
+        if len(self._mmap) >= header.size + footer.size:
+            index_offset, count, last_us, magic = footer.unpack_from(self._mmap, len(self._mmap) - footer.size)
+            self.complete = magic == CaptureWriter.MAGIC
+        if self.complete:
+            index = array.array("Q")
+            index.frombytes(self._mmap[index_offset:index_offset + CaptureWriter.INDEX_ENTRY.size * count])
+            if sys.byteorder == "little":
+                index.byteswap()
+            self._segment_times = index[0::2]
+            self._segment_offsets = index[1::2]
+            self._end = index_offset
+            self.last_us = last_us
+        else:
+            # the recording was interrupted, index the records that are complete
+            self._index()
+
+    def _index(self):
+        self._segment_times = array.array("Q")
+        self._segment_offsets = array.array("Q")
+        self._end = CaptureWriter.HEADER.size
+        self.last_us = 0
+        for record_type, offset, us, _, _, _ in self._records(CaptureWriter.HEADER.size, len(self._mmap), {}, payloads=False):
+            if record_type == CaptureWriter.SEGMENT_RECORD:
+                self._segment_times.append(us)
+                self._segment_offsets.append(offset)
+            elif record_type == CaptureWriter.MESSAGE_RECORD:
+                self.last_us = us
+            self._end = offset
+
+    def _records(self, offset, end, topics, payloads=True):
+        # yields the type of each record, the offset after it and its fields, stops
+        # at the first record that is cut off
+        m = self._mmap
+        segment = CaptureWriter.SEGMENT
+        topic_record = CaptureWriter.TOPIC
+        message = CaptureWriter.MESSAGE
+        while offset < end:
+            record_type = m[offset]
+            if record_type == CaptureWriter.MESSAGE_RECORD:
+                if offset + message.size > end:
+                    return
+                _, us, topic_id, flags, payload_length = message.unpack_from(m, offset)
+                start = offset + message.size
+                offset = start + payload_length
+                if offset > end:
+                    return
+                payload = m[start:offset] if payloads else None
+                yield record_type, offset, us, topics.get(topic_id), flags, payload
+            elif record_type == CaptureWriter.TOPIC_RECORD:
+                if offset + topic_record.size > end:
+                    return
+                _, topic_id, topic_length = topic_record.unpack_from(m, offset)
+                start = offset + topic_record.size
+                offset = start + topic_length
+                if offset > end:
+                    return
+                topics[topic_id] = m[start:offset].decode('utf8')
+                yield record_type, offset, None, None, None, None
+            elif record_type == CaptureWriter.SEGMENT_RECORD:
+                if offset + segment.size > end:
+                    return
+                _, us = segment.unpack_from(m, offset)
+                offset += segment.size
+                topics.clear()
+                yield record_type, offset, us, None, None, None
+            else:
+                return
+
+    def __len__(self):
+        return len(self._segment_times)
+
+    def read(self, start_us=0, end_us=None):
+        # the messages from the segment that contains the start on, as their
+        # timestamp, topic, qos, retain flag and payload
+        i = max(bisect.bisect_right(self._segment_times, start_us) - 1, 0)
+        if i >= len(self._segment_offsets):
+            return
+        for record_type, _, us, topic, flags, payload in self._records(self._segment_offsets[i], self._end, {}):
+            if record_type != CaptureWriter.MESSAGE_RECORD or us < start_us:
+                continue
+            if end_us is not None and us >= end_us:
+                return
+            yield us, topic, flags & 3, bool(flags & 4), payload
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+
+class TopicRecorder:
+    # keep the qos the messages were published with
+    subscription_qos = 2
+    # the messages that wait to be written, the broker holds on to the rest
+    queue_size = 10000
+
+    def __init__(self, host, port, path, topic_filters=None, excluded_topic_filters=None, duration=None, quiet=False, metrics=None, metrics_file=None, metrics_interval=5.0):
+        self._host = host
+        self._port = port
+        self._path = path
+        if not topic_filters:
+            topic_filters = ["#"]
+        self._topic_filters = reduce_topic_filters(topic_filters)
+        self._excluded = TopicTrie(excluded_topic_filters or [])
+        self._duration = duration
+        self._quiet = quiet
+        self._progress = Progress(quiet)
+        self._metrics = metrics
+        self._metrics_writer = create_metrics_writer(metrics, metrics_file, metrics_interval)
+        self._writer = None
+        self._client = None
+
+    def run(self):
+        asyncio.run(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        self._writer = CaptureWriter(self._path)
+        if self._metrics is not None:
+            self._metrics.counter("tooling_recorded_total", "Messages written to the capture.", lambda: self._writer.messages)
+        if self._metrics_writer is not None:
+            self._metrics_writer.start()
+        self._client = async_mqtt.AsyncClient(self._host, self._port, queue_size=self.queue_size, overflow=async_mqtt.BLOCK)
         self._client.on_connect = self._on_connect
-        self._client.on_message = self._on_message
         self._client.on_disconnect = self._on_disconnect
-        self._client.connect(self._host, self._port, 60)
-        self._client.subscribe("#")
-        self._client.loop_start()
-
-        # wait for connection to be established
-        while not self._connected:
-            time.sleep(0.1)
-        
-        alive = True
-        while alive:
-            retained_messages = {}
-            try:
-                msg = self._inbound_messages.get(timeout=1.0)
-                if msg.retain:
-                    retained_messages[msg.topic] = msg
-                    print("--> {0}[QoS{1}, Retain={2}]: {3}".format(msg.topic, msg.qos, msg.retain, ""))
-                    self._client.publish(msg.topic, qos=1, retain=1, payload="")
-                elif msg.topic in retained_messages:
-                    retained_messages.pop(msg.topic)
-            except queue.Empty:
-                if len(retained_messages) > 0:
-                    print("No new message but there are pending retained messages..")
-                else:
-                    print("No new message within the last 1.0 second, terminating..")
-                    alive = False
-
-    def _on_message(self, client, userdata, msg):
-        print("<-- {0}[QoS{1}, Retain={2}]: {3}".format(msg.topic, msg.qos, msg.retain, msg.payload.decode('utf8')))
-        self._inbound_messages.put(msg)
-
-    def _on_connect(self, client, userdata, flags, rc):
-        print("Connected to {0}:{1}".format(self._host, self._port))
-        self._connected = True
-
-    def _on_disconnect(self, client, userdata, rc):
-        print("Disconnected from {0}:{1}".format(self._host, self._port))
-        self._connected = False
+        if self._metrics is not None:
+            self._client.register_metrics(self._metrics, connection="record")
+        await self._client.connect()
+        for signum in [signal.SIGINT, signal.SIGTERM]:
+            loop.add_signal_handler(signum, self._stop)
+        if self._duration is not None:
+            loop.call_later(self._duration, self._stop)
+        started_on = time.monotonic()
+        async for msg in self._client:
+            if self._excluded.matches(msg.topic):
+                continue
+            # paho stamps the messages with the monotonic clock as they are read
+            self._writer.append(msg.timestamp, msg.topic, msg.qos, msg.retain, msg.payload)
+            self._progress.print(self._get_progress_line)
+        elapsed = max(time.monotonic() - started_on, 0.001)
+        self._writer.close()
+        if self._metrics_writer is not None:
+            self._metrics_writer.close()
+        self._progress.print(self._get_progress_line, force=True)
+        print("Recorded {0} messages ({1} bytes) to {2} in {3:.2f} seconds".format(self._writer.messages, self._writer.size, self._path, elapsed))
+
+    def _stop(self):
+        # the messages that were received already are still written
+        asyncio.ensure_future(self._client.close())
+
+    def _get_progress_line(self):
+        return "Recorded {0} messages".format(self._writer.messages)
+
+    def _on_connect(self):
+        if not self._quiet:
+            print("Connected to {0}:{1}".format(self._host, self._port))
+        self._client.subscribe([(topic_filter, self.subscription_qos) for topic_filter in self._topic_filters])
+
+    def _on_disconnect(self):
+        if not self._quiet:
+            print("Disconnected from {0}:{1}".format(self._host, self._port))
+
+
+class CaptureReplay:
+    # Republishes a capture with the timing it was recorded with, sped up by the
+    # speed or as fast as the windows allow with a speed of 0. Every message is due
+    # at an absolute time, so being late once does not delay the messages after it,
+    # and the replay only sleeps when the next message is due later than the slack,
+    # the messages that are due together are published at once.
+    SLACK = 0.0005
+
+    def __init__(self, host, port, path, connections=1, shard_by="hash", window=100, speed=1.0, start=None, end=None, loop=False, quiet=False, metrics=None, metrics_file=None, metrics_interval=5.0):
+        self._path = path
+        self._shard_by = shard_by
+        self._speed = speed
+        self._start = start
+        self._end = end
+        self._loop = loop
+        self._quiet = quiet
+        self._progress = Progress(quiet)
+        self._publishers = [async_mqtt.AsyncClient(host, port, max_inflight=window) for _ in range(connections)]
+        self._replayed = 0
+        if metrics is not None:
+            for i, publisher in enumerate(self._publishers):
+                publisher.register_metrics(metrics, connection=i)
+            self._lateness = metrics.histogram("tooling_replay_lateness_seconds", "Seconds the replayed messages were published after they were due.")
+        else:
+            self._lateness = None
+        self._metrics_writer = create_metrics_writer(metrics, metrics_file, metrics_interval)
+
+    def run(self):
+        asyncio.run(self._run())
+
+    async def _run(self):
+        reader = CaptureReader(self._path)
+        if not reader.complete:
+            print("{0} is incomplete, replaying the messages up to where the recording was interrupted".format(self._path))
+        start_us = int((self._start or 0) * 1e6)
+        if self._end is not None:
+            end_us = int(self._end * 1e6)
+        else:
+            end_us = reader.last_us + 1
+        if self._lateness is None:
+            self._lateness = metrics.Histogram()
+        if self._metrics_writer is not None:
+            self._metrics_writer.start()
+        for publisher in self._publishers:
+            await publisher.connect()
+        started_on = time.monotonic()
+        replay = asyncio.ensure_future(self._replay(reader, start_us, end_us, started_on))
+        # an interrupt stops the replay, the messages in flight are still waited for
+        loop = asyncio.get_running_loop()
+        for signum in [signal.SIGINT, signal.SIGTERM]:
+            loop.add_signal_handler(signum, replay.cancel)
+        try:
+            await replay
+        except asyncio.CancelledError:
+            pass
+        for publisher in self._publishers:
+            await publisher.drain()
+        elapsed = max(time.monotonic() - started_on, 0.001)
+        for publisher in self._publishers:
+            await publisher.close()
+        if self._metrics_writer is not None:
+            self._metrics_writer.close()
+        reader.close()
+        self._progress.print(self._get_progress_line, force=True)
+        print("Replayed {0} messages from {1} in {2:.2f} seconds ({3:.0f} messages/s) over {4} connections".format(
+            self._replayed, self._path, elapsed, self._replayed / elapsed, len(self._publishers)))
+        if self._speed > 0 and self._lateness.count > 0:
+            print("Published late by at most {0} seconds for 50% of the messages and {1} seconds for 99%".format(
+                self._lateness.quantile(0.5), self._lateness.quantile(0.99)))
+
+    async def _replay(self, reader, start_us, end_us, base):
+        while True:
+            replayed = self._replayed
+            for us, topic, qos, retain, payload in reader.read(start_us, end_us):
+                if self._speed > 0:
+                    due_on = base + (us - start_us) / 1e6 / self._speed
+                    delay = due_on - time.monotonic()
+                    if delay > self.SLACK:
+                        await asyncio.sleep(delay)
+                        delay = due_on - time.monotonic()
+                    self._lateness.observe(max(-delay, 0.0))
+                publisher = shard(self._publishers, topic, self._shard_by)
+                if publisher.in_flight >= publisher.max_inflight:
+                    await publisher.wait_for_window()
+                publisher.publish_nowait(topic, payload, qos, retain)
+                self._replayed += 1
+                self._progress.print(self._get_progress_line)
+            if not self._loop or self._replayed == replayed:
+                return
+            if self._speed > 0:
+                # the next round starts where this one would have ended
+                base += (end_us - start_us) / 1e6 / self._speed
+
+    def _get_progress_line(self):
+        published = sum(publisher.published for publisher in self._publishers)
+        in_flight = sum(publisher.in_flight for publisher in self._publishers)
+        return "Replayed {0} messages, {1} acknowledged, {2} in flight".format(self._replayed, published, in_flight)
 
 
 def main():
     command_publish_null_foreach_retained = "publish-null-foreach-retained"
+    command_snapshot = "snapshot"
+    command_restore = "restore"
+    command_inventory = "inventory"
+    command_record = "record"
+    command_replay = "replay"
     parser = argparse.ArgumentParser(description="Publish temperature sensors of this machine.")
     parser.add_argument("--host", help="the host of the mqtt broker")
     parser.add_argument("--port", type=int, help="the port of the mqtt broker")
-    parser.add_argument("command", choices=[command_publish_null_foreach_retained])
+    parser.add_argument("--filter", action="append", help="a topic filter to purge, snapshot, inventory or record, may be given more than once, defaults to #")
+    parser.add_argument("--exclude", action="append", help="a topic filter to keep or leave out of the snapshot, inventory or recording, may be given more than once")
+    parser.add_argument("--dry-run", action="store_true", help="only count the retained topics that would be purged")
+    parser.add_argument("--file", help="the snapshot file to write or restore, defaults to retained.snapshot, or the capture to record or replay, defaults to traffic.capture")
+    parser.add_argument("--connections", type=int, help="the number of connections to purge or restore over, defaults to 1")
+    parser.add_argument("--shard-by", choices=["hash", "prefix"], help="shard topics over the connections by the hash of the whole topic or of its top level, defaults to hash")
+    parser.add_argument("--window", type=int, help="the number of publishes in flight at once per connection, defaults to 100")
+    parser.add_argument("--idle-timeout", type=float, help="the seconds without new retained messages after which the purge or snapshot completes, defaults to 5.0")
+    parser.add_argument("--depth", type=int, help="the number of topic levels the inventory groups topics by, defaults to 1")
+    parser.add_argument("--top", type=int, help="the number of prefixes and largest topics the inventory lists, defaults to 10")
+    parser.add_argument("--sample", type=int, help="the number of payloads the inventory samples, defaults to 10")
+    parser.add_argument("--sketch-size", type=int, help="the number of prefixes the inventory counts at once, counts are approximate beyond that, defaults to 1000")
+    parser.add_argument("--format", choices=["table", "json"], help="print the inventory as a table or as json, defaults to table")
+    parser.add_argument("--duration", type=float, help="the seconds to record, defaults to recording until interrupted")
+    parser.add_argument("--speed", type=float, help="how many times faster than recorded to replay, 0 replays as fast as possible, defaults to 1.0")
+    parser.add_argument("--start", type=float, help="the seconds into the capture to start replaying at, defaults to the start")
+    parser.add_argument("--end", type=float, help="the seconds into the capture to stop replaying at, defaults to the end")
+    parser.add_argument("--loop", action="store_true", help="replay the capture or the range of it over and over again")
+    parser.add_argument("--metrics-file", help="a file the metrics of the command are written to in the prometheus text format while it runs and once it is done")
+    parser.add_argument("--metrics-interval", type=float, help="the seconds between writing the metrics file, defaults to 5.0")
+    parser.add_argument("--quiet", action="store_true", help="do not print progress")
+    parser.add_argument("command", choices=[command_publish_null_foreach_retained, command_snapshot, command_restore, command_inventory, command_record, command_replay])
     args = parser.parse_args()
 
     if args.host:
@@ -72,10 +1078,81 @@ def main():
         port = args.port
     else:
         port = 1883
+    if args.file:
+        path = args.file
+    elif args.command in [command_record, command_replay]:
+        path = "traffic.capture"
+    else:
+        path = "retained.snapshot"
+    if args.connections:
+        connections = args.connections
+    else:
+        connections = 1
+    if args.shard_by:
+        shard_by = args.shard_by
+    else:
+        shard_by = "hash"
+    if args.window:
+        window = args.window
+    else:
+        window = 100
+    if args.idle_timeout:
+        idle_timeout = args.idle_timeout
+    else:
+        idle_timeout = 5.0
+    if args.depth:
+        depth = args.depth
+    else:
+        depth = 1
+    if args.top:
+        top = args.top
+    else:
+        top = 10
+    if args.sample is not None:
+        sample = args.sample
+    else:
+        sample = 10
+    if args.sketch_size:
+        sketch_size = args.sketch_size
+    else:
+        sketch_size = 1000
+    if args.format:
+        output_format = args.format
+    else:
+        output_format = "table"
+    if args.speed is not None:
+        speed = args.speed
+    else:
+        speed = 1.0
+    if args.metrics_interval:
+        metrics_interval = args.metrics_interval
+    else:
+        metrics_interval = 5.0
+    if args.metrics_file:
+        command_metrics = metrics.Metrics({"command": args.command})
+    else:
+        command_metrics = None
     if args.command == command_publish_null_foreach_retained:
-        node = PublishNullForeachRetained(host, port)
+        node = PublishNullForeachRetained(host, port, args.filter, args.exclude, connections, shard_by, window, idle_timeout, args.dry_run, args.quiet, command_metrics, args.metrics_file, metrics_interval)
+        node.run()
+    elif args.command == command_snapshot:
+        node = SnapshotRetained(host, port, path, args.filter, args.exclude, idle_timeout, args.quiet, command_metrics, args.metrics_file, metrics_interval)
+        node.run()
+    elif args.command == command_restore:
+        node = RestoreSnapshot(host, port, path, connections, shard_by, window, args.quiet, command_metrics, args.metrics_file, metrics_interval)
+        node.run()
+    elif args.command == command_inventory:
+        # the json goes to stdout, keep the progress out of it
+        node = RetainedInventory(host, port, args.filter, args.exclude, idle_timeout, args.quiet or output_format == "json", depth, top, sample, sketch_size, output_format, command_metrics, args.metrics_file, metrics_interval)
+        node.run()
+    elif args.command == command_record:
+        node = TopicRecorder(host, port, path, args.filter, args.exclude, args.duration, args.quiet, command_metrics, args.metrics_file, metrics_interval)
+        node.run()
+    elif args.command == command_replay:
+        node = CaptureReplay(host, port, path, connections, shard_by, window, speed, args.start, args.end, args.loop, args.quiet, command_metrics, args.metrics_file, metrics_interval)
         node.run()
     else:
         print("Unknown command")
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
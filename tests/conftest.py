@@ -0,0 +1,59 @@
+import importlib.util
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src", "common"))
+
+def load_program(name):
+    # every program is a main.py of its own, so they are loaded under their directory name
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, "src", name, "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+@pytest.fixture(scope="session")
+def tooling():
+    return load_program("tooling")
+
+@pytest.fixture(scope="session")
+def chat_client():
+    return load_program("chat_client")
+
+@pytest.fixture(scope="session")
+def publish_temperature_stateful():
+    return load_program("publish_temperature_stateful")
+
+@pytest.fixture(scope="session")
+def liveness_monitor():
+    return load_program("liveness_monitor")
+
+@pytest.fixture(scope="session")
+def temperature_alarm_engine():
+    return load_program("temperature_alarm_engine")
+
+@pytest.fixture(scope="session")
+def broker():
+    # the python broker of the benchmarks on a free local port
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, "bench", "broker.py"), "--port", "{0}".format(port)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30.0
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1.0).close()
+            break
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError("The broker did not start listening on port {0}".format(port))
+            time.sleep(0.05)
+    yield port
+    process.terminate()
+    process.wait()
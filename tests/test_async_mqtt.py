@@ -0,0 +1,186 @@
+import asyncio
+import struct
+
+import pytest
+
+import async_mqtt
+
+async def wait_until(predicate, timeout=5.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError("timed out")
+        await asyncio.sleep(0.01)
+
+async def start_mute_broker(messages=0):
+    # acknowledges the connect, sends messages publishes with qos 0 and ignores
+    # everything else, publishes with qos 1 and 2 are never acknowledged
+    async def handle(reader, writer):
+        await reader.read(1024)
+        writer.write(b"\x20\x02\x00\x00")
+        for i in range(messages):
+            body = struct.pack("!H", 3) + b"t/m" + "{0}".format(i).encode('utf8')
+            writer.write(bytes([0x30, len(body)]) + body)
+        while await reader.read(1024):
+            pass
+        writer.close()
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    return server, server.sockets[0].getsockname()[1]
+
+def test_publish_completes_on_the_acknowledgement(broker):
+    async def main():
+        client = async_mqtt.AsyncClient("127.0.0.1", broker)
+        await client.connect()
+        assert client.connected
+        # written for qos 0, PUBACK for qos 1 and PUBCOMP for qos 2
+        assert await asyncio.gather(*[client.publish_nowait("test/ack", b"x", qos=qos) for qos in range(3)]) == [True, True, True]
+        assert client.published == 3
+        assert client.in_flight == 0
+        await client.close()
+        assert not client.connected
+    asyncio.run(main())
+
+def test_window_full(broker):
+    async def main():
+        client = async_mqtt.AsyncClient("127.0.0.1", broker, max_inflight=10)
+        await client.connect()
+        futures = [client.publish_nowait("test/window", b"x", qos=1) for _ in range(10)]
+        assert client.in_flight == 10
+        with pytest.raises(async_mqtt.WindowFull):
+            client.publish_nowait("test/window", b"x", qos=1)
+        assert await asyncio.gather(*futures) == [True] * 10
+        assert client.in_flight == 0
+        # publish waits for room in the window instead
+        futures = [client.publish_nowait("test/window", b"x", qos=1) for _ in range(10)]
+        assert await client.publish("test/window", b"x", qos=2)
+        assert all(future.done() for future in futures)
+        await client.close()
+    asyncio.run(main())
+
+async def receive_burst(port, overflow, count=50, queue_size=10):
+    # subscribes with a small queue and publishes a burst without iterating
+    receiver = async_mqtt.AsyncClient("127.0.0.1", port, queue_size=queue_size, overflow=overflow)
+    await receiver.connect()
+    assert await receiver.subscribe("test/{0}".format(overflow)) == (0,)
+    sender = async_mqtt.AsyncClient("127.0.0.1", port, max_inflight=count)
+    await sender.connect()
+    for i in range(count):
+        sender.publish_nowait("test/{0}".format(overflow), "{0}".format(i))
+    await sender.drain()
+    await sender.close()
+    return receiver
+
+def get_payloads(client):
+    return [int(msg.payload) for msg in client._messages]
+
+def test_overflow_drop_newest(broker):
+    async def main():
+        receiver = await receive_burst(broker, async_mqtt.DROP_NEWEST)
+        await wait_until(lambda: receiver.dropped == 40)
+        assert get_payloads(receiver) == list(range(10))
+        await receiver.close()
+    asyncio.run(main())
+
+def test_overflow_drop_oldest(broker):
+    async def main():
+        receiver = await receive_burst(broker, async_mqtt.DROP_OLDEST)
+        await wait_until(lambda: receiver.dropped == 40)
+        assert get_payloads(receiver) == list(range(40, 50))
+        await receiver.close()
+    asyncio.run(main())
+
+def test_overflow_block(broker):
+    async def main():
+        receiver = await receive_burst(broker, async_mqtt.BLOCK)
+        # reading stops once the queue is full, the broker holds on to the rest
+        await wait_until(lambda: receiver._reading_paused)
+        await asyncio.sleep(0.1)
+        assert receiver.queued < 50
+        payloads = []
+        async for msg in receiver:
+            payloads.append(int(msg.payload))
+            if len(payloads) == 50:
+                break
+        assert payloads == list(range(50))
+        assert receiver.dropped == 0
+        assert not receiver._reading_paused
+        await receiver.close()
+    asyncio.run(main())
+
+def test_close_fails_the_publishes_in_flight():
+    async def main():
+        server, port = await start_mute_broker()
+        client = async_mqtt.AsyncClient("127.0.0.1", port)
+        await client.connect()
+        futures = [client.publish_nowait("test/close", b"x", qos=qos) for qos in [1, 2]]
+        await client.close(timeout=0.2)
+        assert [future.result() for future in futures] == [False, False]
+        assert client.in_flight == 0
+        server.close()
+    asyncio.run(main())
+
+def test_close_while_reading_is_paused():
+    async def main():
+        server, port = await start_mute_broker(messages=20)
+        client = async_mqtt.AsyncClient("127.0.0.1", port, queue_size=5, overflow=async_mqtt.BLOCK)
+        await client.connect()
+        await wait_until(lambda: client._reading_paused)
+        # the disconnect does not get through, the socket is shut down instead
+        client._client.disconnect = lambda: None
+        await asyncio.wait_for(client.close(timeout=0.2), 5.0)
+        assert not client.connected
+        server.close()
+    asyncio.run(main())
+
+def test_close_gives_up_on_the_connection():
+    async def main():
+        server, port = await start_mute_broker(messages=20)
+        client = async_mqtt.AsyncClient("127.0.0.1", port, queue_size=5, overflow=async_mqtt.BLOCK)
+        await client.connect()
+        await wait_until(lambda: client._reading_paused)
+        # neither the disconnect nor the end of the connection get through
+        client._client.disconnect = lambda: None
+        client._resume_reading = lambda: None
+        await asyncio.wait_for(client.close(timeout=0.2), 5.0)
+        assert not client.connected
+        assert client.disconnects == 1
+        server.close()
+    asyncio.run(main())
+
+def test_publish_while_disconnected(broker):
+    async def main():
+        client = async_mqtt.AsyncClient("127.0.0.1", broker)
+        await client.connect()
+        client.drop(downtime=60.0)
+        await wait_until(lambda: not client.connected)
+        # qos 0 is lost right away, qos 1 waits for the reconnect or the close
+        assert not await client.publish_nowait("test/offline", b"x", qos=0)
+        future = client.publish_nowait("test/offline", b"x", qos=1)
+        await client.close()
+        assert future.result() is False
+    asyncio.run(main())
+
+def test_drop_reconnects(broker):
+    async def main():
+        client = async_mqtt.AsyncClient("127.0.0.1", broker)
+        connects = []
+        client.on_connect = lambda: connects.append(client.connected)
+        await client.connect()
+        client.drop(downtime=0.1)
+        await wait_until(lambda: len(connects) == 2)
+        assert client.disconnects == 1
+        assert client.connected
+        assert await client.publish("test/drop", b"x", qos=1)
+        await client.close()
+        assert client.disconnects == 2
+    asyncio.run(main())
+
+def test_connect_refused():
+    async def main():
+        server, port = await start_mute_broker()
+        server.close()
+        await server.wait_closed()
+        client = async_mqtt.AsyncClient("127.0.0.1", port, connect_timeout=2.0)
+        with pytest.raises(OSError):
+            await client.connect()
+    asyncio.run(main())
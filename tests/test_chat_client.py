@@ -0,0 +1,345 @@
+import json
+import os
+import threading
+
+import paho.mqtt.client as paho
+import pytest
+
+class FakeUI:
+    def __init__(self):
+        self.messages = []
+        self.window = ""
+
+    def set_history(self, history, name=""):
+        pass
+
+    def open_window(self, name):
+        pass
+
+    def close_window(self, name):
+        pass
+
+    def switch_window(self, name):
+        self.window = name
+
+    def get_window(self):
+        return self.window
+
+    def chatbuffer_addmessage(self, author, message, name=None):
+        self.messages.append((author, message, name))
+
+
+class FakeMQTTClient:
+    def __init__(self):
+        self.subscribed = []
+        self.unsubscribed = []
+
+    def subscribe(self, topics):
+        self.subscribed.append(topics)
+
+    def unsubscribe(self, topics):
+        self.unsubscribed.append(topics)
+
+
+class FakeLoopThread:
+    def call(self, callback, *args):
+        callback(*args)
+
+
+def create_client(chat_client, wire_format="compact"):
+    client = chat_client.ChatClient(FakeUI(), nickname="alice", client_id="alice", wire_format=wire_format, channels=["general"])
+    # the publishes are recorded instead of handed to the event loop thread
+    client.published = []
+    client._mqtt_client = object()
+    client._publish = lambda topic, payload=None, qos=0, retain=False: client.published.append((topic, payload, retain))
+    return client
+
+def receive(client, topic, payload):
+    msg = paho.MQTTMessage(topic=topic.encode('utf8'))
+    msg.payload = payload
+    client._on_message(msg)
+
+def announce(client, client_id, formats, current_format="json"):
+    meta = {"formats": formats, "format": current_format, "sender": 42, "authors": {}}
+    receive(client, "chat/channel/general/meta/{0}".format(client_id), json.dumps(meta).encode('utf8'))
+
+def test_compact_message_round_trip(chat_client):
+    encoder = chat_client.CompactEncoder(7, "none")
+    decoder = chat_client.CompactDecoder()
+    first = encoder.encode("alice", "hello")
+    assert decoder.is_compact(first)
+    # the author is announced with the first message only
+    assert decoder.decode(first) == [("alice", "hello")]
+    second = encoder.encode("alice", "again")
+    assert len(second) < len(first)
+    assert decoder.decode(second) == [("alice", "again")]
+
+def test_compact_frames_are_no_json(chat_client):
+    decoder = chat_client.CompactDecoder()
+    assert not decoder.is_compact(json.dumps(["alice", "hello"]).encode('utf8'))
+    assert not decoder.is_compact(b"")
+
+@pytest.mark.parametrize("compression", ["none", "zlib", "zstd"])
+def test_compact_batch_round_trip(chat_client, compression):
+    if compression == "zstd" and chat_client.zstandard is None:
+        pytest.skip("zstandard is not installed")
+    encoder = chat_client.CompactEncoder(1, compression)
+    decoder = chat_client.CompactDecoder()
+    messages = [("author{0}".format(i % 3), "message number {0} with ünïcödé".format(i)) for i in range(50)]
+    assert decoder.decode(encoder.encode_batch(messages)) == messages
+    assert decoder.decode(encoder.encode_batch(messages[:2])) == messages[:2]
+
+def test_compact_long_messages_are_cut(chat_client):
+    encoder = chat_client.CompactEncoder(1, "none")
+    decoder = chat_client.CompactDecoder()
+    [(author, message)] = decoder.decode(encoder.encode("alice", "x" * 70000))
+    assert author == "alice"
+    assert len(message) == 0xffff
+
+def test_compact_authors_are_scoped_by_sender(chat_client):
+    alice = chat_client.CompactEncoder(1, "none")
+    bob = chat_client.CompactEncoder(2, "none")
+    decoder = chat_client.CompactDecoder()
+    assert decoder.decode(alice.encode("alice", "hi")) == [("alice", "hi")]
+    assert decoder.decode(bob.encode("bob", "hi")) == [("bob", "hi")]
+    assert decoder.decode(alice.encode("alice", "again")) == [("alice", "again")]
+
+def test_compact_authors_from_metadata(chat_client):
+    encoder = chat_client.CompactEncoder(3, "none")
+    encoder.encode("alice", "before we joined")
+    late = chat_client.CompactDecoder()
+    payload = encoder.encode("alice", "after we joined")
+    assert late.decode(payload) == [("unknown-0", "after we joined")]
+    late.add_authors(3, encoder.get_authors())
+    assert late.decode(payload) == [("alice", "after we joined")]
+
+def test_compact_unsupported_version(chat_client):
+    decoder = chat_client.CompactDecoder()
+    payload = bytearray(chat_client.CompactEncoder(1, "none").encode("alice", "hello"))
+    payload[0] = 0xc2
+    with pytest.raises(ValueError):
+        decoder.decode(bytes(payload))
+
+def test_json_by_default(chat_client):
+    client = create_client(chat_client, wire_format=None)
+    announce(client, "bob", ["compact1", "json"])
+    assert not client._channels["general"].compact
+
+def test_compact_once_every_peer_advertises_it(chat_client):
+    client = create_client(chat_client)
+    channel = client._channels["general"]
+    assert not channel.compact
+    announce(client, "bob", ["compact1", "json"])
+    assert channel.compact
+    # our own meta does not count
+    announce(client, "alice", ["json"])
+    assert channel.compact
+    client.published = []
+    announce(client, "carol", ["json"])
+    assert not channel.compact
+    # the other clients learn that we switched back
+    [(topic, payload, retain)] = client.published
+    assert topic == "chat/channel/general/meta/alice"
+    assert json.loads(payload)["format"] == "json"
+    assert retain
+    # carol left the channel
+    receive(client, "chat/channel/general/meta/carol", b"")
+    assert channel.compact
+
+def test_json_when_an_unannounced_client_shows_up(chat_client):
+    client = create_client(chat_client)
+    channel = client._channels["general"]
+    announce(client, "bob", ["compact1", "json"], "compact1")
+    assert channel.compact
+    # a json message while every announced client sends compact frames comes from an old client
+    receive(client, "chat/channel/general/message", json.dumps(["dave", "hi"]).encode('utf8'))
+    assert not channel.compact
+    assert ("dave", "hi", "general") in client._ui.messages
+    announce(client, "bob", ["compact1", "json"], "compact1")
+    assert not channel.compact
+
+def test_own_json_messages_are_no_old_clients(chat_client):
+    client = create_client(chat_client)
+    channel = client._channels["general"]
+    client._send_message_as("alice", "before")
+    announce(client, "bob", ["compact1", "json"], "compact1")
+    assert channel.compact
+    # the echo of the message we sent in json before switching
+    receive(client, "chat/channel/general/message", json.dumps(["alice", "before"]).encode('utf8'))
+    assert channel.compact
+
+def connect(client):
+    client._mqtt_client = FakeMQTTClient()
+    client._loop_thread = FakeLoopThread()
+    return client._mqtt_client
+
+def test_join_rejects_wildcards(chat_client):
+    client = create_client(chat_client)
+    mqtt_client = connect(client)
+    client._join_channels(["a/b", "+", "c#", "news"])
+    assert list(client._channels) == ["general", "news"]
+    assert [message for _, message, _ in client._ui.messages] == ["Cannot join {0}: channel names must not contain +, # or /".format(name) for name in ["a/b", "+", "c#"]]
+    assert mqtt_client.subscribed == [[("chat/channel/news/message", 2), ("chat/channel/news/meta/+", 2)]]
+
+def test_connect_joins_again(chat_client):
+    client = create_client(chat_client)
+    channel = client._channels["general"]
+    announce(client, "bob", ["compact1", "json"])
+    assert channel.compact
+    mqtt_client = connect(client)
+    client.published = []
+    client._on_connect()
+    # the negotiation starts over with the metadata the other clients publish again
+    assert not channel.compact
+    assert channel.peers == {}
+    assert mqtt_client.subscribed == [[("chat/channel/general/message", 2), ("chat/channel/general/meta/+", 2)]]
+    assert [topic for topic, _, _ in client.published] == ["chat/channel/general/meta/alice", "chat/channel/general/message"]
+
+def test_messages_wait_for_the_input_loop(chat_client):
+    client = create_client(chat_client)
+    channel = client._channels["general"]
+    with client._lock:
+        # the event loop thread receives a message while the input loop changes the channels
+        thread = threading.Thread(target=announce, args=(client, "bob", ["compact1", "json"]))
+        thread.start()
+        thread.join(0.1)
+        assert thread.is_alive()
+        assert channel.peers == {}
+    thread.join()
+    assert channel.compact
+
+def test_history_round_trip(chat_client, tmp_path):
+    directory = str(tmp_path)
+    history = chat_client.ChatHistory(directory, "general/ü")
+    history.append(1.5, [("alice", "hello world")])
+    history.append(2.5, [("bob", "hello alice"), ("alice", "how are you")])
+    assert len(history) == 3
+    assert history.read(0, 10) == [(1.5, "alice", "hello world"), (2.5, "bob", "hello alice"), (2.5, "alice", "how are you")]
+    assert history.read(1, 2) == [(2.5, "bob", "hello alice")]
+    history.close()
+    # the log and the index are found again by the name of the channel
+    history = chat_client.ChatHistory(directory, "general/ü")
+    try:
+        assert len(history) == 3
+        history.append(3.5, [("carol", "hi")])
+        assert history.read(2, 4) == [(2.5, "alice", "how are you"), (3.5, "carol", "hi")]
+    finally:
+        history.close()
+
+def test_history_search(chat_client, tmp_path):
+    directory = str(tmp_path)
+    history = chat_client.ChatHistory(directory, "search")
+    history.append(1.0, [("alice", "the broker is down"), ("bob", "which broker"), ("alice", "the one in the lab")])
+    assert history.search("BROKER", 10) == (2, [(1.0, "alice", "the broker is down"), (1.0, "bob", "which broker")])
+    assert history.search("alice broker", 10) == (1, [(1.0, "alice", "the broker is down")])
+    assert history.search("broker", 1) == (2, [(1.0, "bob", "which broker")])
+    assert history.search("nothing", 10) == (0, [])
+    history.close()
+    # the saved word index is extended by the records logged after it
+    history = chat_client.ChatHistory(directory, "search")
+    history.append(2.0, [("carol", "the broker is up again")])
+    history.close()
+    history = chat_client.ChatHistory(directory, "search")
+    try:
+        assert history.search("broker", 10)[0] == 3
+        assert history.search("again", 10) == (1, [(2.0, "carol", "the broker is up again")])
+    finally:
+        history.close()
+
+def test_history_recovers_after_crash(chat_client, tmp_path):
+    directory = str(tmp_path)
+    history = chat_client.ChatHistory(directory, "crash")
+    history.append(1.0, [("alice", "one"), ("alice", "two")])
+    history.close()
+    log_path = os.path.join(directory, "crash.log")
+    index_path = os.path.join(directory, "crash.index")
+    # a record that made it into the log but not into the index, and one that was cut off
+    record = chat_client.ChatHistory.RECORD.pack(2.0, 3, 5) + b"bob" + b"three"
+    with open(log_path, "ab") as f:
+        f.write(record)
+        f.write(record[:-2])
+    with open(index_path, "ab") as f:
+        f.write(b"\0\0\0")
+    history = chat_client.ChatHistory(directory, "crash")
+    try:
+        assert len(history) == 3
+        assert history.read(0, 3) == [(1.0, "alice", "one"), (1.0, "alice", "two"), (2.0, "bob", "three")]
+        assert history.search("three", 10) == (1, [(2.0, "bob", "three")])
+        history.append(3.0, [("carol", "four")])
+        assert history.read(3, 4) == [(3.0, "carol", "four")]
+    finally:
+        history.close()
+
+def test_history_ignores_a_broken_word_index(chat_client, tmp_path):
+    directory = str(tmp_path)
+    history = chat_client.ChatHistory(directory, "words")
+    history.append(1.0, [("alice", "hello")])
+    history.close()
+    with open(os.path.join(directory, "words.words"), "r+b") as f:
+        f.truncate(os.path.getsize(f.name) - 1)
+    history = chat_client.ChatHistory(directory, "words")
+    try:
+        assert history.search("hello", 10) == (1, [(1.0, "alice", "hello")])
+    finally:
+        history.close()
+
+def test_prefix_trie(chat_client):
+    trie = chat_client.PrefixTrie()
+    for sequence, command in enumerate(["/join a", "/join b", "/leave a", "hello"]):
+        trie.add(command, sequence)
+    assert trie.newest("/j") == "/join b"
+    assert trie.newest("/") == "/leave a"
+    assert trie.newest("/x") is None
+    assert trie.matches("/join") == ["/join b", "/join a"]
+    trie.remove("/join b")
+    assert trie.matches("/join") == ["/join a"]
+    # a command that is added again becomes the newest one
+    trie.remove("/join a")
+    trie.add("/join a", 4)
+    assert trie.newest("/") == "/join a"
+    trie.remove("/join a")
+    trie.remove("/leave a")
+    assert trie.newest("/") is None
+    assert trie.matches("") == ["hello"]
+
+def test_command_history_navigation(chat_client):
+    historian = chat_client.CommandHistorian(capacity=3)
+    assert historian.older("draft") is None
+    for command in ["/join a", "hello", "/join b"]:
+        historian.push(command)
+    assert historian.older("typing") == "/join b"
+    assert historian.older("typing") == "hello"
+    assert historian.older("typing") == "/join a"
+    assert historian.older("typing") == "/join a"
+    assert historian.newer() == "hello"
+    assert historian.newer() == "/join b"
+    # the line that was edited before comes back
+    assert historian.newer() == "typing"
+    assert historian.newer() is None
+
+def test_command_history_is_bounded_and_deduplicated(chat_client):
+    historian = chat_client.CommandHistorian(capacity=3)
+    for command in ["/join a", "hello", "/join b", "hello", "/leave b"]:
+        historian.push(command)
+    assert len(historian) == 3
+    assert historian.find("/join") == "/join b"
+    # /join a fell out of the history
+    assert historian.find("/join", 1) is None
+    assert historian.find("") == "/leave b"
+    assert historian.find("", 1) == "hello"
+    assert historian.find("", 2) == "/join b"
+
+def test_command_history_file(chat_client, tmp_path):
+    path = str(tmp_path / "history" / "input")
+    historian = chat_client.CommandHistorian(path, capacity=2)
+    for command in ["one", "two", "one", "three", "four", "three"]:
+        historian.push(command)
+    historian.close()
+    historian = chat_client.CommandHistorian(path, capacity=2)
+    assert historian.older("") == "three"
+    assert historian.older("") == "four"
+    assert historian.older("") == "four"
+    historian.close()
+    # the file is compacted once it holds more than twice the capacity
+    with open(path) as f:
+        assert f.read() == "four\nthree\n"
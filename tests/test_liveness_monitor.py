@@ -0,0 +1,38 @@
+ALIVE = 1
+DEAD = 2
+
+def test_counts(liveness_monitor):
+    index = liveness_monitor.LivenessIndex()
+    index.update("a/STATE", ALIVE, 1.0, retained=True)
+    index.update("b/STATE", DEAD, 1.0, retained=True)
+    index.update("c/state", ALIVE, 1.0)
+    index.update("c/state", DEAD, 2.0)
+    summary = index.summarize(3.0)
+    assert summary["nodes"] == 3
+    assert summary["alive"] == 1
+    assert summary["dead"] == 2
+    # retained states are no births or deaths
+    assert summary["births"] == 1
+    assert summary["deaths"] == 1
+    assert summary["recent_deaths"] == ["c"]
+    assert index.summarize(4.0)["births"] == 0
+
+def test_flapping(liveness_monitor):
+    index = liveness_monitor.LivenessIndex(flap_history=8, flap_window=300.0, flap_threshold=4)
+    now = 1000.0
+    for i in range(5):
+        index.update("a/STATE", (ALIVE, DEAD)[i % 2], now + i)
+        index.update("b/STATE", ALIVE, now + i)
+    summary = index.summarize(now + 10)
+    assert summary["flapping"] == 1
+    assert summary["top_flapping"] == [{"node": "a", "transitions": 4}]
+    # the transitions leave the flap window
+    assert index.summarize(now + 400)["flapping"] == 0
+
+def test_no_flapping_early_on(liveness_monitor):
+    # the monotonic clock may start below the flap window, the empty entries of
+    # the ring must not count as transitions then
+    index = liveness_monitor.LivenessIndex(flap_history=8, flap_window=300.0, flap_threshold=4)
+    for i in range(3):
+        index.update("a/STATE", (ALIVE, DEAD)[i % 2], 5.0 + i)
+    assert index.summarize(10.0)["flapping"] == 0
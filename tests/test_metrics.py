@@ -0,0 +1,75 @@
+import json
+
+import metrics
+
+def test_bucket_boundaries():
+    histogram = metrics.Histogram((1.0, 2.0))
+    # a bucket includes its upper bound, the last one counts what is above all bounds
+    for value in [0.0, 1.0, 1.5, 2.0, 2.5, float("inf")]:
+        histogram.observe(value)
+    assert histogram.counts == [2, 2, 2]
+    assert histogram.count == 6
+    assert histogram.sum == float("inf")
+
+def test_quantile():
+    histogram = metrics.Histogram((1.0, 2.0))
+    assert histogram.quantile(0.5) is None
+    for value in [0.5, 0.5, 1.5, 3.0]:
+        histogram.observe(value)
+    assert histogram.quantile(0.5) == 1.0
+    assert histogram.quantile(0.75) == 2.0
+    assert histogram.quantile(0.99) == float("inf")
+
+def test_register_again_keeps_counting():
+    registry = metrics.Metrics()
+    registry.counter("scans_total", "Scans.").inc()
+    registry.counter("scans_total", "Scans.").inc(2)
+    assert registry.to_dict() == {"scans_total": 3}
+
+def test_to_json():
+    registry = metrics.Metrics({"application_id": "node"})
+    registry.gauge("queued", "Queued.", lambda: 4)
+    histogram = registry.histogram("read_seconds", "Read.", bounds=(1.0,))
+    histogram.observe(0.5)
+    histogram.observe(5.0)
+    assert json.loads(registry.to_json()) == {
+        "queued{application_id=\"node\"}": 4,
+        "read_seconds{application_id=\"node\"}": {
+            "count": 2,
+            "sum": 5.5,
+            "p50": 1.0,
+            "p90": None,
+            "p99": None,
+            "buckets": [[1.0, 1], ["+Inf", 1]],
+        },
+    }
+
+def test_to_prometheus():
+    first = metrics.Metrics({"application_id": "a"})
+    second = metrics.Metrics({"application_id": "b\"\n"})
+    for registry in [first, second]:
+        registry.counter("published_total", "Publishes\nacknowledged.").inc(2)
+    histogram = first.histogram("ack_seconds", "Ack.", bounds=(0.5, 1.0), labels={"qos": 1})
+    for value in [0.25, 0.75, 2.0]:
+        histogram.observe(value)
+    assert metrics.to_prometheus([first, second]) == "\n".join([
+        "# HELP ack_seconds Ack.",
+        "# TYPE ack_seconds histogram",
+        "ack_seconds_bucket{application_id=\"a\",qos=\"1\",le=\"0.5\"} 1",
+        "ack_seconds_bucket{application_id=\"a\",qos=\"1\",le=\"1.0\"} 2",
+        "ack_seconds_bucket{application_id=\"a\",qos=\"1\",le=\"+Inf\"} 3",
+        "ack_seconds_sum{application_id=\"a\",qos=\"1\"} 3.0",
+        "ack_seconds_count{application_id=\"a\",qos=\"1\"} 3",
+        "# HELP published_total Publishes\\nacknowledged.",
+        "# TYPE published_total counter",
+        "published_total{application_id=\"a\"} 2",
+        "published_total{application_id=\"b\\\"\\n\"} 2",
+    ]) + "\n"
+
+def test_write_prometheus(tmp_path):
+    registry = metrics.Metrics()
+    registry.gauge("connected", "Connected.", lambda: 1)
+    path = tmp_path / "node.prom"
+    metrics.write_prometheus(str(path), [registry])
+    assert path.read_text() == "# HELP connected Connected.\n# TYPE connected gauge\nconnected 1\n"
+    assert [p.name for p in tmp_path.iterdir()] == ["node.prom"]
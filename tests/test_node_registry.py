@@ -0,0 +1,80 @@
+import paho.mqtt.client as paho
+
+import node_registry
+
+class Node:
+    def __init__(self):
+        self.scan_rate = 10.0
+        self.restarts = 0
+        self.published = []
+        self.registry = node_registry.NodeRegistry("node", lambda topic, payload: self.published.append((topic, payload)))
+        self.registry.add_command("restart", self.restart)
+        self.registry.add_property("scan_rate", "numeric", lambda: self.scan_rate, self.set_scan_rate, minimum=0.5, maximum=60.0, quantity="duration", unit="seconds")
+        self.registry.add_property("version", "string", lambda: "1.0", parse=str)
+
+    def restart(self):
+        self.restarts += 1
+
+    def set_scan_rate(self, scan_rate):
+        self.scan_rate = scan_rate
+
+
+def dispatch(node, topic, payload):
+    msg = paho.MQTTMessage(topic=topic.encode('utf8'))
+    msg.payload = payload.encode('utf8')
+    return node.registry.dispatch(msg)
+
+def test_subscriptions():
+    node = Node()
+    # read only properties are not subscribed
+    assert node.registry.get_subscriptions(qos=1) == [("node/command/restart", 1), ("node/property/scan_rate/set", 1)]
+
+def test_dispatch():
+    node = Node()
+    assert dispatch(node, "node/command/restart", "")
+    assert node.restarts == 1
+    assert dispatch(node, "node/property/scan_rate/set", "2.5")
+    assert node.scan_rate == 2.5
+    assert node.published == [("property/scan_rate", "2.5")]
+    for topic in ["node/command/other", "node/property/version/set", "other/command/restart", "node/property/scan_rate"]:
+        assert not dispatch(node, topic, "1")
+    assert node.restarts == 1
+
+def test_change_refuses_values_out_of_bounds(capsys):
+    node = Node()
+    for payload in ["0.25", "61", "nan", "-inf"]:
+        assert dispatch(node, "node/property/scan_rate/set", payload)
+    assert node.scan_rate == 10.0
+    assert node.published == []
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0] == "Refusing to change the scan rate to 0.25, it must be at least 0.5"
+    assert lines[1] == "Refusing to change the scan rate to 61.0, it must be at most 60.0"
+    assert len(lines) == 4
+    # the bounds are inclusive
+    assert dispatch(node, "node/property/scan_rate/set", "60")
+    assert node.scan_rate == 60.0
+
+def test_change_refuses_what_does_not_parse(capsys):
+    node = Node()
+    assert dispatch(node, "node/property/scan_rate/set", "fast")
+    assert node.scan_rate == 10.0
+    assert node.published == []
+    assert capsys.readouterr().out.startswith("Refusing to change the scan rate: could not convert")
+    msg = paho.MQTTMessage(topic=b"node/property/scan_rate/set")
+    msg.payload = b"\xff"
+    assert node.registry.dispatch(msg)
+    assert node.scan_rate == 10.0
+
+def test_publish_all():
+    node = Node()
+    node.registry.publish_all()
+    assert node.published == [("property/scan_rate", "10.0"), ("property/version", "1.0")]
+
+def test_get_birth_topics():
+    node = Node()
+    assert list(node.registry.get_birth_topics()) == [
+        {"topic": "node/command/restart", "modes": ["sub"], "type": "null"},
+        {"topic": "node/property/scan_rate", "modes": ["pub"], "type": "numeric", "quantity": "duration", "unit": "seconds"},
+        {"topic": "node/property/scan_rate/set", "modes": ["sub"], "type": "numeric", "quantity": "duration", "unit": "seconds", "minimum": 0.5, "maximum": 60.0},
+        {"topic": "node/property/version", "modes": ["pub"], "type": "string"},
+    ]
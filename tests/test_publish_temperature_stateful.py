@@ -0,0 +1,491 @@
+import json
+
+import paho.mqtt.client as paho
+import pytest
+
+class FakeBackend:
+    def __init__(self, readings):
+        # the sensors mapped to their value and unit
+        self.readings = readings
+        self.reads = []
+
+    def read(self, sensors=None):
+        self.reads.append(sensors)
+        for sensor, (value, unit) in self.readings.items():
+            if sensors is None or sensor in sensors:
+                yield sensor, value, unit
+
+    def close(self):
+        pass
+
+
+class FakeClient:
+    def __init__(self, async_mqtt, max_inflight=1000):
+        self._async_mqtt = async_mqtt
+        self.max_inflight = max_inflight
+        self.published = []
+        # publishes fail with WindowFull while this is set
+        self.full = False
+
+    @property
+    def in_flight(self):
+        return 0
+
+    def publish_nowait(self, topic, payload=None, qos=0, retain=False):
+        if self.full:
+            raise self._async_mqtt.WindowFull()
+        self.published.append((topic, payload, qos, retain))
+
+    def subscribe(self, topics):
+        pass
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(publish_temperature_stateful, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(publish_temperature_stateful.time, "monotonic", clock)
+    return clock
+
+def create_node(publish_temperature_stateful, readings, **kwargs):
+    node = publish_temperature_stateful.SensorNode("localhost", 1883, "node", kwargs.pop("scan_rate", 10.0), FakeBackend(readings), **kwargs)
+    node._client = FakeClient(publish_temperature_stateful.async_mqtt)
+    node._connected = True
+    node._was_connected = True
+    return node
+
+def set_property(node, name, payload):
+    # as if the payload was published to <id>/property/<name>/set
+    topic = "node/property/{0}/set".format(name)
+    msg = paho.MQTTMessage(topic=topic.encode('utf8'))
+    msg.payload = payload.encode('utf8')
+    assert node._registry.dispatch(msg)
+
+def get_published(node, prefix="node/property/"):
+    published = [(topic[len(prefix):], payload) for topic, payload, _, _ in node._client.published if topic.startswith(prefix)]
+    node._client.published = []
+    return published
+
+def make_hwmon(root, chips):
+    # a fake sysfs tree, the chips map the channel files to their content
+    for i, files in enumerate(chips):
+        chip = root / "hwmon{0}".format(i)
+        chip.mkdir(parents=True)
+        for name, content in files.items():
+            (chip / name).write_text(content)
+    return str(root)
+
+@pytest.fixture
+def hwmon_root(tmp_path):
+    return make_hwmon(tmp_path / "hwmon", [
+        {"name": "coretemp\n", "temp1_input": "45000\n", "temp1_label": "Package id 0\n", "temp2_input": "41500\n", "temp2_label": "Core 0\n"},
+        {"temp1_input": "38000\n", "fan1_input": "1200\n", "fan1_label": "cpu_fan\n", "in0_input": "900\n", "temp1_max": "100000\n"},
+    ])
+
+def test_hwmon_channels(publish_temperature_stateful, hwmon_root):
+    backend = publish_temperature_stateful.HwmonBackend(hwmon_root)
+    try:
+        assert len(backend) == 4
+        # channels without a label are known by their name, voltages are left out
+        assert list(backend.read()) == [
+            ("Package id 0", 45.0, "°C"),
+            ("Core 0", 41.5, "°C"),
+            ("cpu_fan", 1200.0, "RPM"),
+            ("temp1", 38.0, "°C"),
+        ]
+        assert list(backend.read({"Core 0", "cpu_fan"})) == [("Core 0", 41.5, "°C"), ("cpu_fan", 1200.0, "RPM")]
+    finally:
+        backend.close()
+
+def test_hwmon_reads_again(publish_temperature_stateful, hwmon_root, tmp_path):
+    backend = publish_temperature_stateful.HwmonBackend(hwmon_root)
+    try:
+        assert list(backend.read({"Core 0"})) == [("Core 0", 41.5, "°C")]
+        # the files stay open and are read from their start on every scan
+        (tmp_path / "hwmon" / "hwmon0" / "temp2_input").write_text("52250\n")
+        assert list(backend.read({"Core 0"})) == [("Core 0", 52.25, "°C")]
+        assert list(backend.read({"Core 0"})) == [("Core 0", 52.25, "°C")]
+    finally:
+        backend.close()
+
+def test_hwmon_skips_unreadable_channels(publish_temperature_stateful, hwmon_root, tmp_path):
+    backend = publish_temperature_stateful.HwmonBackend(hwmon_root)
+    try:
+        # a sensor that is powered down
+        (tmp_path / "hwmon" / "hwmon1" / "fan1_input").write_text("")
+        assert [sensor for sensor, _, _ in backend.read()] == ["Package id 0", "Core 0", "temp1"]
+    finally:
+        backend.close()
+
+def test_hwmon_without_chips(publish_temperature_stateful, tmp_path):
+    backend = publish_temperature_stateful.HwmonBackend(str(tmp_path))
+    assert len(backend) == 0
+    assert list(backend.read()) == []
+    backend.close()
+
+def test_parse_deadbands(publish_temperature_stateful):
+    parse = publish_temperature_stateful.parse_deadbands
+    assert parse('{"temperature": {"absolute": 0.5, "relative": 0.1}, "rate": {}}') == {"temperature": {"absolute": 0.5, "relative": 0.1}, "rate": {}}
+    for payload in ['[]', '{"temperature": 0.5}', '{"temperature": {"percent": 1}}', '{"temperature": {"absolute": -1}}', '{"temperature": {"absolute": "1"}}']:
+        with pytest.raises(ValueError):
+            parse(payload)
+    with pytest.raises(ValueError):
+        parse("not json")
+
+def test_deadband_absolute(publish_temperature_stateful, clock):
+    node = create_node(publish_temperature_stateful, {"core": (40.0, "°C"), "fan": (1000.0, "RPM")}, deadbands={"temperature": {"absolute": 0.5}})
+    node._publish_sensors()
+    assert get_published(node) == [("core", "40.0"), ("fan", "1000.0")]
+    node._sensor_backend.readings["core"] = (40.5, "°C")
+    node._sensor_backend.readings["fan"] = (1000.0, "RPM")
+    node._publish_sensors()
+    # the change must exceed the deadband, quantities without one are published on every scan
+    assert get_published(node) == [("fan", "1000.0")]
+    node._sensor_backend.readings["core"] = (39.4, "°C")
+    node._publish_sensors()
+    assert get_published(node) == [("core", "39.4"), ("fan", "1000.0")]
+
+def test_deadband_relative(publish_temperature_stateful):
+    node = create_node(publish_temperature_stateful, {}, deadbands={"temperature": {"relative": 0.1}})
+    node._last_published_values["core"] = (50.0, 0.0)
+    assert not node._is_exception("core", 54.0, "°C", 1.0)
+    assert node._is_exception("core", 44.0, "°C", 1.0)
+
+def test_deadband_relative_to_zero(publish_temperature_stateful):
+    # any change of a value that was 0 exceeds a relative deadband, no change does not
+    node = create_node(publish_temperature_stateful, {}, deadbands={"temperature": {"relative": 0.1}})
+    node._last_published_values["core"] = (0.0, 0.0)
+    assert not node._is_exception("core", 0.0, "°C", 1.0)
+    assert node._is_exception("core", 0.01, "°C", 1.0)
+    node = create_node(publish_temperature_stateful, {}, deadbands={"temperature": {"absolute": 1.0, "relative": 0.1}})
+    node._last_published_values["core"] = (0.0, 0.0)
+    assert node._is_exception("core", 0.01, "°C", 1.0)
+
+def test_deadband_without_thresholds(publish_temperature_stateful):
+    node = create_node(publish_temperature_stateful, {}, deadbands={"temperature": {}})
+    node._last_published_values["core"] = (40.0, 0.0)
+    assert not node._is_exception("core", 40.0, "°C", 1.0)
+    assert node._is_exception("core", 40.1, "°C", 1.0)
+
+def test_deadband_heartbeat(publish_temperature_stateful):
+    node = create_node(publish_temperature_stateful, {}, deadbands={"temperature": {"absolute": 5.0}}, max_silence=60.0)
+    node._last_published_values["core"] = (40.0, 0.0)
+    assert not node._is_exception("core", 40.0, "°C", 59.0)
+    assert node._is_exception("core", 40.0, "°C", 60.0)
+
+def test_deadband_set_remotely(publish_temperature_stateful, clock):
+    node = create_node(publish_temperature_stateful, {"core": (40.0, "°C")})
+    set_property(node, "deadband", json.dumps({"temperature": {"absolute": 1.0}}))
+    assert node._deadbands == {"temperature": {"absolute": 1.0}}
+    assert get_published(node) == [("deadband", '{"temperature": {"absolute": 1.0}}')]
+
+def get_birth(node):
+    published = dict((topic, payload) for topic, payload, _, _ in node._client.published)
+    node._client.published = []
+    return published.get("node/BIRTH"), published.get("node/BIRTH/version")
+
+def test_birth_is_cached(publish_temperature_stateful, clock):
+    node = create_node(publish_temperature_stateful, {"core": (40.0, "°C"), "fan": (1000.0, "RPM")})
+    node._publish_birth()
+    payload, version = get_birth(node)
+    topics = [entry["topic"] for entry in json.loads(payload)]
+    assert "node/property/core" in topics
+    assert "node/property/fan" in topics
+    assert "node/property/scan_rate/set" in topics
+    reads = len(node._sensor_backend.reads)
+    # the birth is neither read nor encoded again while the sensors stay the same
+    node._publish_sensors()
+    node._publish_birth()
+    assert get_birth(node) == (payload, version)
+    assert len(node._sensor_backend.reads) == reads + 1
+    assert node._birth[0] is payload
+
+def test_birth_changes_with_the_sensors(publish_temperature_stateful, clock):
+    node = create_node(publish_temperature_stateful, {"core": (40.0, "°C")})
+    node._publish_birth()
+    payload, version = get_birth(node)
+    node._sensor_backend.readings["fan"] = (1000.0, "RPM")
+    node._publish_sensors()
+    # a scan that finds other sensors publishes a new birth right away
+    new_payload, new_version = get_birth(node)
+    assert new_version != version
+    assert "node/property/fan" in [entry["topic"] for entry in json.loads(new_payload)]
+    # the values do not change the birth
+    node._sensor_backend.readings["fan"] = (1100.0, "RPM")
+    node._publish_sensors()
+    assert get_birth(node) == (None, None)
+
+def test_rebirth_holdoff(publish_temperature_stateful, clock):
+    node = create_node(publish_temperature_stateful, {"core": (40.0, "°C")}, rebirth_holdoff=2.0)
+    node._run_due()
+    node._client.published = []
+    node._request_rebirth()
+    due_on = node._rebirth_due_on
+    # the jitter spreads the births over the second half of the holdoff
+    assert clock.now + 1.0 <= due_on <= clock.now + 2.0
+    assert node._run_due() == due_on
+    # requests within the holdoff are coalesced into a single birth
+    node._request_rebirth()
+    assert node._rebirth_due_on == due_on
+    clock.now = due_on - 0.001
+    node._run_due()
+    assert get_birth(node) == (None, None)
+    clock.now = due_on
+    node._run_due()
+    assert get_birth(node)[0] is not None
+    node._run_due()
+    assert get_birth(node) == (None, None)
+    node._request_rebirth()
+    assert node._rebirth_due_on is not None
+
+def test_rebirth_jitter(publish_temperature_stateful, clock):
+    due_ons = set()
+    for i in range(20):
+        node = create_node(publish_temperature_stateful, {}, rebirth_holdoff=1.0)
+        node._request_rebirth()
+        due_ons.add(node._rebirth_due_on)
+    assert len(due_ons) > 1
+
+def test_parse_sensor_scan_rates(publish_temperature_stateful):
+    parse = publish_temperature_stateful.parse_sensor_scan_rates
+    assert parse('{"core": 1, "rate": 0.5}') == {"core": 1, "rate": 0.5}
+    for payload in ['[1]', '{"core": 0}', '{"core": "1"}']:
+        with pytest.raises(ValueError):
+            parse(payload)
+
+def test_schedule(publish_temperature_stateful, clock):
+    readings = {"core": (40.0, "°C"), "fan": (1000.0, "RPM"), "gpu": (50.0, "°C")}
+    node = create_node(publish_temperature_stateful, readings, scan_rate=10.0, sensor_scan_rates={"fan": 2.0})
+    started_on = clock.now
+    # all scans are due right away, the fan is scanned by its own scan only
+    assert node._run_due() == started_on + 2.0
+    assert sorted(get_published(node)) == [("core", "40.0"), ("fan", "1000.0"), ("gpu", "50.0")]
+    clock.now = started_on + 2.0
+    assert node._run_due() == started_on + 4.0
+    assert get_published(node) == [("fan", "1000.0")]
+    # scans that were missed are skipped, the deadlines do not drift
+    clock.now = started_on + 7.5
+    assert node._run_due() == started_on + 8.0
+    assert get_published(node) == [("fan", "1000.0")]
+    clock.now = started_on + 10.0
+    assert node._run_due() == started_on + 12.0
+    assert sorted(get_published(node)) == [("core", "40.0"), ("fan", "1000.0"), ("gpu", "50.0")]
+
+def test_schedule_by_quantity(publish_temperature_stateful, clock):
+    readings = {"core": (40.0, "°C"), "fan": (1000.0, "RPM"), "gpu": (50.0, "°C")}
+    node = create_node(publish_temperature_stateful, readings, scan_rate=10.0, sensor_scan_rates={"temperature": 1.0, "gpu": 5.0})
+    node._run_due()
+    get_published(node)
+    # a sensor's own scan rate wins over the one of its quantity
+    assert node._dedicated_sensors == {"core", "gpu"}
+    clock.now += 1.0
+    node._run_due()
+    assert get_published(node) == [("core", "40.0")]
+    clock.now += 4.0
+    node._run_due()
+    assert sorted(get_published(node)) == [("core", "40.0"), ("gpu", "50.0")]
+
+def test_schedule_after_a_remote_scan_rate_change(publish_temperature_stateful, clock):
+    node = create_node(publish_temperature_stateful, {"core": (40.0, "°C")}, scan_rate=10.0)
+    started_on = clock.now
+    assert node._run_due() == started_on + 10.0
+    get_published(node)
+    clock.now = started_on + 3.0
+    set_property(node, "scan_rate", "20")
+    assert node._scan_rate == 20.0
+    assert node._wakeup.is_set()
+    assert get_published(node) == [("scan_rate", "20.0")]
+    # the new scan rate starts with a scan right away
+    assert node._run_due() == started_on + 23.0
+    assert get_published(node) == [("core", "40.0")]
+    # scan rates below the minimum are refused
+    set_property(node, "scan_rate", "0.5")
+    set_property(node, "scan_rate", "nan")
+    set_property(node, "scan_rate", "fast")
+    assert node._scan_rate == 20.0
+    assert get_published(node) == []
+
+def drain(buffer):
+    readings = []
+    while True:
+        reading = buffer.pop()
+        if reading is None:
+            return readings
+        readings.append(reading)
+
+def get_readings(count, start=0):
+    return [(float(i), "property/core{0}".format(i % 4), 40.0 + i) for i in range(start, start + count)]
+
+def test_buffer_in_memory(publish_temperature_stateful, tmp_path):
+    buffer = publish_temperature_stateful.StoreAndForwardBuffer(str(tmp_path / "node.buffer"), capacity=10)
+    assert not buffer.has_backlog()
+    readings = get_readings(5)
+    for reading in readings:
+        buffer.append(*reading)
+    assert buffer.has_backlog()
+    assert drain(buffer) == readings
+    assert not buffer.has_backlog()
+    buffer.close()
+
+def test_buffer_spills_over(publish_temperature_stateful, tmp_path):
+    buffer = publish_temperature_stateful.StoreAndForwardBuffer(str(tmp_path / "node.buffer"), capacity=3)
+    readings = get_readings(10)
+    for reading in readings:
+        buffer.append(*reading)
+    assert len(buffer) == 3
+    # the oldest readings come back first, from the file
+    assert drain(buffer) == readings
+    # the file is started over once it is replayed
+    more = get_readings(5, 10)
+    for reading in more:
+        buffer.append(*reading)
+    assert drain(buffer) == more
+    buffer.close()
+
+def test_buffer_survives_a_restart(publish_temperature_stateful, tmp_path):
+    path = str(tmp_path / "node.buffer")
+    buffer = publish_temperature_stateful.StoreAndForwardBuffer(path, capacity=3)
+    readings = get_readings(8)
+    for reading in readings:
+        buffer.append(*reading)
+    buffer.close()
+    buffer = publish_temperature_stateful.StoreAndForwardBuffer(path, capacity=3)
+    assert buffer.has_backlog()
+    assert drain(buffer) == readings
+    buffer.close()
+
+def test_buffer_drops_when_full(publish_temperature_stateful, tmp_path):
+    record_size = publish_temperature_stateful.StoreAndForwardBuffer._record.size + len("property/core0")
+    buffer = publish_temperature_stateful.StoreAndForwardBuffer(str(tmp_path / "node.buffer"), capacity=2, max_spill_size=3 * record_size)
+    readings = get_readings(8)
+    for reading in readings:
+        buffer.append(*reading)
+    assert buffer.dropped == 3
+    assert drain(buffer) == readings[:3] + readings[-2:]
+    buffer.close()
+
+def test_buffer_cut_off_record(publish_temperature_stateful, tmp_path):
+    path = str(tmp_path / "node.buffer")
+    buffer = publish_temperature_stateful.StoreAndForwardBuffer(path, capacity=1)
+    readings = get_readings(4)
+    for reading in readings:
+        buffer.append(*reading)
+    buffer.close()
+    with open(path, "r+b") as f:
+        f.seek(0, 2)
+        f.truncate(f.tell() - 3)
+    buffer = publish_temperature_stateful.StoreAndForwardBuffer(path, capacity=1)
+    assert drain(buffer) == readings[:-1]
+    buffer.close()
+
+def test_buffer_peek(publish_temperature_stateful, tmp_path):
+    buffer = publish_temperature_stateful.StoreAndForwardBuffer(str(tmp_path / "node.buffer"), capacity=2)
+    assert buffer.peek() is None
+    readings = get_readings(5)
+    for reading in readings:
+        buffer.append(*reading)
+    # from the file and from memory, peeking does not take the reading
+    for reading in readings:
+        assert buffer.peek() == reading
+        assert buffer.peek() == reading
+        assert buffer.pop() == reading
+    assert buffer.peek() is None
+    buffer.close()
+
+def create_buffered_node(publish_temperature_stateful, tmp_path, readings):
+    buffer = publish_temperature_stateful.StoreAndForwardBuffer(str(tmp_path / "node.buffer"), capacity=2)
+    return create_node(publish_temperature_stateful, readings, buffer=buffer, replay_rate=30.0)
+
+def test_replay_keeps_readings_when_the_window_is_full(publish_temperature_stateful, tmp_path, clock):
+    node = create_buffered_node(publish_temperature_stateful, tmp_path, {})
+    readings = get_readings(5)
+    for reading in readings:
+        node._buffer.append(*reading)
+    node._client.full = True
+    node._replay_backlog()
+    assert node._buffer.peek() == readings[0]
+    node._client.full = False
+    # three readings per replay interval at the replay rate
+    node._replay_backlog()
+    node._replay_backlog()
+    replayed = [(topic, json.loads(payload)) for topic, payload, qos, _ in node._client.published]
+    assert replayed == [("node/history/{0}".format(topic), {"timestamp": timestamp, "value": value}) for timestamp, topic, value in readings]
+    assert not node._buffer.has_backlog()
+
+def test_readings_before_the_first_connect_are_not_buffered(publish_temperature_stateful, tmp_path, clock):
+    node = create_buffered_node(publish_temperature_stateful, tmp_path, {"core": (40.0, "°C")})
+    node._connected = False
+    node._was_connected = False
+    node._publish_sensors()
+    assert not node._buffer.has_backlog()
+    # once the node was connected the readings are kept for the replay
+    node._was_connected = True
+    node._publish_sensors()
+    assert node._buffer.peek()[1:] == ("property/core", 40.0)
+
+def test_rolling_windows_wrap_around(publish_temperature_stateful):
+    windows = publish_temperature_stateful.RollingWindows(["core", "fan"], 3)
+    for i in range(1, 6):
+        windows.append([("core", float(i)), ("fan", 10.0 * i)])
+    # the oldest samples are overwritten once the ring is full
+    assert windows._ordered().tolist() == [[3.0, 4.0, 5.0], [30.0, 40.0, 50.0]]
+    assert windows.summarize() == {
+        "core": {"min": 3.0, "max": 5.0, "mean": 4.0, "p95": 4.9, "samples": 3},
+        "fan": {"min": 30.0, "max": 50.0, "mean": 40.0, "p95": 49.0, "samples": 3},
+    }
+
+def test_rolling_windows_missing_samples(publish_temperature_stateful):
+    windows = publish_temperature_stateful.RollingWindows(["core", "fan", "gpu"], 4)
+    assert windows.summarize() == {}
+    # sensors that were not read have no samples, unknown sensors are ignored
+    windows.append([("core", 40.0), ("other", 1.0)])
+    windows.append([("core", 42.0), ("fan", 1200.0)])
+    assert windows.summarize() == {
+        "core": {"min": 40.0, "max": 42.0, "mean": 41.0, "p95": 41.9, "samples": 2},
+        "fan": {"min": 1200.0, "max": 1200.0, "mean": 1200.0, "p95": 1200.0, "samples": 1},
+    }
+    # a sample period without the sensor pushes its old samples out of the window as well
+    for _ in range(4):
+        windows.append([("core", 50.0)])
+    assert windows.summarize() == {"core": {"min": 50.0, "max": 50.0, "mean": 50.0, "p95": 50.0, "samples": 4}}
+
+def test_rolling_windows_resize(publish_temperature_stateful):
+    windows = publish_temperature_stateful.RollingWindows(["core"], 4)
+    for i in range(6):
+        windows.append([("core", float(i))])
+    # shrinking keeps the newest samples, growing keeps all of them
+    windows.resize(2)
+    assert windows._ordered().tolist() == [[4.0, 5.0]]
+    windows.resize(3)
+    assert windows._ordered().tolist() == [[4.0, 5.0]]
+    windows.append([("core", 6.0)])
+    windows.append([("core", 7.0)])
+    assert len(windows) == 3
+    assert windows._ordered().tolist() == [[5.0, 6.0, 7.0]]
+
+def test_aggregate(publish_temperature_stateful, clock):
+    readings = {"core": (40.0, "°C")}
+    node = create_node(publish_temperature_stateful, readings, sample_rate=1.0, window=3.0)
+    for value in [40.0, 41.0, 42.0, 43.0]:
+        readings["core"] = (value, "°C")
+        node._sample_sensors()
+    node._client.published = []
+    node._publish_aggregates()
+    [(topic, payload)] = get_published(node, "node/")
+    assert topic == "aggregate"
+    aggregate = json.loads(payload)
+    assert aggregate["window"] == 3.0
+    assert aggregate["sensors"] == {"core": {"min": 41.0, "max": 43.0, "mean": 42.0, "p95": 42.9, "samples": 3}}
+    # the window is changed remotely, the newest samples are kept
+    set_property(node, "window", "2")
+    node._client.published = []
+    node._publish_aggregates()
+    [(_, payload)] = get_published(node, "node/")
+    assert json.loads(payload)["sensors"]["core"]["samples"] == 2
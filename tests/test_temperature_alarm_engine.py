@@ -0,0 +1,142 @@
+import json
+
+import numpy
+import paho.mqtt.client as paho
+import pytest
+
+class FakeClient:
+    def __init__(self, async_mqtt):
+        self._async_mqtt = async_mqtt
+        self.connected = True
+        self.published = []
+        # the number of publishes that fit into the window, None for no limit
+        self.room = None
+
+    def publish_nowait(self, topic, payload=None, qos=0, retain=False):
+        if self.room is not None:
+            if self.room == 0:
+                raise self._async_mqtt.WindowFull()
+            self.room -= 1
+        self.published.append((topic, payload))
+
+
+def evaluate(table, readings, threshold=80.0, hysteresis=5.0):
+    # the rows that changed and whether they are in alarm now
+    for topic, payload in readings:
+        assert table.set(topic.encode('utf8'), payload)
+    return [(table.topics[row], bool(table.alarms[row])) for row in table.evaluate(threshold, hysteresis).tolist()]
+
+def test_evaluate_threshold_and_hysteresis(temperature_alarm_engine):
+    table = temperature_alarm_engine.TemperatureTable()
+    table.update_node("node", ["core"])
+    raised = [(("node", "core"), True)]
+    resolved = [(("node", "core"), False)]
+    assert evaluate(table, [("node/property/core", b"79.9")]) == []
+    # the threshold raises the alarm
+    assert evaluate(table, [("node/property/core", b"80")]) == raised
+    assert table.get_active() == 1
+    # rising further or falling back into the hysteresis does not raise it again
+    for payload in [b"90", b"80", b"75", b"82"]:
+        assert evaluate(table, [("node/property/core", payload)]) == []
+    # it is resolved below the threshold minus the hysteresis
+    assert evaluate(table, [("node/property/core", b"74.9")]) == resolved
+    assert table.get_active() == 0
+    # and stays resolved until the threshold is reached again
+    for payload in [b"70", b"79"]:
+        assert evaluate(table, [("node/property/core", payload)]) == []
+    assert evaluate(table, [("node/property/core", b"81")]) == raised
+
+def test_evaluate_all_sensors_at_once(temperature_alarm_engine):
+    table = temperature_alarm_engine.TemperatureTable()
+    table.update_node("a", ["core", "gpu"])
+    table.update_node("b", ["core"])
+    readings = [("a/property/core", b"85"), ("a/property/gpu", b"60"), ("b/property/core", b"95")]
+    assert evaluate(table, readings) == [(("a", "core"), True), (("b", "core"), True)]
+    readings = [("a/property/core", b"60"), ("a/property/gpu", b"81"), ("b/property/core", b"78")]
+    assert evaluate(table, readings) == [(("a", "core"), False), (("a", "gpu"), True)]
+    assert table.readings == 6
+
+def test_evaluate_keeps_sensors_without_a_value(temperature_alarm_engine):
+    table = temperature_alarm_engine.TemperatureTable()
+    table.update_node("node", ["core", "gpu"])
+    assert evaluate(table, [("node/property/core", b"90")]) == [(("node", "core"), True)]
+    assert evaluate(table, [("node/property/core", b"nan")]) == []
+    assert table.get_active() == 1
+
+def test_set(temperature_alarm_engine):
+    table = temperature_alarm_engine.TemperatureTable()
+    table.update_node("node", ["core"])
+    assert not table.set(b"node/property/gpu", b"50")
+    assert not table.set(b"other/property/core", b"50")
+    with pytest.raises(ValueError):
+        table.set(b"node/property/core", b"hot")
+    assert table.readings == 0
+
+def test_update_node(temperature_alarm_engine):
+    table = temperature_alarm_engine.TemperatureTable()
+    table.update_node("node", ["core", "gpu"])
+    evaluate(table, [("node/property/core", b"90"), ("node/property/gpu", b"90")])
+    # the sensors that are gone resolve their alarms and free their rows for new ones
+    assert table.update_node("node", ["gpu", "fan"]) == ["core"]
+    assert len(table) == 2
+    assert table.size == 2
+    assert table.topics == [("node", "fan"), ("node", "gpu")]
+    assert not table.set(b"node/property/core", b"50")
+    assert numpy.isnan(table.values[0])
+    assert not table.alarms[0]
+    assert table.get_active() == 1
+    # a node without sensors frees all of its rows
+    assert table.update_node("node", []) == ["gpu"]
+    assert len(table) == 0
+
+def test_grow(temperature_alarm_engine):
+    table = temperature_alarm_engine.TemperatureTable(capacity=2)
+    sensors = ["temp{0}".format(i) for i in range(5)]
+    table.update_node("node", sensors)
+    readings = [("node/property/{0}".format(sensor), "{0}".format(78 + i).encode('utf8')) for i, sensor in enumerate(sensors)]
+    assert evaluate(table, readings) == [(("node", "temp2"), True), (("node", "temp3"), True), (("node", "temp4"), True)]
+    assert len(table.values) == 8
+
+def create_engine(temperature_alarm_engine):
+    table = temperature_alarm_engine.TemperatureTable()
+    engine = temperature_alarm_engine.TemperatureAlarmEngine("localhost", 1883, "alarms", table, 80.0, 5.0, 1.0)
+    engine._client = FakeClient(temperature_alarm_engine.async_mqtt)
+    return engine
+
+def receive(engine, topic, payload):
+    msg = paho.MQTTMessage(topic=topic.encode('utf8'))
+    msg.payload = payload.encode('utf8')
+    engine._on_message(msg)
+
+def test_birth(temperature_alarm_engine):
+    engine = create_engine(temperature_alarm_engine)
+    birth = [
+        {"topic": "node/property/core", "modes": ["pub"], "type": "numeric", "quantity": "temperature"},
+        {"topic": "node/property/fan", "modes": ["pub"], "type": "numeric", "quantity": "rotational_speed"},
+        # a threshold is a setting, not a sensor
+        {"topic": "node/property/threshold", "modes": ["pub"], "type": "numeric", "quantity": "temperature"},
+        {"topic": "node/property/threshold/set", "modes": ["sub"], "type": "numeric", "quantity": "temperature"},
+    ]
+    receive(engine, "node/BIRTH", json.dumps(birth))
+    assert engine._table.topics == [("node", "core")]
+    receive(engine, "node/property/core", "85")
+    engine._evaluate()
+    assert engine._client.published == [("alarms/property/alarms/node/core", "85.0°C")]
+    # the sensor is gone with an empty birth
+    receive(engine, "node/BIRTH", "")
+    assert engine._client.published[-1] == ("alarms/property/alarms/node/core", "resolved")
+    assert len(engine._table) == 0
+
+def test_alarms_that_do_not_fit_are_published_with_the_next_tick(temperature_alarm_engine):
+    engine = create_engine(temperature_alarm_engine)
+    engine._table.update_node("node", ["a", "b", "c"])
+    for sensor in ["a", "b", "c"]:
+        receive(engine, "node/property/{0}".format(sensor), "90")
+    engine._client.room = 1
+    engine._evaluate()
+    assert engine._client.published == [("alarms/property/alarms/node/a", "90.0°C")]
+    assert engine._table.get_active() == 1
+    engine._client.room = None
+    engine._evaluate()
+    assert [topic for topic, _ in engine._client.published] == ["alarms/property/alarms/node/{0}".format(sensor) for sensor in ["a", "b", "c"]]
+    assert engine._table.get_active() == 3
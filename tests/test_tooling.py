@@ -0,0 +1,234 @@
+import os
+import random
+import time
+
+import pytest
+
+def test_topic_filter_covers(tooling):
+    covers = tooling.topic_filter_covers
+    assert covers("a/#", "a/b/c")
+    assert covers("a/#", "a")
+    assert covers("a/+", "a/b")
+    assert covers("a/+", "a/+")
+    assert covers("+/+", "a/+")
+    assert covers("#", "a/b")
+    assert not covers("a/+", "a/b/c")
+    assert not covers("a/b", "a/+")
+    assert not covers("a/+", "a/#")
+    assert not covers("a/b", "a/c")
+
+def test_topic_filter_covers_dollar_topics(tooling):
+    covers = tooling.topic_filter_covers
+    assert not covers("#", "$SYS/#")
+    assert not covers("+/#", "$SYS/x")
+    assert not covers("+/x", "$SYS/x")
+    assert covers("$SYS/#", "$SYS/broker/uptime")
+    assert covers("$SYS/+", "$SYS/x")
+
+def test_reduce_topic_filters(tooling):
+    reduce = tooling.reduce_topic_filters
+    assert reduce(["a/b", "a/#", "c/+", "c/d", "a/#"]) == ["a/#", "c/+"]
+    assert reduce(["#", "$SYS/#", "a/b"]) == ["#", "$SYS/#"]
+    assert reduce(["a/b", "b/a"]) == ["a/b", "b/a"]
+
+def test_topic_trie(tooling):
+    trie = tooling.TopicTrie(["a/+/c", "b/#", "$SYS/broker/+"])
+    assert trie.matches("a/b/c")
+    assert not trie.matches("a/b/d")
+    assert trie.matches("b")
+    assert trie.matches("b/x/y")
+    assert trie.matches("$SYS/broker/uptime")
+    assert not trie.matches("$SYS/other")
+    assert not tooling.TopicTrie(["#"]).matches("$SYS/x")
+    assert not tooling.TopicTrie(["+/x"]).matches("$SYS/x")
+
+def test_shard(tooling):
+    publishers = ["a", "b", "c", "d"]
+    assert tooling.shard(["only"], "x/y", "topic") == "only"
+    # the same topic always goes to the same publisher
+    assert tooling.shard(publishers, "x/y", "topic") == tooling.shard(publishers, "x/y", "topic")
+    # by prefix all topics below the first level go to the same publisher
+    shards = set(tooling.shard(publishers, "node{0}/property/{1}".format(3, i), "prefix") for i in range(20))
+    assert len(shards) == 1
+    shards = set(tooling.shard(publishers, "node/property/{0}".format(i), "topic") for i in range(100))
+    assert len(shards) == 4
+
+def write_snapshot(tooling, path, records):
+    writer = tooling.RetainedSnapshotWriter(path)
+    for topic, qos, payload in records:
+        writer.append(topic, qos, payload)
+    count = writer.close()
+    assert writer.size == os.path.getsize(path)
+    return count
+
+def read_snapshot(tooling, path):
+    reader = tooling.RetainedSnapshotReader(path)
+    try:
+        return len(reader), [(topic, qos, bytes(payload)) for topic, qos, payload in reader]
+    finally:
+        reader.close()
+
+@pytest.mark.parametrize("run_size", [2, 5, 1 << 16])
+def test_snapshot_round_trip(tooling, tmp_path, monkeypatch, run_size):
+    monkeypatch.setattr(tooling.RetainedSnapshotWriter, "RUN_SIZE", run_size)
+    rng = random.Random(run_size)
+    records = []
+    latest = {}
+    for i in range(200):
+        topic = "sensors/{0}/temperature".format(rng.randrange(50))
+        record = (topic, rng.randrange(3), bytes(rng.randrange(256) for _ in range(rng.randrange(8))))
+        records.append(record)
+        latest[topic] = record
+    path = str(tmp_path / "retained.snapshot")
+    count = write_snapshot(tooling, path, records)
+    # the index holds the latest value of every topic, sorted by topic
+    expected = [latest[topic] for topic in sorted(latest)]
+    assert count == len(expected)
+    assert read_snapshot(tooling, path) == (len(expected), expected)
+
+def test_snapshot_empty(tooling, tmp_path):
+    path = str(tmp_path / "empty.snapshot")
+    assert write_snapshot(tooling, path, []) == 0
+    assert read_snapshot(tooling, path) == (0, [])
+
+def test_snapshot_sorts_by_encoded_topic(tooling, tmp_path, monkeypatch):
+    monkeypatch.setattr(tooling.RetainedSnapshotWriter, "RUN_SIZE", 2)
+    path = str(tmp_path / "unicode.snapshot")
+    records = [("b", 0, b"1"), ("ä", 1, b"2"), ("a", 2, b""), ("B", 0, b"3")]
+    write_snapshot(tooling, path, records)
+    topics = [topic for topic, _, _ in read_snapshot(tooling, path)[1]]
+    assert topics == sorted(topics, key=lambda topic: topic.encode('utf8'))
+
+def test_snapshot_interrupted(tooling, tmp_path):
+    path = str(tmp_path / "interrupted.snapshot")
+    write_snapshot(tooling, path, [("a", 0, b"1"), ("b", 0, b"2")])
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 1)
+    with pytest.raises(ValueError):
+        tooling.RetainedSnapshotReader(path)
+
+def test_snapshot_not_a_snapshot(tooling, tmp_path):
+    path = tmp_path / "other.snapshot"
+    path.write_bytes(b"x" * 64)
+    with pytest.raises(ValueError):
+        tooling.RetainedSnapshotReader(str(path))
+
+def test_space_saving_exact(tooling):
+    counter = tooling.SpaceSaving(10)
+    for item, count in [("a", 5), ("b", 3), ("c", 1)]:
+        for _ in range(count):
+            counter.add(item, 10)
+    assert counter.evicted == 0
+    assert counter.top(2) == [("a", 5, 0, 50), ("b", 3, 0, 30)]
+
+def test_space_saving_bounded(tooling):
+    counter = tooling.SpaceSaving(5)
+    rng = random.Random(1)
+    counts = {}
+    stream = ["hot"] * 500 + ["warm"] * 200 + ["cold{0}".format(i) for i in range(1000)]
+    rng.shuffle(stream)
+    for item in stream:
+        counts[item] = counts.get(item, 0) + 1
+        counter.add(item, 1)
+    assert len(counter) == 5
+    assert counter.evicted > 0
+    top = counter.top(2)
+    assert [item for item, _, _, _ in top] == ["hot", "warm"]
+    for item, count, error, _ in top:
+        # counts are overestimated by at most their error
+        assert count - error <= counts[item] <= count
+
+def test_reservoir(tooling):
+    reservoir = tooling.Reservoir(10, seed=1)
+    for i in range(5):
+        assert reservoir.wants()
+        reservoir.add(i)
+    assert reservoir.items == list(range(5))
+    for i in range(5, 10000):
+        if reservoir.wants():
+            reservoir.add(i)
+        else:
+            reservoir.skip()
+    assert len(reservoir.items) == 10
+    assert len(set(reservoir.items)) == 10
+    # the sample is not stuck at the first items
+    assert max(reservoir.items) >= 10
+
+def test_reservoir_uniform(tooling):
+    # every item of the stream ends up in the sample with the same probability
+    hits = [0] * 10
+    for seed in range(2000):
+        reservoir = tooling.Reservoir(2, seed=seed)
+        for i in range(10):
+            if reservoir.wants():
+                reservoir.add(i)
+            else:
+                reservoir.skip()
+        for item in reservoir.items:
+            hits[item] += 1
+    for count in hits:
+        assert 300 < count < 500
+
+def write_capture(tooling, path, count, **kwargs):
+    writer = tooling.CaptureWriter(path, **kwargs)
+    started_on = time.monotonic()
+    messages = []
+    for i in range(count):
+        topic = "node/{0}/property/temperature".format(i % 7)
+        payload = "{0}".format(i).encode('utf8')
+        qos = i % 3
+        retain = i % 5 == 0
+        writer.append(started_on + i * 0.001, topic, qos, retain, payload)
+        messages.append((topic, qos, retain, payload))
+    writer.close()
+    assert writer.messages == count
+    assert writer.size == os.path.getsize(path)
+    return messages
+
+def read_capture(reader, start_us=0, end_us=None):
+    return [(us, topic, qos, retain, bytes(payload)) for us, topic, qos, retain, payload in reader.read(start_us, end_us)]
+
+def test_capture_round_trip(tooling, tmp_path):
+    path = str(tmp_path / "messages.capture")
+    # small segments, so the topics are defined again in every one of them
+    messages = write_capture(tooling, path, 100, segment_bytes=200)
+    reader = tooling.CaptureReader(path)
+    try:
+        assert reader.complete
+        assert len(reader) > 1
+        read = read_capture(reader)
+        assert [message[1:] for message in read] == messages
+        timestamps = [message[0] for message in read]
+        assert timestamps == sorted(timestamps)
+        assert reader.last_us == timestamps[-1]
+        # reading starts in the middle of a segment
+        start_us = timestamps[42]
+        assert read_capture(reader, start_us) == [message for message in read if message[0] >= start_us]
+        end_us = timestamps[60]
+        assert read_capture(reader, start_us, end_us) == [message for message in read if start_us <= message[0] < end_us]
+    finally:
+        reader.close()
+
+def test_capture_cut_off(tooling, tmp_path):
+    path = str(tmp_path / "cut_off.capture")
+    messages = write_capture(tooling, path, 50, segment_bytes=200)
+    reader = tooling.CaptureReader(path)
+    segments = len(reader)
+    reader.close()
+    # cut off the index, the footer and the last byte of the last message
+    index_size = tooling.CaptureWriter.INDEX_ENTRY.size * segments + tooling.CaptureWriter.FOOTER.size
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - index_size - 1)
+    reader = tooling.CaptureReader(path)
+    try:
+        assert not reader.complete
+        assert len(reader) == segments
+        assert [message[1:] for message in read_capture(reader)] == messages[:-1]
+    finally:
+        reader.close()
+
+def test_capture_not_a_capture(tooling, tmp_path):
+    path = tmp_path / "other.capture"
+    path.write_bytes(b"MQTTSNAP" + b"\0" * 32)
+    with pytest.raises(ValueError):
+        tooling.CaptureReader(str(path))